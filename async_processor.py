@@ -0,0 +1,633 @@
+"""Queries for and processes xmatters instance data using asyncio
+
+    An alternative capture engine to processor.py.  It walks the same
+    Sites, People, Devices, Groups and Shifts pagination, but keeps many
+    requests in flight from a single thread instead of using worker
+    threads.  The output files and admin sets are the same as those written
+    by processor.process.
+
+    Requires the aiohttp module (`pip install aiohttp`).
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+# The admin sets, output files, and error logging are shared with processor
+# pylint: disable=protected-access
+
+import asyncio
+import time
+import urllib.parse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import config
+import common_logger
+import http_archive
+import instances
+import json_codec
+import metrics
+import profiler
+import processor
+import shards
+import site_cache
+import sqlite_export
+import writers
+import xm_session
+
+_logger = None
+_session = None
+# Paces the requests, and backs off when throttled, see xm_session
+_scheduler = None
+
+class _Response(object):
+    """Minimal response holder so processor._log_xm_error can be reused"""
+    def __init__(self, status_code: int, body: dict):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        """Returns the decoded response body"""
+        return self._body
+
+async def _replay(url: str):
+    """Answers a request from the archive, see http_archive.replay
+
+    Args:
+        url (str): The location to request
+
+    Return:
+        (int, dict, bytes): The recorded status, headers, and body
+    """
+    entry = http_archive.lookup(url)
+    if entry is None:
+        raise aiohttp.ClientConnectionError('Not in the archive: ' + url)
+    if config.replay_latency:
+        await asyncio.sleep(entry['seconds'])
+    if entry['status'] is None:
+        raise aiohttp.ClientConnectionError(entry['error'])
+    return entry['status'], entry['headers'], entry['body'].encode('utf-8')
+
+async def _request(url: str):
+    """Sends a single GET, or answers it from the archive
+
+    Args:
+        url (str): The location to request
+
+    Return:
+        (int, Mapping, bytes): The status, headers, and body
+    """
+    if http_archive.replaying():
+        return await _replay(url)
+    async with _session.get(url) as response:
+        return response.status, response.headers, await response.read()
+
+async def _get(url: str):
+    """Issues a GET against the xMatters instance
+
+    Waits on the scheduler, and on the budget shared with other instances
+    when capturing several, before each attempt.  Throttled, 5xx, and
+    failed connection attempts are retried up to config.max_retries
+    times, as xm_session.get does.
+
+    Args:
+        url (str): The location to request
+
+    Return:
+        response (_Response): The response, or the last failed response
+            once the retries are used up, or None if the request failed
+    """
+    attempt = 0
+    while True:
+        await _scheduler.acquire()
+        await instances.acquire_async()
+        started = time.monotonic()
+        try:
+            status, headers, content = await _request(url)
+            elapsed = time.monotonic() - started
+            metrics.record_request(url, status, len(content), elapsed)
+            profiler.add('network', elapsed)
+            http_archive.record(url, status, headers, content, elapsed)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            elapsed = time.monotonic() - started
+            metrics.record_request(url, None, 0, elapsed)
+            profiler.add('network', elapsed)
+            http_archive.record_failure(url, e, elapsed)
+            if attempt >= config.max_retries:
+                _logger.error(config.ERR_REQUEST_EXCEPTION_MSG, url, repr(e))
+                return None
+            reason = repr(e)
+            delay = xm_session.backoff(attempt)
+        else:
+            if status not in xm_session.RETRY_STATUSES or attempt >= config.max_retries:
+                if status not in xm_session.RETRY_STATUSES:
+                    _scheduler.succeeded()
+                decoding = time.perf_counter()
+                try:
+                    body = json_codec.loads(content) if content.strip() else None
+                except ValueError as e:
+                    _logger.error(config.ERR_REQUEST_EXCEPTION_MSG, url, repr(e))
+                    return None
+                profiler.add('json decode', time.perf_counter() - decoding)
+                return _Response(status, body)
+            reason = 'status ' + str(status)
+            delay = xm_session.backoff(attempt)
+            if status == 429:
+                wait = xm_session.retry_after(headers)
+                if wait is not None:
+                    delay = wait
+                _scheduler.throttled(delay)
+        finally:
+            instances.release()
+            _scheduler.release()
+
+        attempt += 1
+        _logger.warning('Retrying (%d of %d) in %.1f seconds after %s from %s',
+                        attempt, config.max_retries, delay, reason, url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+def _failed(url: str, response: _Response):
+    """Logs and counts a request that failed for good
+
+    Args:
+        url (str): The location that was requested
+        response (_Response): The response, or None if there was none
+    """
+    if response is None:
+        processor._request_failed()
+    else:
+        processor._log_xm_error(url, response)
+
+async def _get_pages(url: str):
+    """Yields each page of a paginated xMatters list
+
+    Follows the links.next of each page, and requests the next page while
+    the caller is still working on the current one.
+
+    Args:
+        url (str): The location of the first page
+
+    Return:
+        bodys (dict): Each page of the list, in order
+    """
+    next_page = asyncio.ensure_future(_get(url))
+    while next_page is not None:
+        response = await next_page
+        next_page = None
+        if response is None or response.status_code != 200:
+            _failed(url, response)
+            break
+
+        # Start on the next page before handing back this one
+        bodys = response.json()
+        page_url = url
+        if 'links' in bodys and 'next' in bodys['links']:
+            url = config.xmod_url + bodys['links']['next']
+            next_page = asyncio.ensure_future(_get(url))
+        _logger.debug("%d Count of %d Total found via url=%s",
+                      bodys['count'], bodys['total'], page_url)
+        yield bodys
+
+async def _get_object(url: str):
+    """Retrieves a single object, or None if it could not be retrieved
+
+    Args:
+        url (str): The location of the object
+
+    Return:
+        obj (dict): The object
+    """
+    response = await _get(url)
+    if response is None or response.status_code != 200:
+        _failed(url, response)
+        return None
+    return response.json()
+
+async def _fetch_site_name(site_id: str):
+    """Retrieves a Site name from xMatters and caches it
+
+    A Site that is not found is cached as such, but other failures are not
+    cached, so the Site is asked for again next time.
+
+    Args:
+        site_id (str): The ID of the site to find
+
+    Return:
+        site_name (str): The Site's name, or None if not found
+    """
+    url = config.xmod_url + '/api/xm/1/sites/' + site_id
+    _logger.debug('Retrieving Site, url=%s', url)
+    try:
+        response = await _get(url)
+    finally:
+        del processor._capture.site_lookups[site_id]
+    if response is None or response.status_code != 200:
+        _failed(url, response)
+        if response is not None and response.status_code == 404:
+            site_cache.put(site_id, None)
+        return None
+    site = response.json()
+    site_cache.put(site['id'], site['name'])
+    return site['name']
+
+async def _lookup_site_name(site_id: str):
+    """Retrieves a Site name by ID
+
+    Attempts to find the Site by it's ID in the Site cache, if not found,
+    then retrieve the Site object from xMatters.  Concurrent lookups for
+    the same Site wait on the same request.
+
+    Args:
+        site_id (str): The ID of the site to find
+
+    Return:
+        site_name (str): The Site's name, or None if not found
+    """
+    known, site_name = site_cache.get(site_id)
+    if known:
+        return site_name
+    if site_id not in processor._capture.site_lookups:
+        processor._capture.site_lookups[site_id] = asyncio.ensure_future(_fetch_site_name(site_id))
+    return await processor._capture.site_lookups[site_id]
+
+async def _process_sites():
+    """Capture and save the instances Site objects
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+    _logger.info('Begin Gathering Sites.')
+    sites_file = processor._track_file(writers.RecordWriter(config.sites_filename))
+
+    # Initialize conditions
+    total_sites = 0
+    cnt = 0
+    failures = processor._capture.failures
+    url = config.xmod_url + '/api/xm/1/sites?offset=0&limit=' + str(config.page_size)
+    _logger.debug('Gathering Sites via url=%s', url)
+    profiler.begin_phase('sites')
+    metrics.begin_phase('sites')
+
+    async for bodys in _get_pages(url):
+        total_sites = bodys['total']
+        for body in bodys['data']:
+            cnt += 1
+            _logger.info(f'Capturing Site "{body["name"]}"')
+            sites_file.write_record(body)
+            sqlite_export.add('sites', body)
+            processor._update_site_admin(body)
+        site_cache.update(bodys['data'])
+        metrics.progress('sites', cnt, total_sites)
+
+    metrics.end_phase('sites')
+    profiler.end_phase('sites')
+
+    _logger.info("Collected %d of a possible %d Sites.", cnt, total_sites)
+    if cnt >= total_sites and processor._capture.failures == failures:
+        site_cache.refreshed()
+
+    processor._close_file(sites_file)
+    processor._check_phase('sites', cnt, total_sites, failures)
+
+async def _refresh_sites():
+    """Fills the Site cache from the Sites list, unless it is fresh
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+    if site_cache.is_fresh():
+        return
+    _logger.info('Refreshing the Site cache.')
+    listed_sites = 0
+    total_sites = 0
+    failures = processor._capture.failures
+    url = config.xmod_url + '/api/xm/1/sites?offset=0&limit=' + str(config.page_size)
+    async for bodys in _get_pages(url):
+        total_sites = bodys['total']
+        listed_sites += bodys['count']
+        site_cache.update(bodys['data'])
+    if listed_sites >= total_sites and processor._capture.failures == failures:
+        site_cache.refreshed()
+
+async def _get_user_devices(user_id: str, target_name: str):
+    """Return a User's Devices
+
+    Args:
+        user_id (str): The User's UUID
+        target_name (str): The User's targetName field
+
+    Return:
+        device_list (list): List of dictionaries of the User's devices.
+    """
+    device_list = []
+    url = config.xmod_url + '/api/xm/1/people/' + user_id + '/devices/?embed=timeframes&offset=0&limit=' + str(config.page_size)
+    _logger.debug('Gathering Devices for user "%s", url=%s', target_name, url)
+
+    async for bodys in _get_pages(url):
+        device_list += bodys['data']
+        processor._update_device_admin(bodys['data'])
+
+    _logger.debug('Collected %d Devices for User "%s".', len(device_list), target_name)
+    return device_list
+
+async def _collect_devices():
+    """Collects every Device in the instance, grouped by owner
+
+    As with processor._collect_devices, if any Device was missed, the
+    Users are marked incomplete too.
+
+    Args:
+        None
+
+    Return:
+        devices_by_owner (dict): Lists of Devices by owner id
+    """
+    _logger.info('Begin gathering Devices.')
+    failures = processor._capture.failures
+    devices_by_owner = {}
+    total_devices = 0
+    cnt = 0
+    url = config.xmod_url + '/api/xm/1/devices?embed=timeframes&offset=0&limit=' + str(config.page_size)
+    _logger.debug('Gathering Devices via url=%s', url)
+    profiler.begin_phase('devices')
+    metrics.begin_phase('devices')
+
+    async for bodys in _get_pages(url):
+        total_devices = bodys['total']
+        for body in bodys['data']:
+            cnt += 1
+            devices_by_owner.setdefault(body['owner']['id'], []).append(body)
+        processor._update_device_admin(bodys['data'])
+        metrics.progress('devices', cnt, total_devices)
+
+    metrics.end_phase('devices')
+    profiler.end_phase('devices')
+
+    _logger.info("Collected %d of a possible %d Devices for %d Users.", cnt, total_devices, len(devices_by_owner))
+    processor._check_phase('devices', cnt, total_devices, failures)
+    if 'devices' in processor._capture.incomplete:
+        processor._incomplete_phase('users')
+    return devices_by_owner
+
+async def _capture_user(body: dict, include_devices: bool, devices_by_owner: dict):
+    """Capture a single User, and possibly their Devices
+
+    Args:
+        body (dict): The User entry from the people list
+        include_devices (bool): If True, get the User's devices too
+        devices_by_owner (dict): Lists of Devices by owner id, or None to
+            request each User's Devices
+
+    Return:
+        user_obj (dict): The User record, or None if the User was not found
+    """
+    _logger.info(f'Capturing User: "{body["targetName"]}".')
+    if config.bulk_users and processor._has_complete_embeds(body):
+        a_user = body
+    else:
+        url = config.xmod_url + '/api/xm/1/people/' + urllib.parse.quote(body['id']) + '?embed=' + ','.join(processor.USER_EMBEDS)
+        a_user = await _get_object(url)
+        if a_user is None:
+            return None
+    processor._update_user_admin(a_user)
+    user_obj = {'user': a_user}
+
+    # Get the devices, if requested
+    if include_devices and devices_by_owner is not None:
+        user_obj['devices'] = devices_by_owner.pop(a_user['id'], [])
+    elif include_devices:
+        user_obj['devices'] = await _get_user_devices(a_user['id'], a_user['targetName'])
+
+    return user_obj
+
+async def _process_users(include_devices: bool):
+    """Capture and save the instances User objects
+
+    Every User on a page is captured concurrently, and then saved in list
+    order.
+
+    Args:
+        include_devices (bool): If True, get the User's devices too
+
+    Return:
+        None
+    """
+    # Get every Device up front, rather than per User
+    failures = processor._capture.failures
+    devices_by_owner = None
+    if include_devices and config.bulk_devices:
+        devices_by_owner = await _collect_devices()
+
+    _logger.info('Begin gathering Users.')
+    users_file = processor._track_file(shards.open_writer('users', config.users_filename))
+
+    # Initialize conditions
+    listed_users = 0
+    total_users = 0
+    cnt = 0
+    url = config.xmod_url + '/api/xm/1/people?offset=0&limit=' + str(config.page_size)
+    if config.bulk_users:
+        url += '&embed=' + ','.join(processor.USER_EMBEDS)
+    _logger.debug('Gathering Users via url=%s', url)
+    profiler.begin_phase('users')
+    metrics.begin_phase('users')
+
+    async for bodys in _get_pages(url):
+        total_users = bodys['total']
+        listed_users += bodys['count']
+        user_objs = await asyncio.gather(
+            *(_capture_user(body, include_devices, devices_by_owner)
+              for body in bodys['data']))
+        for user_obj in user_objs:
+            if user_obj is not None:
+                cnt += 1
+                users_file.write_record(user_obj)
+                sqlite_export.add('users', user_obj)
+        metrics.progress('users', listed_users, total_users)
+
+    metrics.end_phase('users')
+    profiler.end_phase('users')
+
+    _logger.info("Collected %d of a possible %d Users.", listed_users, total_users)
+
+    processor._close_file(users_file)
+    processor._check_phase('users', listed_users, total_users, failures)
+
+async def _get_group_shifts(group_id: str, target_name: str):
+    """Return a Group's Shifts
+
+    Args:
+        group_id (str): The Group's UUID
+        target_name (str): The Group's targetName field
+
+    Return:
+        shift_list (list): List of dictionaries of the Group's Shifts.
+    """
+    shift_list = []
+    url = config.xmod_url + '/api/xm/1/groups/' + group_id + '/shifts/?embed=members,rotation&offset=0&limit=' + str(config.page_size)
+    _logger.debug(f'Gathering Shifts for Group "{target_name}", url={url}')
+
+    async for bodys in _get_pages(url):
+        shift_list += bodys['data']
+
+    _logger.debug(f'Collected {len(shift_list)} Shifts for Group "{target_name}".')
+    return shift_list
+
+async def _capture_group(body: dict):
+    """Capture a single Group and its Shifts
+
+    The Group and its Shifts are requested at the same time.
+
+    Args:
+        body (dict): The Group entry from the groups list
+
+    Return:
+        group_obj (dict): The Group record, or None if the Group was not found
+    """
+    _logger.info(f"Retrieving Group: {body['targetName']}")
+    url = config.xmod_url + '/api/xm/1/groups/' + urllib.parse.quote(body['id']) + '?embed=supervisors'
+    a_group, shifts = await asyncio.gather(
+        _get_object(url), _get_group_shifts(body['id'], body['targetName']))
+    if a_group is None:
+        return None
+
+    # If present, translate the Site from an ID to a name
+    if 'site' in a_group:
+        site_name = await _lookup_site_name(a_group['site']['id'])
+        del a_group['site']
+        a_group['site'] = site_name
+    return {'group': a_group, 'shifts': shifts}
+
+async def _process_groups():
+    """Capture and save the instances Group objects
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+    failures = processor._capture.failures
+    await _refresh_sites()
+    _logger.info('Begin capturing Groups.')
+    groups_file = processor._track_file(shards.open_writer('groups', config.groups_filename))
+
+    # Initialize conditions
+    listed_groups = 0
+    total_groups = 0
+    cnt = 0
+    url = config.xmod_url + '/api/xm/1/groups?offset=0&limit=' + str(config.page_size)
+    _logger.debug('Gathering Groups via url=%s', url)
+    profiler.begin_phase('groups')
+    metrics.begin_phase('groups')
+
+    async for bodys in _get_pages(url):
+        total_groups = bodys['total']
+        listed_groups += bodys['count']
+        group_objs = await asyncio.gather(
+            *(_capture_group(body) for body in bodys['data']))
+        for group_obj in group_objs:
+            if group_obj is not None:
+                cnt += 1
+                groups_file.write_record(group_obj)
+                sqlite_export.add('groups', group_obj)
+        metrics.progress('groups', listed_groups, total_groups)
+
+    metrics.end_phase('groups')
+    profiler.end_phase('groups')
+
+    _logger.info(f"Collected {listed_groups} of a possible {total_groups} Groups.")
+
+    processor._close_file(groups_file)
+    processor._check_phase('groups', listed_groups, total_groups, failures)
+
+async def _process(objects_to_process: list):
+    """Opens the session and captures the requested objects
+
+    Args:
+        objects_to_process (list): The list of object types to capture
+    """
+    global _session, _scheduler # pylint: disable=global-statement
+
+    connector = aiohttp.TCPConnector(limit=config.max_requests)
+    timeout = aiohttp.ClientTimeout(sock_connect=config.connect_timeout,
+                                    sock_read=config.read_timeout)
+    auth = aiohttp.BasicAuth(config.basic_auth.username,
+                             config.basic_auth.password)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     auth=auth) as session:
+        _session = session
+        _scheduler = xm_session.async_scheduler()
+
+        # Capture and save the Site objects
+        if 'sites' in objects_to_process:
+            await _process_sites()
+
+        # Capture and save the User objects, and possibly devices
+        if 'users' in objects_to_process:
+            await _process_users('devices' in objects_to_process)
+        elif 'devices' in objects_to_process:
+            await _process_users(True)
+
+        # Capture and save the Group objects
+        if 'groups' in objects_to_process:
+            await _process_groups()
+
+    _session = None
+
+def process(objects_to_process: list):
+    """Capture objects for this instance.
+
+    Same as processor.process, but using the asyncio engine.
+
+    Args:
+        objects_to_process (list): The list of object types to capture
+    """
+    global _logger # pylint: disable=global-statement
+
+    json_codec.begin()
+    metrics.begin()
+    http_archive.begin()
+    sqlite_export.begin()
+    processor._begin_capture()
+    site_cache.load()
+    profiler.begin()
+    _logger = common_logger.get_logger()
+    _logger.debug('Using the asyncio engine with up to %d requests in flight',
+                  config.max_requests)
+
+    try:
+        asyncio.run(_process(objects_to_process))
+
+        # Preserve the collected admin data and the run metrics
+        profiler.begin_phase('admin save')
+        processor._save_admin_data()
+        profiler.end_phase('admin save')
+        metrics.save(config.metrics_filename)
+        sqlite_export.finish()
+        site_cache.save()
+        http_archive.finish()
+    finally:
+        # Also when the capture raised, so the next one starts afresh
+        processor._close_open_files()
+        metrics.finish()
+        profiler.finish()
+    processor._end_capture()
+
+def main():
+    """In case we need to execute the module directly"""
+    pass
+
+if __name__ == '__main__':
+    main()
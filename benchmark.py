@@ -0,0 +1,160 @@
+"""Benchmarks the capture end to end against a mock xMatters instance
+
+    Starts a mock_xmatters server, then runs each capture command against
+    it in a fresh process, and reports the wall time, requests made,
+    requests per second, peak resident memory, and bytes of output for
+    each one.  Any arguments that are not benchmark arguments are passed
+    to the capture, so the capture options can be compared, e.g.:
+
+    $ python3 benchmark.py --users 20000 --latency 0.02 -w 8
+    $ python3 benchmark.py --users 20000 --latency 0.02 -w 8 -B -D
+    $ python3 benchmark.py --users 5000 --throttle-rate 0.01 --commands users
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+import mock_xmatters
+
+COMMANDS = ['sites', 'users', 'devices', 'groups', 'all']
+
+def _peak_rss() -> int:
+    """Returns the peak resident memory of this process, in bytes"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _run_capture(argv: list, results: multiprocessing.Queue):
+    """Runs a capture command, in the child process
+
+    Args:
+        argv (list): The capture command line, without the program name
+        results (Queue): Receives the error, if any, and the peak RSS
+    """
+    sys.argv = ['capture-instance-data.py']
+    import cli # pylint: disable=import-outside-toplevel
+    error = None
+    try:
+        args = cli.process_command_line(argv, __doc__)
+        args.func(args)
+    except BaseException as e: # pylint: disable=broad-except
+        error = repr(e)
+    results.put((error, _peak_rss()))
+
+def _output_bytes(out_directory: str) -> int:
+    """Returns the bytes written to the output files, ignoring the log"""
+    return sum(os.path.getsize(os.path.join(out_directory, name))
+               for name in os.listdir(out_directory)
+               if not name.endswith('.log'))
+
+def run(instance: mock_xmatters.MockInstance, url: str, command: str,
+        capture_args: list, work_directory: str) -> dict:
+    """Runs and measures one capture command
+
+    Args:
+        instance (MockInstance): The instance being served at url
+        url (str): Base URL of the mock instance
+        command (str): One of COMMANDS
+        capture_args (list): Extra capture command line arguments
+        work_directory (str): Directory for the defaults and output
+
+    Returns:
+        dict: The measurements of the run
+    """
+    out_directory = tempfile.mkdtemp(prefix=command + '.', dir=work_directory)
+    defaults_filename = os.path.join(out_directory, 'defaults.json')
+    with open(defaults_filename, 'w') as defaults:
+        json.dump({
+            'xmodURL': url, 'user': 'benchmark', 'password': 'benchmark',
+            'outDirectory': out_directory, 'dirSep': os.sep,
+            'baseName': 'benchmark', 'logFilename': 'capture'}, defaults)
+    argv = ['-d', defaults_filename] + capture_args + [command]
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    child = context.Process(target=_run_capture, args=(argv, results))
+    instance.reset_counts()
+    start = time.perf_counter()
+    child.start()
+    error, peak_rss = results.get()
+    child.join()
+    seconds = time.perf_counter() - start
+    os.remove(defaults_filename)
+
+    return {
+        'command': command,
+        'seconds': seconds,
+        'requests': instance.requests,
+        'requestsPerSecond': instance.requests / seconds if seconds else 0.0,
+        'peakRSS': peak_rss,
+        'outputBytes': _output_bytes(out_directory),
+        'responses': {str(status): count for status, count
+                      in sorted(instance.responses.items())},
+        'error': error
+    }
+
+def _report(results: list):
+    """Prints a table of the measurements"""
+    print('%-8s %9s %9s %9s %12s %14s  %s' % (
+        'command', 'seconds', 'requests', 'req/s', 'peak RSS MB',
+        'output bytes', 'responses'))
+    for result in results:
+        print('%-8s %9.2f %9d %9.1f %12.1f %14d  %s%s' % (
+            result['command'], result['seconds'], result['requests'],
+            result['requestsPerSecond'], result['peakRSS'] / (1024 * 1024),
+            result['outputBytes'],
+            ' '.join('%s:%d' % item for item in result['responses'].items()),
+            '  FAILED ' + result['error'] if result['error'] else ''))
+
+def main():
+    """Serves the mock instance and benchmarks each command against it"""
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the capture against a mock xMatters instance",
+        epilog="Other arguments are passed to capture-instance-data.py")
+    mock_xmatters.add_instance_arguments(parser)
+    parser.add_argument("--commands", nargs='+', choices=COMMANDS,
+                        default=COMMANDS,
+                        help="Commands to benchmark [default: all of them]")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Runs of each command [default: %(default)s]")
+    parser.add_argument("--keep", dest="keep_directory",
+                        help="Keep the output in this directory")
+    parser.add_argument("--json", dest="json_filename",
+                        help="Also save the measurements to this file")
+    args, capture_args = parser.parse_known_args()
+
+    instance = mock_xmatters.instance_from_arguments(args)
+    server = mock_xmatters.start_server(instance)
+    url = 'http://127.0.0.1:%d' % server.server_port
+    results = []
+    with tempfile.TemporaryDirectory(prefix='benchmark.') as temp_directory:
+        work_directory = args.keep_directory or temp_directory
+        os.makedirs(work_directory, exist_ok=True)
+        for command in args.commands:
+            for _ in range(args.repeat):
+                results.append(run(instance, url, command, capture_args,
+                                   work_directory))
+    server.shutdown()
+
+    _report(results)
+    if args.json_filename:
+        with open(args.json_filename, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
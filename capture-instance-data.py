@@ -23,6 +23,7 @@ import sys
 
 import config
 import cli
+import processor
 
 __all__ = []
 __version__ = config.VERSION
@@ -33,7 +34,11 @@ def main(argv=None):
     """ Begins the New Properties process """
     
     args = cli.process_command_line(argv, __doc__)
-    args.func(args)
+    try:
+        args.func(args)
+    except processor.CaptureIncomplete:
+        # Already logged, but a scheduler must see that it failed
+        return config.ERR_CAPTURE_INCOMPLETE_CODE
     return 0
 
 if __name__ == "__main__":
@@ -43,17 +48,6 @@ if __name__ == "__main__":
     if config.TESTRUN:
         import doctest
         doctest.testmod()
-    if config.PROFILE:
-        import cProfile
-        import pstats
-        profile_filename = 'capture-instance-data_profile.txt'
-        cProfile.run('main()', profile_filename)
-        statsfile = open("profile_stats.txt", "wb")
-        p = pstats.Stats(profile_filename, stream=statsfile)
-        stats = p.strip_dirs().sort_stats('cumulative')
-        stats.print_stats()
-        statsfile.close()
-        sys.exit(0)
     try:
         sys.exit(main())
     
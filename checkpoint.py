@@ -0,0 +1,132 @@
+"""Persists and restores the progress of a capture so it may be resumed.
+
+    After each page of Sites, Users, or Groups is saved, the offset of the
+    next page, the number of records and bytes written to the output file,
+    and the admin sets collected so far are committed to the checkpoint
+    file.  A capture started with --resume reloads the checkpoint, reuses
+    the same output files, and continues from the last committed page.
+
+    The checkpoint file is removed once the capture completes.
+
+    Attributes:
+        __state (dict): Holds the progress of the current capture
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import os
+
+import config
+import writers
+
+__state = None
+
+def load() -> dict:
+    """Reads the checkpoint file of an interrupted capture
+
+    Args:
+
+    Returns:
+        dict: The saved progress, or None if there is no checkpoint
+    """
+    try:
+        with open(config.checkpoint_filename) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+
+def begin():
+    """Starts tracking the progress of a capture
+
+    When resuming, the progress is reloaded from the checkpoint file,
+    otherwise a new checkpoint is started for config.time_str.
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __state # pylint: disable=global-statement
+    __state = load() if config.resume else None
+    if __state is None:
+        __state = {'timeStr': config.time_str, 'phases': {}, 'admin': {}}
+
+def admin_sets() -> dict:
+    """Returns the admin sets saved by the interrupted capture
+
+    Args:
+
+    Returns:
+        dict: Lists of admin values by set name
+    """
+    return __state['admin']
+
+def phase(name: str) -> dict:
+    """Returns the saved progress for a type of object
+
+    Args:
+        name (str): The type of object, e.g. 'users'
+
+    Returns:
+        dict: With 'offset' of the next page to request, 'written' records,
+            'position' in bytes of the output file (a [position, written]
+            per shard if sharded, see shards.ShardedWriter.sync), and 'done'
+    """
+    return __state['phases'].get(
+        name, {'offset': 0, 'written': 0, 'position': 0, 'done': False})
+
+def commit(name: str, offset: int, written: int, out_file: writers.RecordWriter,
+           admin_objects: dict, done: bool = False):
+    """Saves the progress for a type of object
+
+    The output file is synced first, so the checkpoint never refers to
+    data that is not on disk.  The checkpoint file is replaced atomically.
+
+    Args:
+        name (str): The type of object, e.g. 'users'
+        offset (int): The offset of the next page to request
+        written (int): The number of records written to out_file
+        out_file (RecordWriter): The output file, which may be a
+            shards.ShardedWriter, or None when done
+        admin_objects (dict): The admin sets collected so far
+        done (bool): True when every page has been saved
+
+    Returns:
+        None
+    """
+    position = 0
+    if out_file is not None:
+        position = out_file.sync()
+    __state['phases'][name] = {
+        'offset': offset, 'written': written, 'position': position,
+        'done': done}
+    __state['admin'] = {a_type: sorted(values)
+                        for a_type, values in admin_objects.items()}
+
+    temp_filename = config.checkpoint_filename + '.tmp'
+    with open(temp_filename, 'w') as checkpoint_file:
+        json.dump(__state, checkpoint_file)
+    os.replace(temp_filename, config.checkpoint_filename)
+
+def finish():
+    """Removes the checkpoint file once the capture has completed
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __state # pylint: disable=global-statement
+    __state = None
+    if os.path.exists(config.checkpoint_filename):
+        os.remove(config.checkpoint_filename)
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
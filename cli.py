@@ -4,49 +4,142 @@
    http://google.github.io/styleguide/pyguide.htm
 """
 
+import os
 import sys
 import json
 import argparse
+import functools
 import getpass
 from datetime import datetime
 
 from requests import auth
 
 import config
+import checkpoint
 import common_logger
+import daemon
 import processor
+import async_processor
+import instances
+import json_codec
+import writers
 
 
+def _engine():
+    """Returns the capture engine module selected by the config object"""
+    if config.engine == 'async':
+        return async_processor
+    return processor
+
 def process_sites(args):
     """Called when command line specifies Sites"""
     common_logger.get_logger().debug('Processing Sites only')
-    processor.process(['sites'])
+    _engine().process(['sites'])
     return
 
 def process_users(args):
     """Called when command line specifies Users"""
     common_logger.get_logger().debug('Processing Users only')
-    processor.process(['users'])
+    _engine().process(['users'])
     return
 
 def process_devices(args):
     """Called when command line specifies Devices"""
     common_logger.get_logger().debug('Processing Devices only')
-    processor.process(['devices'])
+    _engine().process(['devices'])
     return
 
 def process_groups(args):
     """Called when command line specifies Groups"""
     common_logger.get_logger().debug('Processing Groups only')
-    processor.process(['groups'])
+    _engine().process(['groups'])
     return
 
 def process_all(args):
     """Called when command line specifies all operations"""
     common_logger.get_logger().debug('Processing Sites, Users, Devices, and Groups')
-    processor.process(['sites','users','devices','groups'])
+    _engine().process(['sites','users','devices','groups'])
+    return
+
+def process_instances(args):
+    """Called when command line specifies --instances"""
+    result = instances.capture(args.instances,
+                               functools.partial(_capture_instance, args.prog_doc),
+                               config.total_requests)
+    if result != 0:
+        sys.exit(result)
+    return
+
+def process_daemon(args):
+    """Called when command line specifies --daemon"""
+    daemon.run(functools.partial(args.command_func, args), _set_filenames)
     return
 
+def _capture_instance(prog_doc: str, settings: dict):
+    """Captures one instance of --instances, in the instance's own process"""
+    args = process_command_line(prog_doc=prog_doc, instance=settings)
+    try:
+        args.func(args)
+    except processor.CaptureIncomplete:
+        sys.exit(config.ERR_CAPTURE_INCOMPLETE_CODE)
+
+# The stages of the capture pipeline, see processor._run_pipeline
+PIPELINE_STAGES = ['fetch', 'enrich', 'encode']
+
+def _stage_workers(text: str) -> dict:
+    """Parses the --stage-workers argument, e.g. 'fetch=8,enrich=4'"""
+    stage_workers = {}
+    for part in text.split(','):
+        stage, _, workers = part.partition('=')
+        stage_workers[stage.strip()] = int(workers)
+    return stage_workers
+
+def _set_filenames():
+    """Names the output files of a capture from config.time_str"""
+    config.sites_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.sites.' + config.time_str +
+        writers.FORMAT_EXTENSIONS[config.output_format] +
+        writers.EXTENSIONS[config.compression])
+    config.users_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.users.' + config.time_str +
+        writers.FORMAT_EXTENSIONS[config.output_format] +
+        writers.EXTENSIONS[config.compression])
+    config.devices_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.devices.' + config.time_str +
+        writers.FORMAT_EXTENSIONS[config.output_format] +
+        writers.EXTENSIONS[config.compression])
+    config.groups_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.groups.' + config.time_str +
+        writers.FORMAT_EXTENSIONS[config.output_format] +
+        writers.EXTENSIONS[config.compression])
+    config.admin_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.admin.' + config.time_str + '.json' +
+        writers.EXTENSIONS[config.compression])
+    config.metrics_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.metrics.' + config.time_str + '.json')
+    config.fingerprints_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.fingerprints.' + config.time_str + '.json')
+    config.changes_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.changes.' + config.time_str + '.json')
+    if config.sqlite:
+        config.sqlite_filename = (
+            config.out_directory + config.dir_sep + config.base_name + '.' +
+            config.instance_type + '.' + config.time_str + '.sqlite')
+    config.profile_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.profile.' + config.time_str + '.json')
+    config.stacks_filename = (
+        config.out_directory + config.dir_sep + config.base_name + '.' +
+        config.instance_type + '.profile.' + config.time_str + '.folded')
+
 class _CLIError(Exception):
     """Generic exception to raise and log different fatal errors."""
     def __init__(self, msg, rc=config.ERR_CLI_EXCEPTION):
@@ -60,6 +153,44 @@ class _CLIError(Exception):
     def __unicode__(self):
         return self.msg
 
+def _instances_command_line(args, cfg: dict, prog_doc: str):
+    """Validates --instances, and sets up the capture of every instance
+
+    Args:
+        args (Namespace): The parsed command line
+        cfg (dict): The defaults file
+        prog_doc (str): The program's docstring, for each instance
+
+    Returns:
+        Namespace: args, with the Instance of each instance
+    """
+    if config.total_requests is None and 'totalRequests' in cfg:
+        config.total_requests = cfg['totalRequests']
+    if config.total_requests is not None and config.total_requests < 1:
+        raise ValueError('Total requests must be 1 or more')
+    if not os.path.exists(config.instances_filename):
+        raise(_CLIError(
+            config.ERR_CLI_MISSING_INSTANCES_MSG % config.instances_filename,
+            config.ERR_CLI_MISSING_INSTANCES_CODE))
+    args.instances = instances.load(config.instances_filename)
+
+    # Instances that would write the same files would overwrite each other
+    outputs = {}
+    for instance in args.instances:
+        settings = dict(cfg, **instance.settings)
+        output = (config.out_directory or settings.get('outDirectory'),
+                  config.base_name or settings.get('baseName'),
+                  config.instance_type or settings.get('instance', 'np'))
+        if output in outputs:
+            raise ValueError('Instances %s and %s would write the same files, '
+                             'give them a different baseName or outDirectory'
+                             % (outputs[output], instance.name))
+        outputs[output] = instance.name
+
+    args.prog_doc = prog_doc
+    args.func = process_instances
+    return args
+
 class __Password(argparse.Action):
     """Container to get and/or hold incoming password"""
     def __call__(self, parser, namespace, values, option_string): # pylint: disable=signature-differs
@@ -67,8 +198,15 @@ class __Password(argparse.Action):
             values = getpass.getpass()
         setattr(namespace, self.dest, values)
 
-def process_command_line(argv=None, prog_doc=''): # pylint: disable=too-many-branches,too-many-statements
-    """Evaluates and responds to passed in command line arguments"""
+def process_command_line(argv=None, prog_doc='', instance=None): # pylint: disable=too-many-branches,too-many-statements
+    """Evaluates and responds to passed in command line arguments
+
+    Args:
+        argv (list): Arguments to add to the command line
+        prog_doc (str): The program's docstring, for the help
+        instance (dict): The settings of an instance from --instances, when
+            capturing that instance
+    """
     llogger = None
 
     if argv is None:
@@ -100,6 +238,14 @@ USAGE
             formatter_class=argparse.RawDescriptionHelpFormatter)
         subparsers = parser.add_subparsers(dest='command_name')
         # Add common arguments
+        parser.add_argument("-B", "--bulk-users", dest="bulk_users",
+                            action='store_true', default=None,
+                            help=(
+                                "If specified, Roles and Supervisors are "
+                                "requested with the list of Users instead of "
+                                "once per User. A User is only requested on "
+                                "its own when the list's Roles or Supervisors "
+                                "are truncated."))
         parser.add_argument("-b", "--basename", dest="base_name",
                             default=None,
                             help=(
@@ -113,11 +259,76 @@ USAGE
                                 "If specified, will echo all log output to "
                                 "the console at the requested verbosity based "
                                 "on the -v option"))
+        parser.add_argument("--codec", dest="codec",
+                            default=None,
+                            choices=json_codec.BACKENDS,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--codec to choose the JSON library. Both "
+                                "write the same output, 'orjson' is faster "
+                                "and requires the orjson module. [default: "
+                                "orjson if it is installed, else json]"))
+        parser.add_argument("--daemon", dest="daemon_interval",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--daemon to keep running and capture again "
+                                "every so many seconds, reusing the "
+                                "connections and caches, until stopped with "
+                                "SIGTERM or Ctrl-C. [default: capture once]"))
+        parser.add_argument("-D", "--bulk-devices", dest="bulk_devices",
+                            action='store_true', default=None,
+                            help=(
+                                "If specified, Devices are requested from "
+                                "the instance wide list of Devices and "
+                                "matched to their owners, instead of being "
+                                "requested once per User."))
         parser.add_argument("-d", "--defaults", dest="defaults_filename",
                             default="defaults.json",
                             help=(
                                 "Specifes the name of the file containing "
                                 "default settings [default: %(default)s]"))
+        parser.add_argument("-e", "--engine", dest="engine",
+                            default=None,
+                            choices=['threads', 'async'],
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "-e to choose the capture engine. 'async' "
+                                "keeps many requests in flight from a single "
+                                "thread and requires the aiohttp module. "
+                                "[default: threads]"))
+        parser.add_argument("-f", "--format", dest="output_format",
+                            default=None,
+                            choices=list(writers.FORMAT_EXTENSIONS),
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "-f to choose the record format of the Sites, "
+                                "Users, and Groups files. 'ndjson' writes one "
+                                "JSON record per line so the files can be "
+                                "streamed. [default: json]"))
+        parser.add_argument("-I", "--incremental", dest="incremental",
+                            action='store_true', default=None,
+                            help=(
+                                "If specified, Users and Groups whose entry "
+                                "in the people or groups list is unchanged "
+                                "since the previous snapshot are copied "
+                                "forward from it instead of being requested "
+                                "again, and deleted ones are reported."))
+        parser.add_argument("--index", dest="index",
+                            action='store_true', default=None,
+                            help=(
+                                "If specified, an index file is written next "
+                                "to each Sites, Users, and Groups file, so "
+                                "single records can be looked up by id or "
+                                "targetName with snapshot_index.py."))
+        parser.add_argument("--instances", dest="instances_filename",
+                            default=None,
+                            help=(
+                                "If specified, capture every instance listed "
+                                "in this JSON file at once, each in its own "
+                                "process. Each entry holds defaults file keys "
+                                "that override the defaults file for that "
+                                "instance."))
         parser.add_argument("-i", "--itype", dest="instance_type",
                             default=None,
                             choices=['np', 'prod'],
@@ -133,6 +344,13 @@ USAGE
                                 "-l to specify the base name of the log file. "
                                 "The name will have a timestamp and .log "
                                 "appended to the end."))
+        parser.add_argument("-m", "--max-requests", dest="max_requests",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "-m to specify the maximum number of "
+                                "requests in flight when using the async "
+                                "engine. [default: %d]" % config.max_requests))
         parser.add_argument("-o", "--odir", dest="out_directory",
                             default=None,
                             help=(
@@ -145,12 +363,133 @@ USAGE
                                   "If not specified in the defaults file, use -p"
                                   " to specify a password either on the command"
                                   " line, or be prompted"))
+        parser.add_argument("--pipeline-depth", dest="pipeline_depth",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--pipeline-depth to specify the most Users "
+                                "or Groups held between listing and writing "
+                                "at once, which bounds the memory used. "
+                                "[default: twice the page size]"))
+        parser.add_argument("--profile", dest="profile",
+                            action='store_true',
+                            help=(
+                                "If specified, records the wall and CPU time "
+                                "of each phase and the time spent on the "
+                                "network, JSON, and logging, and saves them "
+                                "to the output directory."))
+        parser.add_argument("--profile-stacks", dest="profile_stacks",
+                            action='store_true',
+                            help=(
+                                "If specified, profiles as with --profile and "
+                                "also samples the thread stacks, saving them "
+                                "in the folded format used by flame graph "
+                                "tools."))
+        parser.add_argument("--rate-limit", dest="rate_limit",
+                            default=None, type=float,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--rate-limit to specify the most requests "
+                                "per second sent to the instance. The rate "
+                                "is lowered automatically when xMatters "
+                                "throttles requests. [default: no limit]"))
+        parser.add_argument("--record", dest="record_filename",
+                            default=None, metavar="ARCHIVE",
+                            help=(
+                                "If specified, records every response from "
+                                "the instance to this gzip compressed archive, "
+                                "so the capture can be replayed with "
+                                "--replay."))
+        parser.add_argument("--replay", dest="replay_filename",
+                            default=None, metavar="ARCHIVE",
+                            help=(
+                                "If specified, answers every request from "
+                                "this archive made by --record instead of the "
+                                "instance, at full speed. Use the options of "
+                                "the recorded capture."))
+        parser.add_argument("--replay-latency", dest="replay_latency",
+                            action='store_true',
+                            help=(
+                                "If specified with --replay, each response "
+                                "takes as long as it did when recorded."))
+        parser.add_argument("--retries", dest="max_retries",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--retries to specify how many times a "
+                                "throttled, 5xx, or failed request is retried "
+                                "with backoff. [default: %d]" % config.max_retries))
+        parser.add_argument("-r", "--resume", dest="resume",
+                            action='store_true',
+                            help=(
+                                "If specified, continues the interrupted "
+                                "capture recorded in the checkpoint file, "
+                                "appending to its output files."))
+        parser.add_argument("--shard-records", dest="shard_records",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--shard-records to split the Users and "
+                                "Groups files into shards of this many "
+                                "records, listed in a manifest."))
+        parser.add_argument("--shards", dest="shards",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--shards to split the Users and Groups "
+                                "files into this many shards by a hash of "
+                                "their targetName, listed in a manifest, and "
+                                "written in parallel. [default: 1, i.e. not "
+                                "sharded]"))
+        parser.add_argument("--site-cache-ttl", dest="site_cache_ttl",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--site-cache-ttl to specify how many seconds "
+                                "the Site names saved by an earlier capture "
+                                "are reused for, or 0 to not save them. "
+                                "[default: 86400]"))
+        parser.add_argument("--sqlite", dest="sqlite",
+                            action='store_true', default=None,
+                            help=(
+                                "If specified, the Sites, Users (with their "
+                                "Roles, Supervisors, Devices, and "
+                                "Timeframes), Groups (with their Shifts), and "
+                                "admin sets are also exported to an indexed "
+                                "SQLite database."))
+        parser.add_argument("--stage-workers", dest="stage_workers",
+                            default=None, type=_stage_workers,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--stage-workers to set the workers of each "
+                                "capture stage, e.g. 'fetch=8,enrich=4,"
+                                "encode=1'. The fetch stage gets each User "
+                                "or Group, enrich gets their Devices or "
+                                "Shifts, and encode turns them into JSON. "
+                                "[default: fetch and enrich use the number "
+                                "of workers, encode uses 1]"))
+        parser.add_argument("--status-port", dest="status_port",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--status-port to serve the status of a "
+                                "--daemon at http://127.0.0.1:PORT/status "
+                                "and /health. [default: status file only]"))
         parser.add_argument("-u", "--user", dest="user",
                             default=None,
                             help=("If not specified in the defaults file, use "
                                   "-u to specify the xmatters user id that has"
                                   " permissions to get Event and Notification "
                                   "data."))
+        parser.add_argument("-z", "--compress", dest="compression",
+                            default=None,
+                            choices=list(writers.EXTENSIONS),
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "-z to compress the output files. The "
+                                "compression runs on its own thread, and adds "
+                                "its extension (e.g. .gz) to the file names. "
+                                "[default: none]"))
         parser.add_argument("-V", "--version",
                           action='version', version=program_version_message)
         parser.add_argument("-v", dest="verbose",
@@ -162,6 +501,22 @@ USAGE
                                 "WARNING logging, a double v (-vv) means add "
                                 "INFO logging, and a tripple v (-vvv) means "
                                 "add DEBUG logging [default: %(default)s]"))
+        parser.add_argument("-w", "--workers", dest="workers",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "-w to specify the number of concurrent "
+                                "workers used to capture Users (with their "
+                                "Devices) and Groups (with their Shifts), and "
+                                "to request the pages of each list. "
+                                "[default: 1]"))
+        parser.add_argument("--total-requests", dest="total_requests",
+                            default=None, type=int,
+                            help=(
+                                "If not specified in the defaults file, use "
+                                "--total-requests to limit the requests in "
+                                "flight across every instance captured with "
+                                "--instances. [default: no shared limit]"))
         parser.add_argument("-x", "--xmodurl", dest="xmod_url",
                             default=None,
                             help=("If not specified in the defaults file, use "
@@ -199,20 +554,76 @@ USAGE
         password = None
         if args.base_name:
             config.base_name = args.base_name
+        if args.bulk_users:
+            config.bulk_users = args.bulk_users
+        if args.bulk_devices:
+            config.bulk_devices = args.bulk_devices
+        if args.daemon_interval is not None:
+            config.daemon_interval = args.daemon_interval
+        if args.output_format:
+            config.output_format = args.output_format
+        if args.codec:
+            config.codec = args.codec
+        if args.compression:
+            config.compression = args.compression
+        if args.engine:
+            config.engine = args.engine
+        if args.incremental:
+            config.incremental = args.incremental
+        if args.index:
+            config.index = args.index
         if args.instance_type:
             config.instance_type = args.instance_type
+        if args.instances_filename:
+            config.instances_filename = args.instances_filename
         if args.log_filename:
             config.log_filename = args.log_filename
         if args.out_directory:
             config.out_directory = args.out_directory
+        if args.max_requests is not None:
+            config.max_requests = args.max_requests
         if args.noisy > 0:
             config.noisy = args.noisy
         if args.password:
             password = args.password
+        if args.pipeline_depth is not None:
+            config.pipeline_depth = args.pipeline_depth
+        if args.profile:
+            config.profile = args.profile
+        if args.profile_stacks:
+            config.profile = config.profile_stacks = args.profile_stacks
+        if args.rate_limit is not None:
+            config.rate_limit = args.rate_limit
+        if args.max_retries is not None:
+            config.max_retries = args.max_retries
+        if args.record_filename:
+            config.record_filename = args.record_filename
+        if args.replay_filename:
+            config.replay_filename = args.replay_filename
+        if args.replay_latency:
+            config.replay_latency = args.replay_latency
+        if args.resume:
+            config.resume = args.resume
+        if args.shard_records is not None:
+            config.shard_records = args.shard_records
+        if args.shards is not None:
+            config.shards = args.shards
+        if args.site_cache_ttl is not None:
+            config.site_cache_ttl = args.site_cache_ttl
+        if args.sqlite:
+            config.sqlite = args.sqlite
+        if args.stage_workers:
+            config.stage_workers = args.stage_workers
+        if args.status_port is not None:
+            config.status_port = args.status_port
+        if args.total_requests is not None:
+            config.total_requests = args.total_requests
         if args.user:
             user = args.user
         if args.verbose > 0:
             config.verbosity = args.verbose
+        if args.workers is not None:
+            config.workers = args.workers
         if args.xmod_url:
             config.xmod_url = args.xmod_url
 
@@ -225,6 +636,13 @@ USAGE
                 config.ERR_CLI_MISSING_DEFAULTS_MSG % args.defaults_filename,
                 config.ERR_CLI_MISSING_DEFAULTS_CODE))
 
+        # An instance captured with --instances overrides the defaults file,
+        # otherwise this process only starts the capture of each instance
+        if instance is not None:
+            cfg.update(instance)
+        elif config.instances_filename:
+            return _instances_command_line(args, cfg, prog_doc)
+
         # Process the defaults
         if user is None and 'user' in cfg:
             user = cfg['user']
@@ -245,6 +663,46 @@ USAGE
                 config.verbosity = cfg['verbosity']
         if config.instance_type is None and 'instance' in cfg:
             config.instance_type = cfg['instance']
+        if config.workers is None and 'workers' in cfg:
+            config.workers = cfg['workers']
+        if config.stage_workers is None and 'stageWorkers' in cfg:
+            config.stage_workers = cfg['stageWorkers']
+        if config.pipeline_depth is None and 'pipelineDepth' in cfg:
+            config.pipeline_depth = cfg['pipelineDepth']
+        if config.bulk_users is None and 'bulkUsers' in cfg:
+            config.bulk_users = cfg['bulkUsers']
+        if config.bulk_devices is None and 'bulkDevices' in cfg:
+            config.bulk_devices = cfg['bulkDevices']
+        if config.incremental is None and 'incremental' in cfg:
+            config.incremental = cfg['incremental']
+        if config.index is None and 'index' in cfg:
+            config.index = cfg['index']
+        if config.sqlite is None and 'sqlite' in cfg:
+            config.sqlite = cfg['sqlite']
+        if config.daemon_interval is None and 'daemonInterval' in cfg:
+            config.daemon_interval = cfg['daemonInterval']
+        if config.status_port is None and 'statusPort' in cfg:
+            config.status_port = cfg['statusPort']
+        if config.site_cache_ttl is None and 'siteCacheTTL' in cfg:
+            config.site_cache_ttl = cfg['siteCacheTTL']
+        if args.rate_limit is None and 'rateLimit' in cfg:
+            config.rate_limit = cfg['rateLimit']
+        if args.max_retries is None and 'maxRetries' in cfg:
+            config.max_retries = cfg['maxRetries']
+        if config.output_format is None and 'format' in cfg:
+            config.output_format = cfg['format']
+        if config.compression is None and 'compression' in cfg:
+            config.compression = cfg['compression']
+        # Either sharding option on the command line overrides both defaults
+        if args.shards is None and args.shard_records is None:
+            config.shards = cfg.get('shards')
+            config.shard_records = cfg.get('shardRecords')
+        if config.engine is None and 'engine' in cfg:
+            config.engine = cfg['engine']
+        if config.codec is None and 'codec' in cfg:
+            config.codec = cfg['codec']
+        if args.max_requests is None and 'maxRequests' in cfg:
+            config.max_requests = cfg['maxRequests']
 
         # Validate and default instance type to non production
         if config.instance_type is None:
@@ -252,30 +710,132 @@ USAGE
         if config.instance_type not in ['prod', 'np']:
             raise ValueError('Input must be either "prod" or "np"')
 
+        # Validate and default the number of workers to a single worker
+        if config.workers is None:
+            config.workers = 1
+        if config.workers < 1:
+            raise ValueError('Workers must be 1 or more')
+
+        # Validate and default the workers of each stage from the workers
+        stage_workers = {'fetch': config.workers, 'enrich': config.workers,
+                         'encode': 1}
+        for stage, workers in (config.stage_workers or {}).items():
+            if stage not in PIPELINE_STAGES:
+                raise ValueError('Stages must be one of: ' + ', '.join(PIPELINE_STAGES))
+            if workers < 1:
+                raise ValueError('Stage workers must be 1 or more')
+            stage_workers[stage] = workers
+        config.stage_workers = stage_workers
+        if config.pipeline_depth is None:
+            config.pipeline_depth = 2 * config.page_size
+        if config.pipeline_depth < 1:
+            raise ValueError('Pipeline depth must be 1 or more')
+
+        # Validate and default the record format to a JSON array
+        if config.output_format is None:
+            config.output_format = 'json'
+        if config.output_format not in writers.FORMAT_EXTENSIONS:
+            raise ValueError('Format must be one of: ' +
+                             ', '.join(writers.FORMAT_EXTENSIONS))
+
+        # Validate and default the compression to none
+        if config.compression is None:
+            config.compression = 'none'
+        if config.compression not in writers.EXTENSIONS:
+            raise ValueError('Compression must be one of: ' +
+                             ', '.join(writers.EXTENSIONS))
+
+        # Validate the sharding, 1 shard means the files are not sharded
+        if config.shards is not None and config.shards < 1:
+            raise ValueError('Shards must be 1 or more')
+        if config.shard_records is not None and config.shard_records < 1:
+            raise ValueError('Shard records must be 1 or more')
+        if config.shards == 1:
+            config.shards = None
+        if config.shards and config.shard_records:
+            raise ValueError('Shards and shard records cannot be used together')
+
+        # Validate and default the JSON codec to the fastest one installed
+        if config.codec is None:
+            config.codec = json_codec.DEFAULT_BACKEND
+        if config.codec not in json_codec.BACKENDS:
+            raise ValueError('Codec must be one of: ' + ', '.join(json_codec.BACKENDS))
+        if config.codec == 'orjson' and json_codec.orjson is None:
+            raise(_CLIError(config.ERR_CLI_MISSING_ORJSON_MSG,
+                            config.ERR_CLI_MISSING_ORJSON_CODE))
+
+        # Validate and default the capture engine to threads
+        if config.engine is None:
+            config.engine = 'threads'
+        if config.engine not in ['threads', 'async']:
+            raise ValueError('Engine must be either "threads" or "async"')
+        if config.engine == 'async' and async_processor.aiohttp is None:
+            raise(_CLIError(config.ERR_CLI_MISSING_AIOHTTP_MSG,
+                            config.ERR_CLI_MISSING_AIOHTTP_CODE))
+        if config.max_requests < 1:
+            raise ValueError('Max requests must be 1 or more')
+        if config.rate_limit is not None and config.rate_limit <= 0:
+            raise ValueError('Rate limit must be more than 0')
+        if config.max_retries < 0:
+            raise ValueError('Retries must be 0 or more')
+        if config.site_cache_ttl is None:
+            config.site_cache_ttl = 86400
+        if config.site_cache_ttl < 0:
+            raise ValueError('Site cache TTL must be 0 or more')
+        if config.record_filename and config.replay_filename:
+            raise ValueError('Record and replay cannot be used together')
+        if config.replay_filename and not os.path.exists(config.replay_filename):
+            raise(_CLIError(
+                config.ERR_CLI_MISSING_ARCHIVE_MSG % config.replay_filename,
+                config.ERR_CLI_MISSING_ARCHIVE_CODE))
+        if config.resume and config.engine == 'async':
+            raise ValueError('Resume is only available with the threads engine')
+        if config.incremental and config.engine == 'async':
+            raise ValueError('Incremental is only available with the threads engine')
+        if config.daemon_interval is not None:
+            if config.daemon_interval < daemon.MIN_INTERVAL:
+                raise ValueError('The daemon interval must be %d seconds or more'
+                                 % daemon.MIN_INTERVAL)
+            if config.engine == 'async':
+                raise ValueError('The daemon is only available with the threads engine')
+            if config.record_filename or config.replay_filename:
+                raise ValueError('Record and replay cannot be used with the daemon')
+        if config.status_port is not None and not 0 <= config.status_port < 65536:
+            raise ValueError('The status port must be from 0 to 65535')
+
         config.non_prod = True if config.instance_type == 'np' else False
         config.command_name = args.command_name
 
+        # The Site cache is shared by every capture of the instance
+        config.site_cache_filename = (
+            config.out_directory + config.dir_sep + config.base_name + '.' +
+            config.instance_type + '.site-cache.json')
+
+        # A daemon keeps its status in the same file across captures
+        config.status_filename = (
+            config.out_directory + config.dir_sep + config.base_name + '.' +
+            config.instance_type + '.status.json')
+
+        # Pick up the time stamp of the interrupted capture, so the same
+        # output files are appended to
+        config.checkpoint_filename = (
+            config.out_directory + config.dir_sep + config.base_name + '.' +
+            config.instance_type + '.checkpoint.json')
+        if config.resume:
+            progress = checkpoint.load()
+            if progress is None:
+                raise(_CLIError(
+                    config.ERR_CLI_MISSING_CHECKPOINT_MSG % config.checkpoint_filename,
+                    config.ERR_CLI_MISSING_CHECKPOINT_CODE))
+            config.time_str = progress['timeStr']
+
         # Fix file names
         if config.log_filename:
             config.log_filename = (
                 config.out_directory + config.dir_sep + config.base_name +
                 '.' + config.instance_type + '.' + config.log_filename +
                 '.' + config.time_str + '.log')
-        config.sites_filename = (
-            config.out_directory + config.dir_sep + config.base_name + '.' +
-            config.instance_type + '.sites.' + config.time_str + '.json')
-        config.users_filename = (
-            config.out_directory + config.dir_sep + config.base_name + '.' +
-            config.instance_type + '.users.' + config.time_str + '.json')
-        config.devices_filename = (
-            config.out_directory + config.dir_sep + config.base_name + '.' +
-            config.instance_type + '.devices.' + config.time_str + '.json')
-        config.groups_filename = (
-            config.out_directory + config.dir_sep + config.base_name + '.' +
-            config.instance_type + '.groups.' + config.time_str + '.json')
-        config.admin_filename = (
-            config.out_directory + config.dir_sep + config.base_name + '.' +
-            config.instance_type + '.admin.' + config.time_str + '.json')
+        _set_filenames()
 
         # Initialize logging
         llogger = common_logger.get_logger()
@@ -322,6 +882,8 @@ USAGE
         # Make sure we have a func None == all
         if args.func is None:
             args.func = process_all
+        if config.daemon_interval is not None:
+            args.command_func, args.func = args.func, process_daemon
 
         return args
 
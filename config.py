@@ -22,7 +22,6 @@ LICENSE_REF = 'http://www.apache.org/licenses/LICENSE-2.0'
 # Global Constants
 DEBUG = 0
 TESTRUN = 0
-PROFILE = 0
 
 """ Global Variables
     Defaults are set from configuration file via processArgs()
@@ -30,6 +29,68 @@ PROFILE = 0
 program_name = os.path.basename(sys.argv[0])
 time_str = time.strftime("%Y%m%d-%H%M")
 page_size = 1000
+# Number of concurrent workers used to capture Users and Groups
+workers = None
+# Workers of each capture pipeline stage ('fetch', 'enrich', 'encode'),
+# and the most Users or Groups held in the pipeline at once
+stage_workers = None
+pipeline_depth = None
+# If True, get Roles and Supervisors from the people list instead of per User
+bulk_users = None
+# If True, get Devices from the instance wide list instead of per User
+bulk_devices = None
+# If True, copy unchanged Users and Groups forward from the previous snapshot
+incremental = None
+# Seconds a saved Site cache may be reused for, 0 means it is not saved
+site_cache_ttl = None
+site_cache_filename = None
+# If True, continue the interrupted capture recorded in the checkpoint file
+resume = False
+checkpoint_filename = None
+# Record format for the sites, users, and groups files: 'json' or 'ndjson'
+output_format = None
+# Compression for the output files: 'none', 'gzip', 'bz2', or 'xz'
+compression = None
+# Split the users and groups files into this many shards by targetName, or
+# into shards of this many records, see shards.py
+shards = None
+shard_records = None
+# If True, write an index next to each record file, see snapshot_index.py
+index = None
+# If True, also export the records to a SQLite database, see sqlite_export.py
+sqlite = None
+# JSON library to use, either 'orjson' or 'json'
+codec = None
+# Capture engine to use, either 'threads' (processor) or 'async' (async_processor)
+engine = None
+# If True, profile the capture, and also sample the thread stacks
+profile = False
+profile_stacks = False
+# Maximum number of requests in flight when using the async engine
+max_requests = 100
+# File listing the instances to capture concurrently, and the most requests
+# in flight across all of them, None means no shared limit, see instances.py
+instances_filename = None
+total_requests = None
+# Seconds between the captures of a daemon, None captures once, and the
+# local port its status is served on, see daemon.py
+daemon_interval = None
+status_port = None
+# Most requests per second to send to the instance, None means no limit
+rate_limit = None
+# Times a throttled, 5xx, or failed request is retried, and the backoff
+# in seconds before the first retry and the longest backoff
+max_retries = 5
+backoff_base = 0.5
+backoff_cap = 60
+# Archive to record every response to, or to replay the responses from
+# instead of sending requests, and if True, replay with the recorded latency
+record_filename = None
+replay_filename = None
+replay_latency = False
+# Seconds to wait when connecting to, and reading from, the xMatters instance
+connect_timeout = 10
+read_timeout = 120
 xmod_url = None
 out_directory = None
 properties_filename = None
@@ -48,6 +109,19 @@ groups_filename = None
 company_admin_role = 'Company Admin'
 # Holds admin info: company_admins, roles, timezones, country, language
 admin_filename = None
+# Holds the request metrics and phase timings of the run
+metrics_filename = None
+# Hold the list fingerprints of the capture, and the changes found by an
+# incremental capture
+fingerprints_filename = None
+changes_filename = None
+# Holds the SQLite export
+sqlite_filename = None
+# Holds the status of a daemon
+status_filename = None
+# Hold the profile and the sampled stacks when profiling
+profile_filename = None
+stacks_filename = None
 
 # Error codes
 ERR_CLI_EXCEPTION = -1
@@ -81,6 +155,22 @@ ERR_REQUEST_NEXT_EXCEPTION_CODE = -11
 ERR_INITIAL_REQUEST_FAILED_CODE = -12
 ERR_INITIAL_REQUEST_FAILED_MSG = ("Error %d on initial request to %s.\nPlease "
                                   "verify instance address, user, and password")
+ERR_CLI_MISSING_AIOHTTP_CODE = -13
+ERR_CLI_MISSING_AIOHTTP_MSG = ("The async engine requires the aiohttp module. "
+                               "Install it with 'pip install aiohttp'")
+ERR_CLI_MISSING_CHECKPOINT_CODE = -14
+ERR_CLI_MISSING_CHECKPOINT_MSG = ("There is no interrupted capture to resume, "
+                                  "missing checkpoint file: %s")
+ERR_CLI_MISSING_ARCHIVE_CODE = -15
+ERR_CLI_MISSING_ARCHIVE_MSG = "Missing archive to replay: %s"
+ERR_CLI_MISSING_ORJSON_CODE = -16
+ERR_CLI_MISSING_ORJSON_MSG = ("The orjson codec requires the orjson module. "
+                              "Install it with 'pip install orjson'")
+ERR_CLI_MISSING_INSTANCES_CODE = -17
+ERR_CLI_MISSING_INSTANCES_MSG = "Missing instances file: %s"
+ERR_CAPTURE_INCOMPLETE_CODE = -18
+ERR_CAPTURE_INCOMPLETE_MSG = ("The capture is incomplete, some of the %s could "
+                              "not be captured, see the log for the errors")
 
 def main():
     """ To pass conventions, in case we need to execute main """
@@ -0,0 +1,244 @@
+"""Captures an instance on a schedule from one long running process.
+
+    With --daemon SECONDS, the capture does not exit once it is done, but
+    captures again every SECONDS, counted from the start of the previous
+    capture (starts missed while a capture overran are skipped), until it
+    is stopped with SIGTERM or Ctrl-C.  The capture under way is finished
+    first, a second signal stops at once.
+
+    Each capture has its own time stamp and output files, as if it had
+    been run on its own, but the process keeps what a new process would
+    build again between captures:
+
+        * the shared session (see xm_session), so its kept-alive
+          connections and the pacing learned from throttling carry over
+        * the Site names (see site_cache), while within --site-cache-ttl
+        * the fingerprints of the last complete snapshot (see incremental),
+          so an incremental capture (-I) does not read the previous
+          fingerprints file again
+
+    How the daemon is doing is written to a status file next to the output
+    files (e.g. my-instance.np.status.json) whenever it starts or finishes
+    a capture.  A capture failed if it raised, or logged any errors (e.g.
+    requests that still failed after their retries).  A capture that
+    raised is torn down as one that finished is (see processor.process),
+    so its workers, output files, and profile do not carry over.
+
+    With --status-port, the status is also served on the local host:
+    /status answers the same JSON, and /health answers 200 while the last
+    capture succeeded and 503 once it failed, for a service manager or
+    monitor to poll.
+
+    Attributes:
+        __status (dict): The daemon's state, runs, and last run
+        __stop (Event): Set once the daemon has been asked to stop
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+import config
+import common_logger
+import metrics
+import xm_session
+
+# Shortest interval between captures, since output files are named by minute
+MIN_INTERVAL = 60
+
+__lock = threading.Lock()
+__status = {}
+__stop = threading.Event()
+
+def _now() -> str:
+    """Returns the local time as an ISO 8601 string, for the status"""
+    return datetime.now().astimezone().isoformat(timespec='seconds')
+
+def status() -> dict:
+    """Returns a copy of the daemon's status
+
+    Args:
+
+    Returns:
+        dict: The status, as written to the status file
+    """
+    with __lock:
+        return json.loads(json.dumps(__status))
+
+def healthy() -> bool:
+    """Returns True unless the last capture failed"""
+    with __lock:
+        return __status.get('consecutiveFailures', 0) == 0
+
+def _update(**changes):
+    """Updates the status, and writes it to the status file"""
+    with __lock:
+        __status.update(changes)
+        contents = json.dumps(__status, indent=2)
+    temp_filename = config.status_filename + '.tmp'
+    with open(temp_filename, 'w') as status_file:
+        status_file.write(contents)
+    os.replace(temp_filename, config.status_filename)
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answers the status and health requests"""
+    def do_GET(self): # pylint: disable=invalid-name
+        """Answers a GET of /status or /health"""
+        if self.path == '/status':
+            code, body = 200, status()
+        elif self.path == '/health':
+            code = 200 if healthy() else 503
+            body = {'healthy': code == 200}
+        else:
+            code, body = 404, {'message': 'Not found, try /status or /health'}
+        payload = json.dumps(body, indent=2).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """Keeps the request log quiet"""
+        pass
+
+def _serve(port: int) -> ThreadingHTTPServer:
+    """Starts serving the status on the local host from a background thread"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='status',
+                              daemon=True)
+    thread.start()
+    common_logger.get_logger().info(
+        'Serving the status at http://127.0.0.1:%d/status', server.server_port)
+    return server
+
+class _ErrorCounter(logging.Handler):
+    """Counts the errors logged during a capture"""
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+def _signalled(signum, frame): # pylint: disable=unused-argument
+    """Stops after the capture under way, or at once if already stopping"""
+    if __stop.is_set():
+        raise KeyboardInterrupt
+    __stop.set()
+    common_logger.get_logger().warning(
+        'Stopping once any capture under way is done, signal again to stop now.')
+
+def _capture_once(capture):
+    """Runs a capture, and records how it went in the status"""
+    logger = common_logger.get_logger()
+    started = time.monotonic()
+    _update(state='capturing', current={'timeStr': config.time_str, 'started': _now()})
+    errors = _ErrorCounter()
+    logger.addHandler(errors)
+    error = None
+    try:
+        capture()
+    except Exception as exc: # pylint: disable=broad-except
+        logger.exception('The %s capture failed.', config.time_str)
+        error = repr(exc)
+    finally:
+        logger.removeHandler(errors)
+    if error is None and errors.count:
+        error = '%d errors were logged' % errors.count
+    summary = metrics.summary()
+    with __lock:
+        runs = __status['runs'] + 1
+        failures = __status['failures'] + (error is not None)
+        consecutive = 0 if error is None else __status['consecutiveFailures'] + 1
+        last_success = config.time_str if error is None else __status['lastSuccess']
+    _update(runs=runs, failures=failures, consecutiveFailures=consecutive,
+            lastSuccess=last_success, current=None, lastRun={
+                'timeStr': config.time_str,
+                'finished': _now(),
+                'seconds': round(time.monotonic() - started, 3),
+                'succeeded': error is None,
+                'error': error,
+                'errors': errors.count,
+                'requests': summary['requests'],
+                'records': {name: phase['records']
+                            for name, phase in summary['phases'].items()}})
+    logger.info('The %s capture %s in %.1f seconds.', config.time_str,
+                'failed' if error else 'finished', time.monotonic() - started)
+
+def run(capture, prepare):
+    """Captures every config.daemon_interval seconds until stopped
+
+    The first capture uses the time stamp and file names already set up,
+    e.g. to resume an interrupted capture, later ones get new ones.
+
+    Args:
+        capture (callable): Runs one capture
+        prepare (callable): Names the output files from config.time_str
+    """
+    logger = common_logger.get_logger()
+    interval = config.daemon_interval
+    __stop.clear()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, _signalled)
+    with __lock:
+        __status.clear()
+        __status.update({
+            'pid': os.getpid(), 'state': 'starting', 'command': config.command_name,
+            'started': _now(), 'interval': interval, 'runs': 0, 'failures': 0,
+            'consecutiveFailures': 0, 'lastSuccess': None, 'lastRun': None,
+            'current': None, 'nextRun': None})
+    server = _serve(config.status_port) if config.status_port is not None else None
+    logger.info('Capturing every %d seconds until stopped.', interval)
+
+    next_start = time.time()
+    try:
+        while True:
+            _capture_once(capture)
+
+            # Skip the starts that were missed while the capture ran over
+            next_start += interval
+            while next_start <= time.time():
+                next_start += interval
+            _update(state='waiting', nextRun=datetime.fromtimestamp(
+                next_start).astimezone().isoformat(timespec='seconds'))
+            if __stop.wait(next_start - time.time()):
+                break
+            # Each capture writes new files, with a new time stamp
+            while time.strftime('%Y%m%d-%H%M') == config.time_str:
+                if __stop.wait(1):
+                    break
+            if __stop.is_set():
+                break
+            config.resume = False
+            config.time_str = time.strftime('%Y%m%d-%H%M')
+            prepare()
+    except KeyboardInterrupt:
+        logger.warning('Stopped during the %s capture.', config.time_str)
+    finally:
+        _update(state='stopped', current=None, nextRun=None)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        xm_session.close()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_DFL if signum == signal.SIGTERM
+                          else signal.default_int_handler)
+    logger.info('Stopped after %d captures.', __status['runs'])
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
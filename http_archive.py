@@ -0,0 +1,247 @@
+"""Records the responses of a capture to an archive, and replays them.
+
+    With --record, every response from the xMatters instance (including
+    throttled, 5xx, and failed attempts) is written to a gzip compressed
+    archive of newline delimited JSON, one response per line, with the
+    time it took.
+
+    With --replay, no requests are sent.  Each request is answered from the
+    archive instead, so a capture can be rerun offline against real data,
+    e.g. to profile a change, reproduce a problem, or compare the output
+    files.  The responses to each request are replayed in the order they
+    were recorded, and the last one is repeated if the request is made
+    more often than it was recorded.  Replay runs at full speed, without
+    backing off or rate limiting, unless --replay-latency is given, in
+    which case each response takes as long as it did when recorded.
+
+    The archive is written a block at a time, each block its own gzip
+    member, with an index next to it (the archive's name plus .idx, see
+    writers.RecordIndex) of where each response is.  A replay reads each
+    response from its block when it is requested, rather than loading the
+    whole archive.  An archive without an index is indexed when it is
+    first replayed.
+
+    Requests are matched on their path and query parameters, in any order,
+    so an archive can be replayed against any xmodURL.  Replaying with
+    other options than the recording (e.g. -B, -D, or a fresh Site cache)
+    makes requests that are not in the archive, which fail as if the
+    instance could not be reached.
+
+    Attributes:
+        __archive (OutputFile): The archive being recorded, or None
+        __index (RecordIndex): The index of the archive being recorded
+        __replay (Index): The archive being replayed, or None
+        __replayed (dict): Responses replayed so far by request
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import atexit
+import os
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import config
+import common_logger
+import json_codec
+import snapshot_index
+import writers
+
+# Response headers kept in the archive, the rest are not used
+HEADERS = ['Content-Type', 'Retry-After']
+
+__lock = threading.Lock()
+__archive = None
+__index = None
+__replay = None
+__replayed = {}
+__registered = False
+
+def request_key(url: str) -> str:
+    """Returns the key a request is archived under
+
+    Args:
+        url (str): The requested location
+
+    Returns:
+        str: The path and the sorted query of url
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    return parts.path + '?' + urllib.parse.urlencode(query, safe=',')
+
+def _request_keys(entry: dict) -> tuple:
+    """Returns the key an archive entry is indexed by, see request_key"""
+    return (entry.get('url'),)
+
+def _open_replay(filename: str) -> snapshot_index.Index:
+    """Opens an archive for replay, indexing it first if need be
+
+    Args:
+        filename (str): Name of the archive
+
+    Returns:
+        Index: The archive, looked up by request key
+    """
+    if not os.path.exists(filename + writers.INDEX_EXTENSION):
+        index, members, _ = writers.index_records(filename, keys=_request_keys)
+        index.write(filename + writers.INDEX_EXTENSION, members)
+    return snapshot_index.Index(filename, keys=_request_keys)
+
+def begin():
+    """Starts recording to config.record_filename, or loads config.replay_filename
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __archive, __index, __replay, __replayed, __registered # pylint: disable=global-statement
+    finish()
+    if config.record_filename:
+        __index = writers.RecordIndex()
+        __archive = writers.OutputFile(config.record_filename, compression='gzip',
+                                       members=[])
+        __archive.write_bytes(json_codec.dumps({'archive': 1, 'timeStr': config.time_str,
+                                                'xmodURL': config.xmod_url}) + b'\n')
+        # An interrupted capture is worth replaying too
+        if not __registered:
+            atexit.register(finish)
+            __registered = True
+        common_logger.get_logger().info('Recording responses to %s.', config.record_filename)
+    elif config.replay_filename:
+        __replay = _open_replay(config.replay_filename)
+        __replayed = {}
+        common_logger.get_logger().info('Replaying %d responses from %s.',
+                                        len(__replay), config.replay_filename)
+
+def replaying() -> bool:
+    """Returns True if requests are answered from the archive"""
+    return __replay is not None
+
+def real_time() -> bool:
+    """Returns True unless replaying at full speed, i.e. waits are kept"""
+    return __replay is None or config.replay_latency
+
+def _write(entry: dict):
+    """Adds an entry to the archive being recorded"""
+    data = json_codec.dumps(entry) + b'\n'
+    with __lock:
+        if __archive is not None:
+            __index.add(_request_keys(entry), __archive.offset, len(data) - 1)
+            __archive.write_bytes(data)
+
+def record(url: str, status: int, headers: dict, content: bytes, seconds: float):
+    """Adds a response to the archive, if recording
+
+    May be called concurrently by the workers.
+
+    Args:
+        url (str): The requested location
+        status (int): The response status
+        headers (dict): The response headers
+        content (bytes): The response body
+        seconds (float): Time from sending the request to reading the body
+    """
+    if __archive is None:
+        return
+    _write({'url': request_key(url), 'status': status,
+            'seconds': round(seconds, 4),
+            'headers': {name: headers[name] for name in HEADERS if name in headers},
+            'body': content.decode('utf-8', 'replace')})
+
+def record_failure(url: str, error: Exception, seconds: float):
+    """Adds a request that got no response to the archive, if recording
+
+    Args:
+        url (str): The requested location
+        error (Exception): Why there was no response
+        seconds (float): Time from sending the request to the failure
+    """
+    if __archive is None:
+        return
+    _write({'url': request_key(url), 'status': None,
+            'seconds': round(seconds, 4), 'error': repr(error)})
+
+def lookup(url: str) -> dict:
+    """Returns the next recorded response to a request
+
+    Args:
+        url (str): The requested location
+
+    Returns:
+        dict: The archive entry, with its status (None if the request
+            failed), seconds, headers, and body, or None if the request
+            is not in the archive
+    """
+    key = request_key(url)
+    with __lock:
+        replayed = __replayed.get(key, 0)
+        entry = None
+        for number, entry in enumerate(__replay.records(key)):
+            if number == replayed:
+                break
+        if entry is not None:
+            __replayed[key] = replayed + 1
+        return entry
+
+def replay(url: str) -> requests.Response:
+    """Answers a request from the archive, as the shared session would
+
+    Waits for the recorded time first, if config.replay_latency.
+
+    Args:
+        url (str): The requested location
+
+    Returns:
+        Response: The recorded response
+
+    Raises:
+        ConnectionError: If the request failed when recorded, or is not in
+            the archive
+    """
+    entry = lookup(url)
+    if entry is None:
+        raise requests.exceptions.ConnectionError('Not in the archive: ' + url)
+    if config.replay_latency:
+        time.sleep(entry['seconds'])
+    if entry['status'] is None:
+        raise requests.exceptions.ConnectionError(entry['error'])
+    response = requests.Response()
+    response.status_code = entry['status']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response.url = url
+    response.encoding = 'utf-8'
+    response._content = entry['body'].encode('utf-8') # pylint: disable=protected-access
+    return response
+
+def finish():
+    """Closes and indexes the archive being recorded, or the one being replayed
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __archive, __replay # pylint: disable=global-statement
+    with __lock:
+        archive, __archive = __archive, None
+        replay, __replay = __replay, None
+    if archive is not None:
+        archive.close()
+        __index.write(archive.name + writers.INDEX_EXTENSION, archive.members)
+    if replay is not None:
+        replay.close()
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
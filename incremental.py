@@ -0,0 +1,323 @@
+"""Tracks list fingerprints so a capture can reuse the previous snapshot.
+
+    Every capture saves a fingerprint (a hash of the list entry returned by
+    the people or groups list) for each User and Group it captured, in a
+    fingerprints file next to the other output files.  The file is only
+    written once the capture completes, so it also marks a complete
+    snapshot.
+
+    An incremental capture (--incremental) loads the fingerprints of the
+    most recent complete snapshot, or keeps them in memory when it was
+    saved by an earlier capture of the same process (see daemon.py).  A
+    User or Group whose list entry has the same fingerprint is copied
+    forward from the previous snapshot's file instead of being requested
+    again, along with its Devices or Shifts.  Only the fingerprints are
+    held in memory, each unchanged record is read from the previous file
+    by id through its index (see snapshot_index), which is built first if
+    the previous capture was run without --index.  Anything that was in
+    the previous snapshot but is no longer listed is reported as deleted,
+    as long as every User or Group was captured.  The result is still a
+    complete snapshot.
+
+    Only the list entry is fingerprinted, so a change that does not show
+    in the list entry (e.g. to a Device or a Shift) is not picked up until
+    the User or Group itself changes, or a full capture is run.
+
+    Attributes:
+        __previous (dict): The fingerprints file of the previous snapshot,
+            by type of object
+        __indexes (list): The snapshot_index.Index of each shard of the
+            previous snapshot's file, for the type of object being captured
+        __current (dict): Fingerprints and targetNames by id, by type of
+            object, for this capture
+        __changes (dict): Counts of added, changed, and unchanged objects,
+            and the deleted objects, by type of object
+        __last (dict): The fingerprints file saved by the last complete
+            capture of this process, or None
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import glob
+import hashlib
+import json
+import os
+import threading
+
+import config
+import common_logger
+import json_codec
+import shards
+import snapshot_index
+import writers
+
+__previous = {}
+__indexes = []
+# Guards __indexes, whose lookups share a decompressed member
+__indexes_lock = threading.Lock()
+__current = {}
+__changes = {}
+__last = None
+
+def fingerprint(body: dict) -> str:
+    """Returns the fingerprint of a list entry
+
+    Args:
+        body (dict): A User or Group entry from the people or groups list
+
+    Returns:
+        str: Hex digest of the entry's canonical JSON
+    """
+    return hashlib.blake2b(json_codec.dumps(body, sort_keys=True),
+                           digest_size=16).hexdigest()
+
+def record_id(kind: str, record: dict) -> str:
+    """Returns the id of a saved User or Group record"""
+    return record['user' if kind == 'users' else 'group']['id']
+
+def _find_previous(kind: str) -> dict:
+    """Returns the most recent complete snapshot that captured a type
+
+    Args:
+        kind (str): The type of object, 'users' or 'groups'
+
+    Returns:
+        dict: The fingerprints file's entry for kind, with its timeStr,
+            or None if there is no earlier snapshot
+    """
+    if __last is not None and kind in __last and __last['timeStr'] < config.time_str:
+        return dict(__last[kind], timeStr=__last['timeStr'])
+    pattern = (config.out_directory + config.dir_sep + config.base_name +
+               '.' + config.instance_type + '.fingerprints.*.json')
+    for filename in sorted(glob.glob(pattern), reverse=True):
+        with open(filename, 'rb') as fingerprints_file:
+            snapshot = json_codec.loads(fingerprints_file.read())
+        if snapshot['timeStr'] < config.time_str and kind in snapshot:
+            previous = snapshot[kind]
+            previous['timeStr'] = snapshot['timeStr']
+            return previous
+    return None
+
+def _open_indexes(filename: str) -> list:
+    """Opens the previous snapshot's file for lookups by id
+
+    Args:
+        filename (str): The previous record file, or the unsharded name of
+            a sharded one
+
+    Returns:
+        list: The snapshot_index.Index of each shard
+
+    Raises:
+        ValueError: If a file without an index cannot be indexed
+    """
+    indexes = []
+    try:
+        for shard in shards.filenames(filename) or [filename]:
+            if not os.path.exists(shard + writers.INDEX_EXTENSION):
+                snapshot_index.build(shard)
+            indexes.append(snapshot_index.Index(shard))
+    except ValueError:
+        for index in indexes:
+            index.close()
+        raise
+    return indexes
+
+def _close_indexes():
+    """Closes the previous snapshot's file"""
+    global __indexes # pylint: disable=global-statement
+    with __indexes_lock:
+        for index in __indexes:
+            index.close()
+        __indexes = []
+
+def begin():
+    """Starts tracking the fingerprints of a capture
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __previous, __current, __changes # pylint: disable=global-statement
+    _close_indexes()
+    __previous = {}
+    __current = {}
+    __changes = {}
+
+def begin_phase(kind: str, options: dict, load: bool = True):
+    """Starts tracking a type of object, loading the previous snapshot
+
+    The previous records are only reused when they were captured with the
+    same options, e.g. both with or both without Devices.
+
+    Args:
+        kind (str): The type of object, 'users' or 'groups'
+        options (dict): The options that change the saved records
+        load (bool): If False, only the previous fingerprints are loaded,
+            not the previous records
+    """
+    global __indexes # pylint: disable=global-statement
+    logger = common_logger.get_logger()
+    __current[kind] = {'options': options, 'fingerprints': {}}
+    _close_indexes()
+    if not config.incremental:
+        return
+
+    previous = _find_previous(kind)
+    if previous is None:
+        logger.warning('There is no earlier snapshot of %s, capturing all of them.', kind)
+        return
+    if previous['options'] != options:
+        logger.warning('The %s snapshot of %s was captured with different '
+                       'options, capturing all of them.', previous['timeStr'], kind)
+        return
+    filename = config.out_directory + config.dir_sep + previous['filename']
+    if not shards.exists(filename):
+        logger.warning('The %s snapshot of %s is missing %s, capturing all of '
+                       'them.', previous['timeStr'], kind, filename)
+        return
+
+    __previous[kind] = previous
+    __changes[kind] = {'previous': previous['timeStr'], 'added': 0,
+                       'changed': 0, 'unchanged': 0, 'deleted': []}
+    if load:
+        try:
+            indexes = _open_indexes(filename)
+        except ValueError as e:
+            logger.warning('The %s snapshot of %s could not be indexed (%s), '
+                           'capturing all of them.', previous['timeStr'], kind, e)
+            return
+        logger.info('Reusing unchanged %s from the %s snapshot.', kind, previous['timeStr'])
+        with __indexes_lock:
+            __indexes = indexes
+
+def recover(kind: str, filename: str):
+    """Recovers the objects already saved by an interrupted capture
+
+    Called after begin_phase when resuming a type of object.  The
+    fingerprints of the saved objects were lost, so they are recorded as
+    present with an unknown fingerprint.  They will not be reported as
+    deleted, and the next incremental capture will request them again.
+
+    Args:
+        kind (str): The type of object, 'users' or 'groups'
+        filename (str): The output file being resumed
+    """
+    fingerprints = __current[kind]['fingerprints']
+    for record in shards.read_records(filename):
+        obj = record['user' if kind == 'users' else 'group']
+        fingerprints[obj['id']] = [None, obj['targetName']]
+
+def recover_phase(kind: str, options: dict, filename: str):
+    """Recovers a type of object that an interrupted capture completed
+
+    Args:
+        kind (str): The type of object, 'users' or 'groups'
+        options (dict): The options that change the saved records
+        filename (str): The completed output file
+    """
+    begin_phase(kind, options, load=False)
+    recover(kind, filename)
+    end_phase(kind, filename, True)
+
+def reuse(kind: str, body: dict) -> dict:
+    """Returns the previous record of an object if its list entry is unchanged
+
+    May be called concurrently by the workers.
+
+    Args:
+        kind (str): The type of object, 'users' or 'groups'
+        body (dict): The object's entry from the list
+
+    Returns:
+        dict: The previous record, or None if it must be captured again
+    """
+    previous = __previous.get(kind)
+    if previous is None:
+        return None
+    entry = previous['fingerprints'].get(body['id'])
+    if entry is None or entry[0] != fingerprint(body):
+        return None
+    with __indexes_lock:
+        for index in __indexes:
+            record = index.get(body['id'])
+            if record is not None and record_id(kind, record) == body['id']:
+                return record
+    return None
+
+def update(kind: str, body: dict):
+    """Records the fingerprint of a saved object
+
+    Args:
+        kind (str): The type of object, 'users' or 'groups'
+        body (dict): The object's entry from the list
+    """
+    current = fingerprint(body)
+    __current[kind]['fingerprints'][body['id']] = [current, body['targetName']]
+    changes = __changes.get(kind)
+    if changes is None:
+        return
+    entry = __previous[kind]['fingerprints'].get(body['id'])
+    if entry is None:
+        changes['added'] += 1
+    elif entry[0] == current:
+        changes['unchanged'] += 1
+    else:
+        changes['changed'] += 1
+
+def end_phase(kind: str, filename: str, complete: bool):
+    """Finishes a type of object, finding what was deleted
+
+    An incomplete type of object is left out of the fingerprints file, so
+    it is not used as a previous snapshot.
+
+    Args:
+        kind (str): The type of object, 'users' or 'groups'
+        filename (str): The output file of this capture
+        complete (bool): True if every object in the list was captured
+    """
+    _close_indexes()
+    if not complete:
+        return
+    __current[kind]['filename'] = os.path.basename(filename)
+    changes = __changes.get(kind)
+    if changes is None:
+        return
+    current = __current[kind]['fingerprints']
+    changes['deleted'] = [
+        {'id': obj_id, 'targetName': entry[1]}
+        for obj_id, entry in __previous[kind]['fingerprints'].items()
+        if obj_id not in current]
+    common_logger.get_logger().info(
+        'Compared to the %s snapshot, %d %s were added, %d changed, %d '
+        'unchanged, and %d deleted.', changes['previous'], changes['added'],
+        kind, changes['changed'], changes['unchanged'], len(changes['deleted']))
+
+def finish():
+    """Saves the fingerprints, and the changes of an incremental capture
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __last # pylint: disable=global-statement
+    snapshot = {'timeStr': config.time_str}
+    snapshot.update({kind: current for kind, current in __current.items()
+                     if 'filename' in current})
+    with open(config.fingerprints_filename, 'wb') as fingerprints_file:
+        fingerprints_file.write(json_codec.dumps(snapshot))
+    __last = snapshot
+    if config.incremental:
+        with open(config.changes_filename, 'w') as changes_file:
+            json.dump(__changes, changes_file, indent=2)
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""Captures several xMatters instances concurrently from one invocation.
+
+    With --instances, the capture reads a JSON list of instances, each an
+    object with the same keys as the defaults file.  An instance's keys
+    override the defaults file for that instance only, while options given
+    on the command line still apply to every instance, e.g.:
+
+        [
+            {"name": "acme", "xmodURL": "https://acme.xmatters.com",
+             "baseName": "acme", "instance": "prod"},
+            {"name": "acme-np", "xmodURL": "https://acme-np.xmatters.com",
+             "baseName": "acme", "instance": "np", "workers": 4}
+        ]
+
+    What the capture engines keep about a capture is held in a
+    processor.Capture made for each capture, but the config module, the
+    session and its connections (see xm_session), and the Site cache,
+    metrics, checkpoint, and output files are kept once per process.  So
+    each instance is captured in a process of its own, with its own config
+    and session, and the instances do not compete for one interpreter.
+    The parent process keeps an Instance for each, with how its capture
+    went.
+
+    With --total-requests N, no more than N requests are in flight across
+    all of the instances together, whatever each instance's own workers or
+    max requests, so the captures share one budget of connections to the
+    network or proxy they go through.  The budget is a semaphore shared by
+    the processes, which xm_session.get and async_processor._get take for
+    each request.
+
+    Attributes:
+        __budget (BoundedSemaphore): Requests in flight shared by every
+            instance, or None if there is no shared limit
+        __waiting (Queue): The asyncio engine's requests waiting on the
+            budget, as (loop, future) pairs, handed it in order by a
+            daemon thread, so a wait does not hold up the process's exit
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import asyncio
+import json
+import multiprocessing
+from multiprocessing import connection
+import queue
+import sys
+import threading
+import time
+
+__budget = None
+__waiting = None
+
+class Instance(object):
+    """An instance listed in the instances file, and how its capture went
+
+    Args:
+        number (int): The position of the instance in the file, from 1
+        settings (dict): The instance's defaults file keys
+
+    Attributes:
+        name (str): The instance's name key, else its baseName and type
+        process (Process): The process capturing the instance, once started
+        started (float): When the capture started, from time.monotonic
+        finished (float): When the capture finished, from time.monotonic
+        exit_code (int): The capture's exit status, once finished
+    """
+    def __init__(self, number: int, settings: dict):
+        self.number = number
+        self.settings = settings
+        self.name = settings.get('name') or '%s.%s' % (
+            settings.get('baseName', number), settings.get('instance', 'np'))
+        self.process = None
+        self.started = None
+        self.finished = None
+        self.exit_code = None
+
+    @property
+    def seconds(self) -> float:
+        """Returns how long the capture took, or has taken so far"""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+def load(filename: str) -> list:
+    """Reads the instances to capture
+
+    Args:
+        filename (str): Name of the instances file
+
+    Returns:
+        list: An Instance for each entry
+
+    Raises:
+        ValueError: If the file is not a list of objects with unique names
+    """
+    with open(filename) as instances_file:
+        entries = json.load(instances_file)
+    if not isinstance(entries, list) or not entries or not all(
+            isinstance(entry, dict) for entry in entries):
+        raise ValueError(filename + ' must hold a list of instance objects')
+    instances = [Instance(number, entry) for number, entry in enumerate(entries, 1)]
+    names = [instance.name for instance in instances]
+    for name in names:
+        if names.count(name) > 1:
+            raise ValueError('More than one instance is named ' + name)
+    return instances
+
+def acquire():
+    """Waits until the shared budget allows another request, if there is one"""
+    if __budget is not None:
+        __budget.acquire()
+
+async def acquire_async():
+    """Same as acquire, without blocking the event loop
+
+    Waits on a thread of its own, rather than the loop's default executor,
+    which aiohttp resolves host names on.  One thread is enough, since the
+    requests are handed the budget one at a time in the order they asked.
+    """
+    global __waiting # pylint: disable=global-statement
+    if __budget is None or __budget.acquire(False):
+        return
+    if __waiting is None:
+        __waiting = queue.Queue()
+        threading.Thread(target=_hand_out, name='budget', daemon=True).start()
+    granted = asyncio.get_running_loop().create_future()
+    __waiting.put((granted.get_loop(), granted))
+    await granted
+
+def _hand_out():
+    """Hands the budget to each waiting request in turn, see acquire_async"""
+    while True:
+        loop, granted = __waiting.get()
+        __budget.acquire()
+        try:
+            loop.call_soon_threadsafe(_grant, granted)
+        except RuntimeError:
+            # The capture is over, and its loop closed
+            release()
+
+def _grant(granted):
+    """Completes a wait on the budget, on the waiting request's loop"""
+    if granted.cancelled():
+        # The request gave up waiting, so give back what it was handed
+        release()
+    else:
+        granted.set_result(None)
+
+def release():
+    """Returns a request to the shared budget, if there is one"""
+    if __budget is not None:
+        __budget.release()
+
+def _run(target, settings: dict, budget):
+    """Captures an instance, in the instance's own process"""
+    global __budget # pylint: disable=global-statement
+    __budget = budget
+    target(settings)
+
+def capture(instances: list, target, total_requests: int = None) -> int:
+    """Captures every instance at once, each in a process of its own
+
+    Args:
+        instances (list): The Instance of each instance to capture
+        target (callable): Captures one instance, called in the new process
+            with the instance's settings, so it must be a module function
+        total_requests (int): The most requests in flight across every
+            instance, or None for no shared limit
+
+    Returns:
+        int: 0 if every capture succeeded, else the exit status of the
+            first one that failed
+    """
+    budget = (multiprocessing.BoundedSemaphore(total_requests)
+              if total_requests else None)
+    for instance in instances:
+        instance.process = multiprocessing.Process(
+            target=_run, args=(target, instance.settings, budget),
+            name='capture ' + instance.name)
+        instance.started = time.monotonic()
+        instance.process.start()
+        sys.stderr.write('Capturing %s (process %d).\n'
+                         % (instance.name, instance.process.pid))
+
+    # Note when each capture finishes, in whatever order they do
+    running = {instance.process.sentinel: instance for instance in instances}
+    while running:
+        for sentinel in connection.wait(list(running)):
+            instance = running.pop(sentinel)
+            instance.process.join()
+            instance.finished = time.monotonic()
+            instance.exit_code = instance.process.exitcode
+            sys.stderr.write('%s %s in %.1f seconds.\n' % (
+                instance.name, 'captured' if instance.exit_code == 0 else
+                'failed with exit status %d' % instance.exit_code,
+                instance.seconds))
+
+    for instance in instances:
+        if instance.exit_code != 0:
+            return instance.exit_code
+    return 0
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
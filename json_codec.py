@@ -0,0 +1,105 @@
+"""Encodes and decodes the JSON of responses and records.
+
+    Uses the orjson module when it is installed (`pip install orjson`),
+    which decodes and encodes several times faster than the json module,
+    and falls back to the json module otherwise.  The backend can also be
+    picked with --codec.
+
+    Both backends write the same bytes: compact separators and UTF-8
+    rather than escaped non-ASCII characters.  The only numbers they write
+    differently are floats that need an exponent (e.g. 1e-07 or 1e+16), so
+    a record that orjson writes with anything that looks like one is
+    encoded again with the json module.  Numbers that orjson cannot encode
+    (integers of more than 64 bits) are also left to the json module.
+
+    Attributes:
+        backend (str): The backend in use, 'orjson' or 'json'
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import config
+
+# The backends, and the one used when none is configured
+BACKENDS = ['orjson', 'json']
+DEFAULT_BACKEND = 'orjson' if orjson is not None else 'json'
+# Bytes of a number, and the bytes a value can follow, in compact JSON,
+# which translate to 1 and 0 respectively for _DIFFERENT_FLOAT
+_FLOAT_TABLE = bytes(1 if byte in b'0123456789.-' else 0 if byte in b':,[' else byte
+                     for byte in range(256))
+# A translated number where orjson may have written a float differently
+# than json does, i.e. with an exponent (orjson writes 1e16 and 1e-7, json
+# writes 1e+16 and 1e-07).  Small floats that json writes with an exponent
+# and orjson does not (e.g. 0.00001) are found by looking for 0.0000.
+_DIFFERENT_FLOAT = re.compile(b'\x00\x01+e')
+
+backend = DEFAULT_BACKEND
+
+def begin():
+    """Picks the backend from config.codec
+
+    Args:
+
+    Returns:
+        None
+    """
+    global backend # pylint: disable=global-statement
+    backend = config.codec or DEFAULT_BACKEND
+
+def loads(data):
+    """Decodes a JSON document
+
+    Args:
+        data (bytes or str): The JSON text
+
+    Returns:
+        The decoded value
+
+    Raises:
+        ValueError: If data is not valid JSON
+    """
+    if backend == 'orjson':
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _json_dumps(value, sort_keys: bool) -> bytes:
+    """Encodes a value with the json module, as orjson would"""
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False,
+                      sort_keys=sort_keys).encode('utf-8')
+
+def dumps(value, sort_keys: bool = False) -> bytes:
+    """Encodes a value as compact JSON, the same with either backend
+
+    Args:
+        value: The value to encode, made of JSON types
+        sort_keys (bool): If True, the keys of every object are sorted
+
+    Returns:
+        bytes: The UTF-8 JSON text
+    """
+    if backend == 'orjson' and isinstance(value, (dict, list)):
+        try:
+            data = orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        except TypeError:
+            return _json_dumps(value, sort_keys)
+        if (b'0.0000' not in data and
+                _DIFFERENT_FLOAT.search(data.translate(_FLOAT_TABLE)) is None):
+            return data
+    return _json_dumps(value, sort_keys)
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""Collects request metrics and progress for the run summary report.
+
+    Every request to the xMatters instance is recorded against its endpoint
+    class (e.g. people list, person detail, devices) with its status, the
+    bytes received, and its latency.  Latencies are kept in a histogram
+    with logarithmic buckets, so the p50, p95, and p99 can be reported
+    without keeping every sample.
+
+    The progress of each phase (sites, users, devices, groups) is tracked
+    from the total field of the list being paged through, and a live
+    throughput and ETA line is shown on the console when it is a terminal.
+
+    At the end of the run the metrics are saved as JSON next to the admin
+    file.
+
+    Attributes:
+        __endpoints (dict): Request statistics by endpoint class
+        __phases (dict): Progress of each phase by name
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import math
+import re
+import sys
+import threading
+import time
+
+import config
+import common_logger
+
+# Endpoint class of each kind of xMatters URL, the first match wins
+ENDPOINT_CLASSES = [
+    (re.compile(r'/api/xm/1/sites/?$'), 'sites list'),
+    (re.compile(r'/api/xm/1/sites/[^/]+/?$'), 'site detail'),
+    (re.compile(r'/api/xm/1/people/?$'), 'people list'),
+    (re.compile(r'/api/xm/1/people/[^/]+/devices/?$'), 'devices'),
+    (re.compile(r'/api/xm/1/people/[^/]+/?$'), 'person detail'),
+    (re.compile(r'/api/xm/1/devices/?$'), 'devices'),
+    (re.compile(r'/api/xm/1/groups/?$'), 'groups list'),
+    (re.compile(r'/api/xm/1/groups/[^/]+/shifts/?$'), 'shifts'),
+    (re.compile(r'/api/xm/1/groups/[^/]+/?$'), 'group detail')
+]
+# Ratio between the bounds of neighbouring latency buckets
+BUCKET_RATIO = 1.1
+# Seconds between updates of the live progress line on a terminal
+LIVE_INTERVAL = 0.5
+# Seconds between progress lines in the log
+LOG_INTERVAL = 30.0
+
+__lock = threading.Lock()
+__started = time.monotonic()
+__endpoints = {}
+__phases = {}
+__live_shown = 0.0
+__live_logged = 0.0
+
+def begin():
+    """Starts collecting metrics for a new run
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __started, __endpoints, __phases # pylint: disable=global-statement
+    with __lock:
+        __started = time.monotonic()
+        __endpoints = {}
+        __phases = {}
+
+def endpoint_class(url: str) -> str:
+    """Returns the endpoint class of an xMatters URL
+
+    Args:
+        url (str): The requested location
+
+    Returns:
+        str: One of the ENDPOINT_CLASSES names, or 'other'
+    """
+    path = url.split('?', 1)[0]
+    for pattern, name in ENDPOINT_CLASSES:
+        if pattern.search(path):
+            return name
+    return 'other'
+
+def _bucket(seconds: float) -> int:
+    """Returns the latency bucket of a duration, bucket 0 is up to 1ms"""
+    millis = seconds * 1000.0
+    if millis <= 1.0:
+        return 0
+    return int(math.ceil(math.log(millis) / math.log(BUCKET_RATIO)))
+
+def _percentile(endpoint: dict, fraction: float) -> float:
+    """Returns the upper bound, in ms, of the bucket holding a percentile"""
+    rank = max(1, int(math.ceil(endpoint['requests'] * fraction)))
+    seen = 0
+    for bucket in sorted(endpoint['buckets']):
+        seen += endpoint['buckets'][bucket]
+        if seen >= rank:
+            return round(min(BUCKET_RATIO ** bucket,
+                             endpoint['maxSeconds'] * 1000.0), 1)
+    return 0.0
+
+def record_request(url: str, status: int, size: int, seconds: float):
+    """Records a request to the xMatters instance
+
+    Args:
+        url (str): The requested location
+        status (int): The response status, or None if no response came back
+        size (int): Bytes in the response body
+        seconds (float): Time from sending the request to reading the body
+    """
+    name = endpoint_class(url)
+    with __lock:
+        endpoint = __endpoints.get(name)
+        if endpoint is None:
+            endpoint = __endpoints[name] = {
+                'requests': 0, 'statuses': {}, 'bytes': 0, 'seconds': 0.0,
+                'maxSeconds': 0.0, 'buckets': {}}
+        endpoint['requests'] += 1
+        key = 'failed' if status is None else str(status)
+        endpoint['statuses'][key] = endpoint['statuses'].get(key, 0) + 1
+        endpoint['bytes'] += size
+        endpoint['seconds'] += seconds
+        endpoint['maxSeconds'] = max(endpoint['maxSeconds'], seconds)
+        bucket = _bucket(seconds)
+        endpoint['buckets'][bucket] = endpoint['buckets'].get(bucket, 0) + 1
+
+def begin_phase(name: str, done: int = 0):
+    """Starts tracking the progress of a phase
+
+    Args:
+        name (str): The phase, e.g. 'users'
+        done (int): List records already handled, e.g. when resuming
+    """
+    with __lock:
+        __phases[name] = {'started': time.monotonic(), 'first': done,
+                          'done': done, 'total': None, 'seconds': None}
+
+def progress(name: str, done: int, total: int):
+    """Updates the progress of a phase, and shows the live progress line
+
+    Args:
+        name (str): The phase, e.g. 'users'
+        done (int): List records handled so far
+        total (int): The total field of the list
+    """
+    global __live_shown, __live_logged # pylint: disable=global-statement
+    now = time.monotonic()
+    with __lock:
+        phase = __phases[name]
+        phase['done'] = done
+        phase['total'] = total
+        show = sys.stderr.isatty() and now - __live_shown >= LIVE_INTERVAL
+        log = now - __live_logged >= LOG_INTERVAL
+        if show:
+            __live_shown = now
+        if log:
+            __live_logged = now
+        line = _progress_line(name, phase, now) if show or log else None
+    if show:
+        sys.stderr.write('\r' + line + '\033[K')
+        sys.stderr.flush()
+    if log:
+        common_logger.get_logger().info(line)
+
+def _progress_line(name: str, phase: dict, now: float) -> str:
+    """Formats the throughput and ETA of a phase"""
+    elapsed = now - phase['started']
+    rate = (phase['done'] - phase['first']) / elapsed if elapsed > 0 else 0.0
+    requests = sum(endpoint['requests'] for endpoint in __endpoints.values())
+    line = '%s: %d of %d, %.1f/s, %.1f requests/s' % (
+        name, phase['done'], phase['total'] or 0, rate,
+        requests / max(now - __started, 1e-6))
+    if rate > 0 and phase['total']:
+        remaining = max(0, phase['total'] - phase['done']) / rate
+        line += ', ETA %s' % time.strftime('%H:%M:%S', time.gmtime(remaining))
+    return line
+
+def end_phase(name: str):
+    """Records the time taken by a phase and leaves its final progress line
+
+    Args:
+        name (str): The phase, e.g. 'users'
+    """
+    now = time.monotonic()
+    with __lock:
+        phase = __phases[name]
+        phase['seconds'] = now - phase['started']
+        line = _progress_line(name, phase, now)
+    if sys.stderr.isatty() and __live_shown:
+        sys.stderr.write('\r' + line + '\033[K\n')
+        sys.stderr.flush()
+
+def finish():
+    """Ends any phase still under way, e.g. when the capture raised
+
+    Args:
+
+    Returns:
+        None
+    """
+    with __lock:
+        names = [name for name, phase in __phases.items() if phase['seconds'] is None]
+    for name in names:
+        end_phase(name)
+
+def summary() -> dict:
+    """Returns the metrics collected so far
+
+    Args:
+
+    Returns:
+        dict: The run summary, as saved by save()
+    """
+    with __lock:
+        elapsed = time.monotonic() - __started
+        endpoints = {}
+        for name, endpoint in sorted(__endpoints.items()):
+            count = endpoint['requests']
+            endpoints[name] = {
+                'requests': count,
+                'statuses': dict(sorted(endpoint['statuses'].items())),
+                'bytes': endpoint['bytes'],
+                'latencyMs': {
+                    'mean': round(endpoint['seconds'] * 1000.0 / count, 1),
+                    'p50': _percentile(endpoint, 0.50),
+                    'p95': _percentile(endpoint, 0.95),
+                    'p99': _percentile(endpoint, 0.99),
+                    'max': round(endpoint['maxSeconds'] * 1000.0, 1)
+                }
+            }
+        phases = {}
+        for name, phase in __phases.items():
+            seconds = phase['seconds']
+            if seconds is None:
+                seconds = time.monotonic() - phase['started']
+            phases[name] = {
+                'records': phase['done'] - phase['first'],
+                'total': phase['total'],
+                'seconds': round(seconds, 3),
+                'recordsPerSecond': round(
+                    (phase['done'] - phase['first']) / seconds, 1) if seconds > 0 else 0.0
+            }
+        requests = sum(endpoint['requests'] for endpoint in endpoints.values())
+        return {
+            'timeStr': config.time_str,
+            'seconds': round(elapsed, 3),
+            'requests': requests,
+            'requestsPerSecond': round(requests / elapsed, 1) if elapsed > 0 else 0.0,
+            'bytes': sum(endpoint['bytes'] for endpoint in endpoints.values()),
+            'endpoints': endpoints,
+            'phases': phases
+        }
+
+def save(filename: str):
+    """Saves the metrics collected so far as JSON
+
+    Args:
+        filename (str): Name of the metrics file
+    """
+    with open(filename, 'w') as metrics_file:
+        json.dump(summary(), metrics_file, indent=2)
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+"""Serves a synthetic xMatters instance for load testing the capture
+
+    A local stub of the parts of the xMatters REST API that are captured:
+    Sites, People (with Roles and Supervisors), Devices (with Timeframes),
+    Groups, and Shifts.  The size of the instance, the largest page size,
+    the latency of each request, and the rate of 500 and 429 responses
+    can all be configured.  Records are generated on demand from their
+    index, so large instances do not need much memory.
+
+    A later revision of the same instance, with a fraction of its People
+    and Groups changed, can be served to try out incremental captures.
+
+    Example:
+    $ python3 mock_xmatters.py --port 8080 --users 40000 --latency 0.05
+
+    Then capture from it with the -x http://127.0.0.1:8080 option.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API = '/api/xm/1'
+
+class MockInstance(object):
+    """The synthetic data and behavior of a mock xMatters instance
+
+    Args:
+        sites (int): Number of Sites
+        users (int): Number of People
+        devices (int): Number of Devices per Person
+        groups (int): Number of Groups
+        shifts (int): Number of Shifts per Group
+        page_size (int): Largest page returned, whatever limit is requested
+        latency (float): Seconds to wait before each response
+        error_rate (float): Fraction of requests answered with a 500
+        throttle_rate (float): Fraction of requests answered with a 429
+        retry_after (float): Seconds given in the Retry-After of a 429
+        seed (int): Seeds the choice of failed requests
+        revision (int): Revision of the instance, 0 is the original
+        churn (float): Fraction of People and Groups changed in each revision
+    """
+    def __init__(self, sites: int = 10, users: int = 1000, devices: int = 3,
+                 groups: int = 100, shifts: int = 3, page_size: int = 1000,
+                 latency: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: float = 1.0,
+                 seed: int = 0, revision: int = 0, churn: float = 0.0):
+        self.sites = sites
+        self.users = users
+        self.devices = devices
+        self.groups = groups
+        self.shifts = shifts
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.revision = revision
+        self.churn = churn
+        self.requests = 0
+        self.responses = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._routes = [
+            (re.compile(API + r'/sites'), self._sites),
+            (re.compile(API + r'/sites/site-(\d+)'), self._site),
+            (re.compile(API + r'/people'), self._people),
+            (re.compile(API + r'/people/person-(\d+)'), self._person),
+            (re.compile(API + r'/people/person-(\d+)/devices'), self._person_devices),
+            (re.compile(API + r'/devices'), self._devices),
+            (re.compile(API + r'/groups'), self._groups),
+            (re.compile(API + r'/groups/group-(\d+)'), self._group),
+            (re.compile(API + r'/groups/group-(\d+)/shifts'), self._group_shifts)
+        ]
+
+    def reset_counts(self):
+        """Clears the request and response counters"""
+        with self._lock:
+            self.requests = 0
+            self.responses = {}
+
+    def _revised(self, kind: str, index: int) -> int:
+        """Returns the latest revision that changed a Person or Group"""
+        for revision in range(self.revision, 0, -1):
+            if random.Random('%s-%d-%d' % (kind, index, revision)).random() < self.churn:
+                return revision
+        return 0
+
+    def site(self, index: int) -> dict:
+        """Returns the Site at index"""
+        return {
+            'id': 'site-%d' % index,
+            'name': 'Site %d' % index,
+            'status': 'ACTIVE',
+            'country': ['US', 'CA', 'GB', 'DE'][index % 4],
+            'language': ['en', 'fr', 'de'][index % 3],
+            'timezone': ['US/Pacific', 'US/Eastern', 'Europe/London'][index % 3]
+        }
+
+    def person(self, index: int, embeds: list) -> dict:
+        """Returns the Person at index, with the requested embeds"""
+        person = {
+            'id': 'person-%d' % index,
+            'targetName': 'user%d' % index,
+            'firstName': 'First%d' % index,
+            'externalKey': 'key-%d-%d' % (index, self._revised('person', index)),
+            'lastName': 'Last%d' % index,
+            'recipientType': 'PERSON',
+            'status': 'ACTIVE',
+            'language': ['en', 'fr', 'de'][index % 3],
+            'timezone': ['US/Pacific', 'US/Eastern', 'Europe/London'][index % 3],
+            'site': {'id': 'site-%d' % (index % max(self.sites, 1))}
+        }
+        if 'roles' in embeds:
+            role = 'Company Admin' if index % 100 == 0 else 'Standard User'
+            person['roles'] = {'count': 1, 'total': 1, 'data': [{'name': role}]}
+        if 'supervisors' in embeds:
+            supervisor = index - index % 10
+            person['supervisors'] = {'count': 1, 'total': 1, 'data': [
+                {'id': 'person-%d' % supervisor, 'targetName': 'user%d' % supervisor}]}
+        return person
+
+    def device(self, index: int) -> dict:
+        """Returns the Device at index, with its Timeframes"""
+        owner, number = divmod(index, max(self.devices, 1))
+        kind = ['EMAIL', 'VOICE', 'TEXT_PHONE'][number % 3]
+        return {
+            'id': 'device-%d' % index,
+            'name': ['Work Email', 'Work Phone', 'SMS Phone'][number % 3],
+            'deviceType': kind,
+            'targetName': 'user%d|%s' % (owner, kind),
+            'owner': {'id': 'person-%d' % owner, 'targetName': 'user%d' % owner},
+            'provider': {'id': 'usp-%s' % kind.lower()},
+            'timeframes': [{
+                'name': '24x7',
+                'startTime': '00:00',
+                'durationInMinutes': 1440,
+                'days': ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU'],
+                'timezone': ['US/Pacific', 'US/Eastern', 'Europe/London'][owner % 3]
+            }]
+        }
+
+    def group(self, index: int, detail: bool) -> dict:
+        """Returns the Group at index"""
+        group = {
+            'id': 'group-%d' % index,
+            'targetName': 'Group %d' % index,
+            'description': 'Revision %d' % self._revised('group', index),
+            'recipientType': 'GROUP',
+            'status': 'ACTIVE'
+        }
+        if detail:
+            group['site'] = {'id': 'site-%d' % (index % max(self.sites, 1))}
+            group['supervisors'] = {'count': 1, 'total': 1, 'data': [
+                {'id': 'person-0', 'targetName': 'user0'}]}
+        return group
+
+    def shift(self, group: int, index: int) -> dict:
+        """Returns a Shift of a Group, with its members and rotation"""
+        member = (group * self.shifts + index) % max(self.users, 1)
+        return {
+            'id': 'shift-%d-%d' % (group, index),
+            'name': 'Shift %d' % index,
+            'group': {'id': 'group-%d' % group},
+            'start': '2018-12-13T08:00:00.000Z',
+            'end': '2018-12-13T16:00:00.000Z',
+            'members': {'count': 1, 'total': 1, 'data': [
+                {'position': 1, 'member': {'id': 'person-%d' % member, 'targetName': 'user%d' % member}}]},
+            'rotation': {'type': 'NONE'}
+        }
+
+    def _page(self, path: str, query: dict, total: int, make) -> dict:
+        """Returns a page of a list, like the xMatters pagination"""
+        offset = int(query.get('offset', 0))
+        limit = min(int(query.get('limit', self.page_size)), self.page_size)
+        data = [make(index) for index in range(offset, min(offset + limit, total))]
+        page = {'count': len(data), 'total': total, 'data': data,
+                'links': {'self': path + '?' + urllib.parse.urlencode(query, safe=',')}}
+        if offset + limit < total:
+            next_query = dict(query, offset=offset + limit, limit=limit)
+            page['links']['next'] = path + '?' + urllib.parse.urlencode(next_query, safe=',')
+        return page
+
+    def _sites(self, path, query):
+        return self._page(path, query, self.sites, self.site)
+
+    def _site(self, path, query, index):
+        return self.site(int(index)) if int(index) < self.sites else None
+
+    def _people(self, path, query):
+        embeds = query.get('embed', '').split(',')
+        return self._page(path, query, self.users, lambda i: self.person(i, embeds))
+
+    def _person(self, path, query, index):
+        embeds = query.get('embed', '').split(',')
+        return self.person(int(index), embeds) if int(index) < self.users else None
+
+    def _person_devices(self, path, query, index):
+        if int(index) >= self.users:
+            return None
+        first = int(index) * self.devices
+        return self._page(path, query, self.devices, lambda i: self.device(first + i))
+
+    def _devices(self, path, query):
+        return self._page(path, query, self.users * self.devices, self.device)
+
+    def _groups(self, path, query):
+        return self._page(path, query, self.groups, lambda i: self.group(i, False))
+
+    def _group(self, path, query, index):
+        return self.group(int(index), True) if int(index) < self.groups else None
+
+    def _group_shifts(self, path, query, index):
+        if int(index) >= self.groups:
+            return None
+        return self._page(path, query, self.shifts, lambda i: self.shift(int(index), i))
+
+    def respond(self, url: str):
+        """Works out the response to a GET
+
+        Args:
+            url (str): The path and query that was requested
+
+        Returns:
+            (int, dict, dict): The status, headers, and JSON body
+        """
+        with self._lock:
+            self.requests += 1
+            roll = self._random.random()
+        if self.latency:
+            time.sleep(self.latency)
+
+        status, headers, body = 404, {}, None
+        if roll < self.throttle_rate:
+            status, headers = 429, {'Retry-After': str(self.retry_after)}
+            body = {'code': 429, 'reason': 'Too Many Requests', 'message': 'Slow down'}
+        elif roll < self.throttle_rate + self.error_rate:
+            status = 500
+            body = {'code': 500, 'reason': 'Internal Server Error', 'message': 'Injected error'}
+        else:
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path.rstrip('/')
+            query = dict(urllib.parse.parse_qsl(parts.query))
+            for pattern, handler in self._routes:
+                match = pattern.fullmatch(path)
+                if match:
+                    body = handler(path, query, *match.groups())
+                    break
+            if body is not None:
+                status = 200
+            else:
+                body = {'code': 404, 'reason': 'Not Found', 'message': 'Could not find ' + path}
+
+        with self._lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+        return status, headers, body
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answers requests from the MockInstance of the server"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """Answers a GET"""
+        status, headers, body = self.server.instance.respond(self.path)
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """Keeps the request log quiet"""
+        pass
+
+def start_server(instance: MockInstance, port: int = 0) -> ThreadingHTTPServer:
+    """Starts serving a mock instance on a background thread
+
+    Args:
+        instance (MockInstance): The instance to serve
+        port (int): The port to listen on, 0 picks a free port
+
+    Returns:
+        ThreadingHTTPServer: The running server, its base URL is
+            'http://127.0.0.1:%d' % server.server_port
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    server.daemon_threads = True
+    server.instance = instance
+    thread = threading.Thread(target=server.serve_forever, name='mock-xmatters',
+                              daemon=True)
+    thread.start()
+    return server
+
+def add_instance_arguments(parser: argparse.ArgumentParser):
+    """Adds the MockInstance settings to a command line parser"""
+    parser.add_argument("--sites", type=int, default=10,
+                        help="Number of Sites [default: %(default)s]")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="Number of Users [default: %(default)s]")
+    parser.add_argument("--devices", type=int, default=3,
+                        help="Devices per User [default: %(default)s]")
+    parser.add_argument("--groups", type=int, default=100,
+                        help="Number of Groups [default: %(default)s]")
+    parser.add_argument("--shifts", type=int, default=3,
+                        help="Shifts per Group [default: %(default)s]")
+    parser.add_argument("--page-size", type=int, default=1000,
+                        help="Largest page the server returns [default: %(default)s]")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds added to each request [default: %(default)s]")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with a 500 [default: %(default)s]")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with a 429 [default: %(default)s]")
+    parser.add_argument("--retry-after", type=float, default=1.0,
+                        help="Seconds in the Retry-After of a 429 [default: %(default)s]")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seeds which requests fail [default: %(default)s]")
+    parser.add_argument("--revision", type=int, default=0,
+                        help="Revision of the instance to serve [default: %(default)s]")
+    parser.add_argument("--churn", type=float, default=0.0,
+                        help="Fraction of Users and Groups changed in each "
+                        "revision [default: %(default)s]")
+
+def instance_from_arguments(args: argparse.Namespace) -> MockInstance:
+    """Creates a MockInstance from the add_instance_arguments settings"""
+    return MockInstance(
+        sites=args.sites, users=args.users, devices=args.devices,
+        groups=args.groups, shifts=args.shifts, page_size=args.page_size,
+        latency=args.latency, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+        seed=args.seed, revision=args.revision, churn=args.churn)
+
+def main():
+    """Serves a mock instance until interrupted"""
+    parser = argparse.ArgumentParser(description="Serves a mock xMatters instance")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="Port to listen on [default: %(default)s]")
+    add_instance_arguments(parser)
+    args = parser.parse_args()
+    server = start_server(instance_from_arguments(args), args.port)
+    print("Serving a mock xMatters instance on http://127.0.0.1:%d" % server.server_port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
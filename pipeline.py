@@ -0,0 +1,176 @@
+"""Runs records through stages of worker threads with bounded memory.
+
+    A capture phase is a pipeline: the list pages are read on a source
+    thread, and each list entry then goes through a number of stages (e.g.
+    fetching the detail, fetching the Devices or Shifts, encoding to JSON),
+    each with its own workers, before the calling thread writes it out.
+    Stages are joined by queues, so a slow stage can be given more workers
+    without the others.
+
+    Results reach the sink in the order the source produced them, so the
+    output is the same as a single threaded capture.  At most depth items
+    are in flight between the source and the sink; when the sink falls
+    behind the source waits, so memory stays flat however large the
+    instance is.
+
+    A Marker passes through the stages untouched, so the source can tell
+    the sink where each page ends.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import queue
+import threading
+
+# Seconds between checks for a stopped pipeline while waiting for room
+WAIT_INTERVAL = 0.5
+# Tells a stage worker to exit
+_STOP = object()
+
+class Marker(object):
+    """Passes through the stages untouched, e.g. to mark the end of a page
+
+    Args:
+        value: Anything the sink needs, e.g. the page's record count
+    """
+    def __init__(self, value):
+        self.value = value
+
+class _Failure(object):
+    """Carries an exception from a worker thread to the sink"""
+    def __init__(self, error: BaseException):
+        self.error = error
+
+class Pipeline(object):
+    """Stages of worker threads between a source and a sink
+
+    Args:
+        name (str): Names the pipeline's threads, e.g. 'users'
+        stages (list): (name, function, workers) of each stage, in order.
+            Each function is called with the result of the stage before
+            and returns the item for the next stage, or None to drop it.
+        depth (int): The most items in flight at once
+    """
+    def __init__(self, name: str, stages: list, depth: int):
+        self._name = name
+        self._stages = stages
+        self._depth = max(1, depth)
+        self._room = threading.Semaphore(self._depth)
+        self._stopped = threading.Event()
+        self._queues = []
+        self._threads = []
+
+    def _source(self, items, first: queue.Queue, results: queue.Queue):
+        """Numbers each item and feeds it to the first stage, on its own thread"""
+        seq = 0
+        try:
+            for item in items:
+                while not self._room.acquire(timeout=WAIT_INTERVAL):
+                    if self._stopped.is_set():
+                        return
+                if self._stopped.is_set():
+                    return
+                first.put((seq, item))
+                seq += 1
+        except BaseException as e: # pylint: disable=broad-except
+            results.put((seq, _Failure(e)))
+            seq += 1
+        results.put((seq, _STOP))
+
+    def _work(self, func, inbox: queue.Queue, outbox: queue.Queue):
+        """Calls func with each record in inbox, until told to stop"""
+        while True:
+            entry = inbox.get()
+            if entry is _STOP:
+                return
+            seq, item = entry
+            if not (item is None or isinstance(item, (Marker, _Failure)) or
+                    self._stopped.is_set()):
+                try:
+                    item = func(item)
+                except BaseException as e: # pylint: disable=broad-except
+                    item = _Failure(e)
+            outbox.put((seq, item))
+
+    def _start(self, items):
+        """Starts the source and the stage workers
+
+        Returns:
+            Queue: Where the last stage puts its results
+        """
+        # Never more than depth items, plus the stop entries and a failure
+        # of the source, are queued, so a put never has to wait
+        self._queues = [queue.Queue(self._depth + workers)
+                        for _, _, workers in self._stages]
+        results = queue.Queue(self._depth + 2)
+        outboxes = self._queues[1:] + [results]
+        for (stage, func, workers), inbox, outbox in zip(self._stages, self._queues, outboxes):
+            for index in range(workers):
+                thread = threading.Thread(
+                    target=self._work, args=(func, inbox, outbox),
+                    name='%s-%s_%d' % (self._name, stage, index), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        first = self._queues[0] if self._queues else results
+        source = threading.Thread(target=self._source, args=(items, first, results),
+                                  name=self._name + '-source', daemon=True)
+        source.start()
+        self._threads.append(source)
+        return results
+
+    def run(self, items, sink):
+        """Runs every item through the stages, passing the results to sink
+
+        Args:
+            items (iterable): The source, iterated on its own thread
+            sink (function): Called on this thread with each result that
+                was not dropped, and with each Marker, in the order of items
+
+        Raises:
+            Exception: The first exception raised by the source, a stage,
+                or the sink, after the results before it were passed on,
+                and once every thread has exited
+        """
+        results = self._start(items)
+        waiting = {}
+        next_seq = 0
+        join = True
+        try:
+            while True:
+                while next_seq not in waiting:
+                    seq, item = results.get()
+                    waiting[seq] = item
+                item = waiting.pop(next_seq)
+                next_seq += 1
+                if item is _STOP:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                if item is not None:
+                    sink(item)
+                self._room.release()
+        except KeyboardInterrupt:
+            # Stopping at once, the threads are daemons so they end with it
+            join = False
+            raise
+        finally:
+            self._stop(join)
+
+    def _stop(self, join: bool):
+        """Tells every worker to exit, and waits for them if join"""
+        self._stopped.set()
+        for (_, _, workers), inbox in zip(self._stages, self._queues):
+            for _ in range(workers):
+                inbox.put(_STOP)
+        if join:
+            for thread in self._threads:
+                thread.join()
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,13 @@
 
 """
 
+import collections
 import json
 import sys
 import pprint
-from io import TextIOBase
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 import urllib.parse
 
 import requests
@@ -16,23 +19,225 @@ from requests.auth import HTTPBasicAuth
 
 import config
 import common_logger
+import http_archive
+import incremental
+import json_codec
+import metrics
+import pipeline
+import profiler
+import shards
+import site_cache
+import sqlite_export
+import checkpoint
+import writers
+import xm_session
+
+# The collections embedded in each captured User
+USER_EMBEDS = ['roles', 'supervisors']
 
 _logger = None
 _users = None
-_sites_cache = {}
-# Holds admin info: company_admins, roles, timezones, country, language
-_admin_objects = None
+# Page workers, only used when more than one worker is configured.  They
+# only ever request a single page, so the pipeline stages can wait on them.
+_page_executor = None
+# Holds the state of the capture under way, see Capture
+_capture = None
+
+class CaptureIncomplete(Exception):
+    """Raised once a capture is saved if some objects could not be captured"""
+
+class Capture(object):
+    """What a capture of an instance keeps, shared by every capture engine
+
+    _begin_capture makes a new one for each capture, so nothing carries
+    over from one capture to the next, e.g. when a daemon captures again
+    (see daemon.py).  Everything else a capture depends on, the config
+    module, the session (see xm_session), and the state of the modules
+    that save the output, is kept once per process, which is why several
+    instances are captured in processes of their own (see instances.py).
+
+    Attributes:
+        admin_objects (dict): The admin info seen, as a set of each of
+            admins, roles, timezones, countries, languages, devices, usps
+        incomplete (list): The types of object not completely captured
+        failures (int): The requests that failed for good, other than for
+            objects not found
+        open_files (list): The output files being written, so a capture
+            that raises closes them
+        devices_by_owner (dict): The Devices from the instance wide list
+            by owner id, if bulk Devices, else None
+        site_lookups (dict): The Site lookups in flight by Site id, so
+            concurrent misses share one request
+        sites_lock (Lock): Guards site_lookups for the worker threads
+    """
+    def __init__(self):
+        self.admin_objects = {
+            'admins': set(),
+            'roles': set(),
+            'timezones': set(),
+            'countries': set(),
+            'languages': set(),
+            'devices': set(),
+            'usps': set()
+        }
+        self.incomplete = []
+        self.failures = 0
+        self.open_files = []
+        self.devices_by_owner = None
+        self.site_lookups = {}
+        self.sites_lock = threading.Lock()
+        self._admin_lock = threading.Lock()
+        self._failures_lock = threading.Lock()
+
+    def update_admin(self, a_type: str, a_value: str):
+        """Adds a value to one of the admin objects sets, from any thread
+
+        Args:
+            a_type (str): The name of a set in admin_objects
+            a_value (str): The value to add to the set
+        """
+        with self._admin_lock:
+            self.admin_objects[a_type].add(a_value)
+
+    def request_failed(self):
+        """Counts a request that failed for good, from any thread"""
+        with self._failures_lock:
+            self.failures += 1
+
+    def incomplete_phase(self, name: str):
+        """Records that a type of object was not completely captured
+
+        Args:
+            name (str): The type of object, e.g. 'users'
+        """
+        if name not in self.incomplete:
+            self.incomplete.append(name)
 
 def _update_admin(a_type: str, a_value: str):
     """Updates the admin objects set
         
     Puts the value into the appropriate set.
+    Safe to call from any worker thread.
         
     Args:
         a_type (str): The name of a set in the admin dict
         a_value (str): The value to add to the dict
     """
-    _admin_objects[a_type].add(a_value)
+    _capture.update_admin(a_type, a_value)
+
+def _begin_capture():
+    """Prepares the logger and a new Capture
+
+    Shared by every capture engine.
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+    global _logger, _capture # pylint: disable=global-statement
+
+    ### Get the current logger
+    _logger = common_logger.get_logger()
+    _capture = Capture()
+
+def _incomplete_phase(name: str):
+    """Records that a type of object was not completely captured
+
+    Shared by every capture engine.
+
+    Args:
+        name (str): The type of object, e.g. 'users'
+    """
+    _capture.incomplete_phase(name)
+
+def _request_failed():
+    """Counts a request that failed for good, safe from any worker thread
+
+    Shared by every capture engine.
+    """
+    _capture.request_failed()
+
+def _check_phase(name: str, listed: int, total: int, failures: int):
+    """Records a type of object as incomplete if any of it was missed
+
+    Shared by every capture engine.
+
+    Args:
+        name (str): The type of object, e.g. 'users'
+        listed (int): The entries listed
+        total (int): The total reported by the list
+        failures (int): Capture.failures when the phase started
+    """
+    if listed < total or _capture.failures > failures:
+        _logger.error('Missed some %s, listed %d of %d, with %d failed requests.',
+                      name, listed, total, _capture.failures - failures)
+        _incomplete_phase(name)
+
+def _end_capture():
+    """Fails a capture that did not get every object, once it is saved
+
+    Shared by every capture engine.
+
+    Args:
+        None
+
+    Raises:
+        CaptureIncomplete: If any type of object was not completely captured
+    """
+    if _capture.incomplete:
+        incomplete = ', '.join(_capture.incomplete)
+        _logger.error(config.ERR_CAPTURE_INCOMPLETE_MSG, incomplete)
+        raise CaptureIncomplete(config.ERR_CAPTURE_INCOMPLETE_MSG % incomplete)
+
+def _update_site_admin(site_obj: dict):
+    """Updates the admin sets from a Site
+
+    Args:
+        site_obj (dict): The Site record
+
+    Return:
+        None
+    """
+    if 'language' in site_obj: _update_admin('languages', site_obj['language'])
+    if 'timezone' in site_obj: _update_admin('timezones', site_obj['timezone'])
+    if 'country' in site_obj: _update_admin('countries', site_obj['country'])
+
+def _update_user_admin(user_obj: dict):
+    """Updates the admin sets from a User, including their Roles
+
+    Args:
+        user_obj (dict): The User record, with embedded Roles
+
+    Return:
+        None
+    """
+    if 'language' in user_obj: _update_admin('languages', user_obj['language'])
+    if 'timezone' in user_obj: _update_admin('timezones', user_obj['timezone'])
+    if 'roles' in user_obj and user_obj['roles']['total'] > 0:
+        for role in user_obj['roles']['data']:
+            _update_admin('roles', role['name'])
+            if role['name'] == config.company_admin_role:
+                _update_admin('admins', user_obj['targetName'])
+
+def _update_device_admin(devices: list):
+    """Updates the admin sets from a list of Devices
+
+    Uses the Device's Timeframes to update the timezones admin set.
+
+    Args:
+        devices (list): The Device records, with embedded Timeframes
+
+    Return:
+        None
+    """
+    for body in devices:
+        if 'timeframes' in body:
+            for timeframe in body['timeframes']:
+                if 'timezone' in timeframe: _update_admin('timezones', timeframe['timezone'])
+        _update_admin('devices', body['deviceType'] + '|' + body['name'])
+        if 'provider' in body: _update_admin('usps', body['provider']['id'])
 
 def _log_xm_error(url, response):
     """Captures and logs errors
@@ -43,11 +248,18 @@ def _log_xm_error(url, response):
         url (str): The location being requested that caused the error
         response (object): JSON object that holds the error response
         """
-    body = response.json()
+    # An error's body may be empty, or not JSON, e.g. from a proxy
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        body = {}
     if response.status_code == 404:
         _logger.warn(config.ERR_INITIAL_REQUEST_FAILED_MSG,
                      response.status_code, url)
     else:
+        _request_failed()
         _logger.error(config.ERR_INITIAL_REQUEST_FAILED_MSG,
                       response.status_code, url)
         _logger.error('Response - code: %s, reason: %s, message: %s',
@@ -55,51 +267,389 @@ def _log_xm_error(url, response):
                     str(body['reason']) if 'reason' in body else "none",
                     str(body['message']) if 'message' in body else "none")
 
-def _create_out_file(filename: str) -> TextIOBase:
+def _decode(response: requests.Response):
+    """Decodes the JSON body of a response, timing it for the profile
+
+    Args:
+        response (Response): A response from xMatters
+
+    Return:
+        body (dict): The decoded body
+    """
+    started = time.perf_counter()
+    body = json_codec.loads(response.content)
+    profiler.add('json decode', time.perf_counter() - started)
+    return body
+
+def _create_out_file(filename: str) -> writers.OutputFile:
     """Creates and opens results file
 
+    The file is compressed if requested by config.compression.
+
     Args:
         filename (str): Name of file to hold output
 
     Returns:
         file: outFile
     """
-    outFile = open(filename, 'w')
+    outFile = writers.OutputFile(filename)
     return outFile
 
-def _lookup_site_name(site_id: str):
-    """Retrieves a Site name by ID
+def _track_file(out_file: writers.RecordWriter) -> writers.RecordWriter:
+    """Keeps an output file to close if the capture raises, see _close_file
 
-    Attempts to find the Site by it's ID in the Site cache,
-    if not found, then retrieve the Site object from xMatters.
+    Shared by every capture engine.
 
     Args:
-        site_id (str): The ID of the site to find
+        out_file (RecordWriter): The output file just opened
 
-    Return:
+    Returns:
+        RecordWriter: out_file
+    """
+    _capture.open_files.append(out_file)
+    return out_file
+
+def _close_file(out_file: writers.RecordWriter):
+    """Closes an output file kept by _track_file
+
+    Shared by every capture engine.
+
+    Args:
+        out_file (RecordWriter): The output file
+    """
+    _capture.open_files.remove(out_file)
+    out_file.close()
+
+def _close_open_files():
+    """Closes the output files a capture that raised left open
+
+    The files are left as they were, so -r can resume them, and a sharded
+    file gets no manifest, since it is not complete.
+
+    Shared by every capture engine.
+    """
+    while _capture.open_files:
+        out_file = _capture.open_files.pop()
+        try:
+            if isinstance(out_file, shards.ShardedWriter):
+                out_file.close(manifest=False)
+            else:
+                out_file.close()
+        except OSError as e:
+            _logger.error('Could not close %s: %s', out_file.name, repr(e))
+
+def _open_phase_file(name: str, filename: str):
+    """Opens the records output file for a type of object
+
+    Starts a new results file, unless resuming an interrupted capture, in
+    which case the existing file is reopened and truncated to the last
+    committed page.
+
+    Args:
+        name (str): The type of object, e.g. 'users'
+        filename (str): Name of file to hold output
+
+    Returns:
+        (RecordWriter, dict): The output file, which is a
+            shards.ShardedWriter if sharded, and the saved progress
+    """
+    progress = checkpoint.phase(name)
+    if progress['position'] and shards.exists(filename):
+        _logger.info('Resuming %s at offset %d, after %d saved records.',
+                     name, progress['offset'], progress['written'])
+        out_file = shards.open_writer(name, filename, position=progress['position'],
+                                      written=progress['written'])
+        return _track_file(out_file), progress
+
+    progress = {'offset': 0, 'written': 0}
+    out_file = shards.open_writer(name, filename)
+    return _track_file(out_file), progress
+
+def _close_phase_file(name: str, out_file: writers.RecordWriter, offset: int,
+                      written: int, total: int, failures: int):
+    """Finishes the output file for a type of object
+
+    The type of object is marked as done in the checkpoint, unless listing
+    stopped before the total was reached, so a resumed capture can pick up
+    where it left off.
+
+    Args:
+        name (str): The type of object, e.g. 'users'
+        out_file (RecordWriter): The output file
+        offset (int): The offset of the next page to request
+        written (int): The number of records written to out_file
+        total (int): The total number of objects in the list
+        failures (int): Capture.failures when the type of object was started
+
+    Returns:
         None
     """
-    if site_id in _sites_cache:
-        return _sites_cache[site_id]
-    
-    # Site was not in the Cache, so get it from xMatters
+    _close_file(out_file)
+    if offset < total:
+        _logger.error('Stopped capturing %s at offset %d of %d, use --resume '
+                      'to continue.', name, offset, total)
+        _incomplete_phase(name)
+        return
+    checkpoint.commit(name, offset, written, None, _capture.admin_objects, done=True)
+    _check_phase(name, offset, total, failures)
+
+def _fetch_site_name(site_id: str):
+    """Retrieves a Site name from xMatters and caches it
+
+    A Site that is not found is cached as such, but other failures are not
+    cached, so the Site is asked for again next time.
 
+    Args:
+        site_id (str): The ID of the site to find
+
+    Return:
+        site_name (str): The Site's name, or None if not found
+    """
     # Initialize conditions
     url = config.xmod_url + '/api/xm/1/sites/' + site_id
     _logger.debug('Retrieving Site, url=%s', url)
 
     # Get the site records
-    response = requests.get(url, auth=config.basic_auth)
-    if response.status_code not in [200, 404]:
+    try:
+        response = xm_session.get(url)
+    except requests.exceptions.RequestException as e:
+        _logger.error(config.ERR_REQUEST_EXCEPTION_MSG, url, repr(e))
+        _request_failed()
+        return None
+    if response.status_code != 200:
         _log_xm_error(url, response)
-        _sites_cache[site_id] = None
+        if response.status_code == 404:
+            site_cache.put(site_id, None)
         return None
 
     # Process the responses
-    site = response.json()
-    _sites_cache[site['id']] = site['name']
+    site = _decode(response)
+    site_cache.put(site['id'], site['name'])
     return site['name']
 
+def _lookup_site_name(site_id: str):
+    """Retrieves a Site name by ID
+
+    Attempts to find the Site by it's ID in the Site cache,
+    if not found, then retrieve the Site object from xMatters.
+    When several fetch workers miss on the same Site at once, only the
+    first one makes the request and the others wait for its result.
+
+    Args:
+        site_id (str): The ID of the site to find
+
+    Return:
+        site_name (str): The Site's name, or None if not found
+    """
+    known, site_name = site_cache.get(site_id)
+    if known:
+        return site_name
+
+    # Site was not in the Cache, so see if it is already being retrieved
+    with _capture.sites_lock:
+        known, site_name = site_cache.get(site_id)
+        if known:
+            return site_name
+        lookup = _capture.site_lookups.get(site_id)
+        if lookup is not None:
+            waiting = True
+        else:
+            waiting = False
+            lookup = _capture.site_lookups[site_id] = Future()
+    if waiting:
+        return lookup.result()
+
+    # Get it from xMatters, and share the result with any waiting workers
+    site_name = None
+    try:
+        site_name = _fetch_site_name(site_id)
+    finally:
+        with _capture.sites_lock:
+            del _capture.site_lookups[site_id]
+        lookup.set_result(site_name)
+    return site_name
+
+def _get_page(url: str):
+    """Retrieves a single page of a paginated list
+
+    Args:
+        url (str): The location of the page
+
+    Return:
+        bodys (dict): The page, or None if it could not be retrieved
+    """
+    try:
+        response = xm_session.get(url)
+    except requests.exceptions.RequestException as e:
+        _logger.error(config.ERR_REQUEST_EXCEPTION_MSG, url, repr(e))
+        _request_failed()
+        return None
+    if response.status_code != 200:
+        _log_xm_error(url, response)
+        return None
+    return _decode(response)
+
+def _page_url(url: str, offset: int) -> str:
+    """Returns url with its offset query parameter replaced
+
+    Args:
+        url (str): The location of the first page
+        offset (int): The offset of the page to request
+
+    Return:
+        url (str): The location of the page at offset
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k != 'offset']
+    query.append(('offset', str(offset)))
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query, safe=',')))
+
+def _ordered_map(executor: ThreadPoolExecutor, func, items: list, window: int):
+    """Yields func(item) for each item, in order, using the executor
+
+    Unlike executor.map, at most window calls are submitted ahead of the
+    result being yielded, so memory stays bounded.
+
+    Args:
+        executor (ThreadPoolExecutor): The workers to call func with
+        func (function): Called with each item
+        items (list): The arguments for func
+        window (int): The maximum number of calls submitted at once
+
+    Return:
+        result: The result of each call, in the order of items
+    """
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def _follow_next_links(url: str, bodys: dict):
+    """Yields the pages after bodys by following each links.next
+
+    Args:
+        url (str): The location of the page bodys came from
+        bodys (dict): The page to start from
+
+    Return:
+        (url, bodys): The location and body of each page
+    """
+    while 'links' in bodys and 'next' in bodys['links']:
+        url = config.xmod_url + bodys['links']['next']
+        bodys = _get_page(url)
+        yield url, bodys
+        if bodys is None:
+            return
+
+def _get_pages(url: str, description: str):
+    """Yields each page of a paginated list, in order
+
+    The first page is requested on its own.  If it says there are more
+    pages, and there are page workers, the remaining pages are requested
+    concurrently by offset, using the 'total' and 'count' from the first
+    page.  At most config.workers pages are requested ahead of the one
+    being yielded, so memory stays bounded.  Without page workers, the
+    links.next of each page is followed instead.  Either way the pages are
+    requested as the first page's links.next is written, with the limit
+    the instance used rather than the one asked for, so each page has the
+    same URL however it was listed (see http_archive).
+
+    Args:
+        url (str): The location of the first page
+        description (str): What is being listed, used for logging
+
+    Return:
+        bodys (dict): Each page of the list
+    """
+    bodys = _get_page(url)
+    if bodys is None:
+        return
+    _logger.debug("%d Count of %d Total %s found via url=%s", bodys['count'], bodys['total'], description, url)
+    yield bodys
+
+    if 'links' not in bodys or 'next' not in bodys['links']:
+        return
+    if _page_executor is None:
+        pages = _follow_next_links(url, bodys)
+    else:
+        start = int(dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query)).get('offset', 0))
+        next_url = config.xmod_url + bodys['links']['next']
+        page_urls = [_page_url(next_url, offset) for offset in
+                     range(start + bodys['count'], bodys['total'], bodys['count'])]
+        pages = zip(page_urls, _ordered_map(_page_executor, _get_page,
+                                            page_urls, config.workers))
+    for page_url, bodys in pages:
+        if bodys is None:
+            return
+        _logger.debug("%d Count of %d Total %s found via url=%s", bodys['count'], bodys['total'], description, page_url)
+        yield bodys
+
+def _list_entries(url: str, description: str):
+    """Yields each entry of a paginated list, and a Marker after each page
+
+    Args:
+        url (str): The location of the first page
+        description (str): What is being listed, used for logging
+
+    Return:
+        entry: Each list entry, and after each page's entries a
+            pipeline.Marker holding the page's (count, total)
+    """
+    for bodys in _get_pages(url, description):
+        yield from bodys['data']
+        yield pipeline.Marker((bodys['count'], bodys['total']))
+
+def _run_pipeline(name: str, url: str, stages: list, sink):
+    """Runs each entry of a list through the capture stages, in list order
+
+    When any stage has more than one worker, the stages run as a
+    pipeline.Pipeline, holding at most config.pipeline_depth entries at
+    once.  Otherwise each entry goes through every stage on this thread.
+
+    Args:
+        name (str): The type of object, e.g. 'users'
+        url (str): The location of the first page of the list
+        stages (list): (stage, function) pairs, see pipeline.Pipeline
+        sink (function): Called on this thread with each record and
+            page Marker, see pipeline.Pipeline.run
+
+    Return:
+        None
+    """
+    entries = _list_entries(url, name.capitalize())
+    if max(config.stage_workers.values()) > 1:
+        _logger.debug('Capturing %s with stage workers %s', name, config.stage_workers)
+        pipeline.Pipeline(name, [(stage, func, config.stage_workers[stage])
+                                 for stage, func in stages],
+                          config.pipeline_depth).run(entries, sink)
+        return
+    for entry in entries:
+        for _, func in stages:
+            if entry is None or isinstance(entry, pipeline.Marker):
+                break
+            entry = func(entry)
+        if entry is not None:
+            sink(entry)
+
+def _encode_entry(entry: tuple) -> tuple:
+    """Encodes the record of a captured entry, the last capture stage
+
+    Args:
+        entry (tuple): The list entry and its record
+
+    Return:
+        (dict, dict, str): The list entry, its record, and the record's JSON
+    """
+    body, record = entry
+    return body, record, writers.encode_record(record)
+
 def _process_sites():
     """Capture and save the instances Site objects
 
@@ -112,52 +662,74 @@ def _process_sites():
     Return:
         None
     """
+    if checkpoint.phase('sites')['done']:
+        _logger.info('Sites were already captured.')
+        return
     _logger.info('Begin Gathering Sites.')
-    sites_file = _create_out_file(config.sites_filename)
-    sites_file.write('[\n')
+    failures = _capture.failures
+    sites_file, progress = _open_phase_file('sites', config.sites_filename)
 
     # Initialize conditions
-    site_objects = []
     total_sites = 0
-    cnt = 0
+    cnt = progress['written']
+    offset = first_offset = progress['offset']
     url = config.xmod_url + '/api/xm/1/sites?offset=0&limit=' + str(config.page_size)
+    if offset > 0:
+        url = _page_url(url, offset)
     _logger.debug('Gathering Sites via url=%s', url)
+    profiler.begin_phase('sites')
+    metrics.begin_phase('sites', offset)
 
-    while True:
-
-        # Get the site records
-        response = requests.get(url, auth=config.basic_auth)
-        if response.status_code not in [200]:
-            _log_xm_error(url, response)
-            break
+    for bodys in _get_pages(url, 'Sites'):
 
         # Process the responses
-        bodys = response.json()
         total_sites = bodys['total']
-        if bodys['count'] > 0:
-            _logger.debug("%d Count of %d Total Sites found via url=%s", bodys['count'], bodys['total'], url)
-            for body in bodys['data']:
-                cnt += 1
-                _logger.info(f'Capturing Site "{body["name"]}"')
-                json.dump(body, sites_file)
-                sites_file.write(',\n') if cnt < total_sites else sites_file.write('\n')
-                _sites_cache[body['id']] = body['name']
-                # Update admin sets
-                if 'language' in body: _update_admin('languages', body['language'])
-                if 'timezone' in body: _update_admin('timezones', body['timezone'])
-                if 'country' in body: _update_admin('countries', body['country'])
-            site_objects += bodys['data']
-
-        # See if there are any more to get
-        if 'links' in bodys and 'next' in bodys['links']:
-            url = config.xmod_url + bodys['links']['next']
-        else:
-            break
-            
-    _logger.info("Collected %d of a possible %d Sites.", len(site_objects), total_sites)
+        for body in bodys['data']:
+            cnt += 1
+            _logger.info(f'Capturing Site "{body["name"]}"')
+            sites_file.write_record(body)
+            sqlite_export.add('sites', body)
+            _update_site_admin(body)
+        site_cache.update(bodys['data'])
+        offset += bodys['count']
+        sqlite_export.commit()
+        checkpoint.commit('sites', offset, cnt, sites_file, _capture.admin_objects)
+        metrics.progress('sites', offset, total_sites)
 
-    sites_file.write(']')
-    sites_file.close()
+    metrics.end_phase('sites')
+    profiler.end_phase('sites')
+
+    _logger.info("Collected %d of a possible %d Sites.", offset - first_offset, total_sites)
+
+    # Every Site is in the cache, unless listing stopped or was resumed
+    if first_offset == 0 and offset >= total_sites:
+        site_cache.refreshed()
+
+    _close_phase_file('sites', sites_file, offset, cnt, total_sites, failures)
+
+def _refresh_sites():
+    """Fills the Site cache from the Sites list, unless it is fresh
+
+    Lets Groups find their Site's name without a request per Site.
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+    if site_cache.is_fresh():
+        return
+    _logger.info('Refreshing the Site cache.')
+    listed_sites = 0
+    total_sites = 0
+    url = config.xmod_url + '/api/xm/1/sites?offset=0&limit=' + str(config.page_size)
+    for bodys in _get_pages(url, 'Sites'):
+        total_sites = bodys['total']
+        listed_sites += bodys['count']
+        site_cache.update(bodys['data'])
+    if listed_sites >= total_sites:
+        site_cache.refreshed()
 
 def _get_user_devices(user_id: str, target_name: str):
     """Return a User's Devices
@@ -178,38 +750,61 @@ def _get_user_devices(user_id: str, target_name: str):
     url = config.xmod_url + '/api/xm/1/people/' + user_id + '/devices/?embed=timeframes&offset=0&limit=' + str(config.page_size)
     _logger.debug('Gathering Devices for user "%s", url=%s', target_name, url)
 
-    while True:
-
-        # Get the site records
-        response = requests.get(url, auth=config.basic_auth)
-        if response.status_code not in [200, 404]:
-            _log_xm_error(url, response)
-            break
+    for bodys in _get_pages(url, f'Devices for User "{target_name}"'):
 
         # Process the responses
-        bodys = response.json()
         total_devices = bodys['total']
-        if bodys['count'] > 0:
-            _logger.debug('%d Count of %d Total Devices found for User "%s" via url=%s', bodys['count'], bodys['total'], target_name, url)
-            device_list += bodys['data']
-            # Use Timeframe to update the timezones admin set
-            for body in bodys['data']:
-                if 'timeframes' in body:
-                    for timeframe in body['timeframes']:
-                        if 'timezone' in timeframe: _update_admin('timezones', timeframe['timezone'])
-                _update_admin('devices', body['deviceType'] + '|' + body['name'])
-                if 'provider' in body: _update_admin('usps', body['provider']['id'])
-
-        # See if there are any more to get
-        if 'links' in bodys and 'next' in bodys['links']:
-            url = config.xmod_url + bodys['links']['next']
-        else:
-            break
+        device_list += bodys['data']
+        _update_device_admin(bodys['data'])
 
     _logger.debug('Collected %d of a possible %d Devices for User "%s".', len(device_list), total_devices, target_name)
 
     return device_list
 
+def _collect_devices():
+    """Collects every Device in the instance, grouped by owner
+
+    Pages through the instance wide Devices list, rather than making at
+    least one request per User, and files each Device under its owner's
+    id as the pages arrive.  The lists are handed out by _enrich_user.
+    Every Device is held until its owner is captured, so unlike the rest
+    of the Users phase, the memory used grows with the number of Devices.
+
+    If any Device was missed, the Users are marked incomplete too, since
+    some of them will be saved without all of their Devices.
+
+    Args:
+        None
+
+    Return:
+        None
+    """
+    _logger.info('Begin gathering Devices.')
+    failures = _capture.failures
+    devices_by_owner = _capture.devices_by_owner = {}
+    total_devices = 0
+    cnt = 0
+    url = config.xmod_url + '/api/xm/1/devices?embed=timeframes&offset=0&limit=' + str(config.page_size)
+    _logger.debug('Gathering Devices via url=%s', url)
+    profiler.begin_phase('devices')
+    metrics.begin_phase('devices')
+
+    for bodys in _get_pages(url, 'Devices'):
+        total_devices = bodys['total']
+        for body in bodys['data']:
+            cnt += 1
+            devices_by_owner.setdefault(body['owner']['id'], []).append(body)
+        _update_device_admin(bodys['data'])
+        metrics.progress('devices', cnt, total_devices)
+
+    metrics.end_phase('devices')
+    profiler.end_phase('devices')
+
+    _logger.info("Collected %d of a possible %d Devices for %d Users.", cnt, total_devices, len(devices_by_owner))
+    _check_phase('devices', cnt, total_devices, failures)
+    if 'devices' in _capture.incomplete:
+        _incomplete_phase('users')
+
 def _get_user(user_id: str, target_name: str):
     """Attempst to retrieve User by id.
         
@@ -223,14 +818,15 @@ def _get_user(user_id: str, target_name: str):
     _logger.info(f'Capturing User: "{target_name}".')
     
     # Set our resource URLs
-    url = config.xmod_url + '/api/xm/1/people/' + urllib.parse.quote(user_id) + '?embed=roles,supervisors'
+    url = config.xmod_url + '/api/xm/1/people/' + urllib.parse.quote(user_id) + '?embed=' + ','.join(USER_EMBEDS)
     _logger.debug('Attempting to retrieve User "%s" via url: %s', target_name, url)
     
     # Make the request
     try:
-        response = requests.get(url, auth=config.basic_auth)
+        response = xm_session.get(url)
     except requests.exceptions.RequestException as e:
-        _logger.error(config.ERR_REQUEST_EXCEPTION_CODE, url, repr(e))
+        _logger.error(config.ERR_REQUEST_EXCEPTION_MSG, url, repr(e))
+        _request_failed()
         return None
     
     # If the initial response fails, log and return null
@@ -239,26 +835,96 @@ def _get_user(user_id: str, target_name: str):
         return None
     
     # Process the response
-    user_obj = response.json()
+    user_obj = _decode(response)
     # _logger.debug('Found User "%s" - json body: %s', user_obj['firstName'] + ' ' + user_obj['lastName'], pprint.pformat(user_obj))
     _logger.debug('Found User "%s" - json body.id: %s', user_obj['firstName'] + ' ' + user_obj['lastName'], user_obj['id'])
 
-    # Update the Admin object
-    if 'language' in user_obj: _update_admin('languages', user_obj['language'])
-    if 'timezone' in user_obj: _update_admin('timezones', user_obj['timezone'])
-    if 'roles' in user_obj and user_obj['roles']['total'] > 0:
-        for role in user_obj['roles']['data']:
-            _update_admin('roles', role['name'])
-            if role['name'] == config.company_admin_role:
-                _update_admin('admins', user_obj['targetName'])
+    _update_user_admin(user_obj)
 
     return user_obj
 
+def _has_complete_embeds(body: dict) -> bool:
+    """Determines if a User from the people list has all of its embeds
+
+    When the people list is requested with embedded Roles and Supervisors,
+    a collection is truncated if its 'total' is more than its 'count'.
+
+    Args:
+        body (dict): The User entry from the people list
+
+    Return:
+        bool: True if the Roles and Supervisors are all present
+    """
+    for embed in USER_EMBEDS:
+        if embed not in body or body[embed]['total'] > body[embed]['count']:
+            return False
+    return True
+
+def _fetch_user(body: dict) -> tuple:
+    """Gets a User's full record, the first stage of capturing a User
+
+    Expands a User entry from the people list into the record that is
+    saved to the users file.  May be run concurrently by the fetch workers.
+
+    Args:
+        body (dict): The User entry from the people list
+
+    Return:
+        (dict, dict, bool): The list entry, the User record, and whether
+            the record is the previous snapshot's, or None if the User was
+            not found
+    """
+    # Copy the User forward from the previous snapshot if it is unchanged
+    user_obj = incremental.reuse('users', body)
+    if user_obj is not None:
+        _logger.info(f'Reusing User: "{body["targetName"]}".')
+        return body, user_obj, True
+
+    # Get the full user object, including Roles and Supervisors,
+    # unless the people list already has all of them
+    if config.bulk_users and _has_complete_embeds(body):
+        _logger.info(f'Capturing User: "{body["targetName"]}".')
+        _update_user_admin(body)
+        a_user = body
+    else:
+        a_user = _get_user(body['id'], body['targetName'])
+    if a_user is None:
+        return None
+    return body, {'user': a_user}, False
+
+def _enrich_user(entry: tuple, include_devices: bool) -> tuple:
+    """Adds a User's Devices, the second stage of capturing a User
+
+    May be run concurrently by the enrich workers.
+
+    Args:
+        entry (tuple): The result of _fetch_user
+        include_devices (bool): If True, get the User's devices too
+
+    Return:
+        (dict, dict): The list entry and the User record
+    """
+    body, user_obj, reused = entry
+    if reused:
+        _update_user_admin(user_obj['user'])
+
+    # Get the devices, if requested
+    if include_devices and _capture.devices_by_owner is not None:
+        user_obj['devices'] = _capture.devices_by_owner.pop(body['id'], [])
+    elif include_devices and reused:
+        _update_device_admin(user_obj['devices'])
+    elif include_devices:
+        a_user = user_obj['user']
+        user_obj['devices'] = _get_user_devices(a_user['id'], a_user['targetName'])
+
+    return body, user_obj
+
 def _process_users(include_devices: bool):
     """Capture and save the instances User objects
 
     Retrieves the User object records from xMatters and saves them in
-    JSON payload format to the output file.
+    JSON payload format to the output file.  Each User goes through the
+    fetch, enrich, and encode stages, see _run_pipeline.
 
     Args:
         include_devices (bool): If True, get the User's devices too
@@ -266,59 +932,68 @@ def _process_users(include_devices: bool):
     Return:
         None
     """
+    if checkpoint.phase('users')['done']:
+        _logger.info('Users were already captured.')
+        incremental.recover_phase('users', {'devices': include_devices},
+                                  config.users_filename)
+        return
+
+    # Get every Device up front, rather than per User, counting any
+    # failures against the Users
+    failures = _capture.failures
+    if include_devices and config.bulk_devices:
+        _collect_devices()
+
     _logger.info('Begin gathering Users.')
-    users_file = _create_out_file(config.users_filename)
-    users_file.write('[\n')
+    users_file, progress = _open_phase_file('users', config.users_filename)
+    incremental.begin_phase('users', {'devices': include_devices})
+    if progress['written'] > 0:
+        incremental.recover('users', config.users_filename)
 
     # Initialize conditions
-    user_objects = []
     total_users = 0
-    cnt = 0
+    cnt = progress['written']
+    offset = first_offset = progress['offset']
     url = config.xmod_url + '/api/xm/1/people?offset=0&limit=' + str(config.page_size)
+    if config.bulk_users:
+        url += '&embed=' + ','.join(USER_EMBEDS)
+    if offset > 0:
+        url = _page_url(url, offset)
     _logger.debug('Gathering Users via url=%s', url)
-
-    while True:
-
-        # Get the user records
-        response = requests.get(url, auth=config.basic_auth)
-        if response.status_code not in [200, 404]:
-            _log_xm_error(url, response)
-            break
-
-        # Process the responses
-        bodys = response.json()
-        total_users = bodys['total']
-        if bodys['count'] > 0:
-            _logger.debug("%d Count of %d Total Users found via url=%s", bodys['count'], bodys['total'], url)
-            for body in bodys['data']:
-
-                # Get the full user object, including Roles and Supervisors
-                user_obj = {}
-                a_user = _get_user(body['id'], body['targetName'])
-                if a_user is not None:
-                    user_obj['user'] = a_user
-
-                    # Get the devices, if requested
-                    if include_devices:
-                        user_obj['devices'] = _get_user_devices(a_user['id'], a_user['targetName'])
-
-                    # Save the User
-                    cnt += 1
-                    json.dump(user_obj, users_file)
-                    users_file.write(',\n') if cnt < total_users else users_file.write('\n')
-
-            user_objects += bodys['data']
-
-        # See if there are any more to get
-        if 'links' in bodys and 'next' in bodys['links']:
-            url = config.xmod_url + bodys['links']['next']
-        else:
-            break
-            
-    _logger.info("Collected %d of a possible %d Users.", len(user_objects), total_users)
-
-    users_file.write(']')
-    users_file.close()
+    profiler.begin_phase('users')
+    metrics.begin_phase('users', offset)
+
+    def save_user(entry):
+        """Saves each User, and commits the checkpoint after each page"""
+        nonlocal total_users, cnt, offset
+        if isinstance(entry, pipeline.Marker):
+            count, total_users = entry.value
+            offset += count
+            sqlite_export.commit()
+            checkpoint.commit('users', offset, cnt, users_file, _capture.admin_objects)
+            metrics.progress('users', offset, total_users)
+            return
+        body, user_obj, text = entry
+        cnt += 1
+        users_file.write_encoded(text, writers.record_keys(user_obj))
+        sqlite_export.add('users', user_obj)
+        incremental.update('users', body)
+
+    _run_pipeline('users', url, [
+        ('fetch', _fetch_user),
+        ('enrich', lambda entry: _enrich_user(entry, include_devices)),
+        ('encode', _encode_entry)], save_user)
+
+    metrics.end_phase('users')
+    profiler.end_phase('users')
+
+    _logger.info("Collected %d of a possible %d Users.", offset - first_offset, total_users)
+    if _capture.devices_by_owner:
+        _logger.warning("%d Users own Devices but were not captured.", len(_capture.devices_by_owner))
+    _capture.devices_by_owner = None
+
+    _close_phase_file('users', users_file, offset, cnt, total_users, failures)
+    incremental.end_phase('users', config.users_filename, 'users' not in _capture.incomplete)
 
 def _get_group(group_id: str, target_name: str):
     """Attempst to retrieve Group by id.
@@ -338,9 +1013,10 @@ def _get_group(group_id: str, target_name: str):
     
     # Make the request
     try:
-        response = requests.get(url, auth=config.basic_auth)
+        response = xm_session.get(url)
     except requests.exceptions.RequestException as e:
-        _logger.error(config.ERR_REQUEST_EXCEPTION_CODE, url, repr(e))
+        _logger.error(config.ERR_REQUEST_EXCEPTION_MSG, url, repr(e))
+        _request_failed()
         return None
     
     # If the initial response fails, log and return null
@@ -349,7 +1025,7 @@ def _get_group(group_id: str, target_name: str):
         return None
     
     # Process the response
-    group_obj = response.json()
+    group_obj = _decode(response)
     # If present, translate the Site from an ID to a name
     if 'site' in group_obj:
         site_name = _lookup_site_name(group_obj['site']['id'])
@@ -378,36 +1054,68 @@ def _get_group_shifts(group_id: str, target_name: str):
     url = config.xmod_url + '/api/xm/1/groups/' + group_id + '/shifts/?embed=members,rotation&offset=0&limit=' + str(config.page_size)
     _logger.debug(f'Gathering Shifts for Group "{target_name}", url={url}')
 
-    while True:
-
-        # Get the site records
-        response = requests.get(url, auth=config.basic_auth)
-        if response.status_code not in [200, 404]:
-            _log_xm_error(url, response)
-            break
+    for bodys in _get_pages(url, f'Shifts for Group "{target_name}"'):
 
         # Process the responses
-        bodys = response.json()
         total_shifts = bodys['total']
-        if bodys['count'] > 0:
-            _logger.debug('%d Count of %d Total Shifts found for Group "%s" via url=%s', bodys['count'], bodys['total'], target_name, url)
-            shift_list += bodys['data']
-
-        # See if there are any more to get
-        if 'links' in bodys and 'next' in bodys['links']:
-            url = config.xmod_url + bodys['links']['next']
-        else:
-            break
+        shift_list += bodys['data']
 
     _logger.debug(f'Collected {len(shift_list)} of a possible {total_shifts} Shifts for Group "{target_name}".')
 
     return shift_list
 
+def _fetch_group(body: dict) -> tuple:
+    """Gets a Group's full record, the first stage of capturing a Group
+
+    Expands a Group entry from the groups list into the record that is
+    saved to the groups file.  May be run concurrently by the fetch workers.
+
+    Args:
+        body (dict): The Group entry from the groups list
+
+    Return:
+        (dict, dict, bool): The list entry, the Group record, and whether
+            the record is the previous snapshot's, or None if the Group was
+            not found
+    """
+    # Copy the Group forward from the previous snapshot if it is unchanged
+    group_obj = incremental.reuse('groups', body)
+    if group_obj is not None:
+        _logger.info(f"Reusing Group: {body['targetName']}")
+        return body, group_obj, True
+
+    # Get the full Group object, including Supervisors
+    a_group = _get_group(body['id'], body['targetName'])
+    if a_group is None:
+        return None
+    return body, {'group': a_group}, False
+
+def _enrich_group(entry: tuple) -> tuple:
+    """Adds a Group's Shifts, the second stage of capturing a Group
+
+    May be run concurrently by the enrich workers.
+
+    Args:
+        entry (tuple): The result of _fetch_group
+
+    Return:
+        (dict, dict): The list entry and the Group record
+    """
+    body, group_obj, reused = entry
+
+    # Get the shifts,
+    if not reused:
+        a_group = group_obj['group']
+        group_obj['shifts'] = _get_group_shifts(a_group['id'], a_group['targetName'])
+
+    return body, group_obj
+
 def _process_groups():
     """Capture and save the instances Group objects
 
     Retrieves the User's Group object records from xMatters and saves them in
-    JSON payload format to the output file.
+    JSON payload format to the output file.  Each Group goes through the
+    fetch, enrich, and encode stages, see _run_pipeline.
 
     Args:
         None
@@ -415,58 +1123,57 @@ def _process_groups():
     Return:
         None
     """
+    if checkpoint.phase('groups')['done']:
+        _logger.info('Groups were already captured.')
+        incremental.recover_phase('groups', {}, config.groups_filename)
+        return
+    _refresh_sites()
     _logger.info('Begin capturing Groups.')
-    groups_file = _create_out_file(config.groups_filename)
-    groups_file.write('[\n')
+    failures = _capture.failures
+    groups_file, progress = _open_phase_file('groups', config.groups_filename)
+    incremental.begin_phase('groups', {})
+    if progress['written'] > 0:
+        incremental.recover('groups', config.groups_filename)
 
     # Initialize conditions
-    group_objects = []
     total_groups = 0
-    cnt = 0
+    cnt = progress['written']
+    offset = first_offset = progress['offset']
     url = config.xmod_url + '/api/xm/1/groups?offset=0&limit=' + str(config.page_size)
+    if offset > 0:
+        url = _page_url(url, offset)
     _logger.debug('Gathering Groups via url=%s', url)
-
-    while True:
-
-        # Get the group records
-        response = requests.get(url, auth=config.basic_auth)
-        if response.status_code not in [200, 404]:
-            _log_xm_error(url, response)
-            break
-
-        # Process the responses
-        bodys = response.json()
-        total_groups = bodys['total']
-        if bodys['count'] > 0:
-            _logger.debug("%d Count of %d Total Groups found via url=%s", bodys['count'], bodys['total'], url)
-            for body in bodys['data']:
-
-                # Get the full Group object, including Roles and Supervisors
-                group_obj = {}
-                a_group = _get_group(body['id'], body['targetName'])
-                if a_group is not None:
-                    group_obj['group'] = a_group
-
-                    # Get the shifts,
-                    group_obj['shifts'] = _get_group_shifts(a_group['id'], a_group['targetName'])
-
-                    # Save the Group
-                    cnt += 1
-                    json.dump(group_obj, groups_file)
-                    groups_file.write(',\n') if cnt < total_groups else groups_file.write('\n')
-
-            group_objects += bodys['data']
-
-        # See if there are any more to get
-        if 'links' in bodys and 'next' in bodys['links']:
-            url = config.xmod_url + bodys['links']['next']
-        else:
-            break
-            
-    _logger.info(f"Collected {len(group_objects)} of a possible {total_groups} Groups.")
-
-    groups_file.write(']')
-    groups_file.close()
+    profiler.begin_phase('groups')
+    metrics.begin_phase('groups', offset)
+
+    def save_group(entry):
+        """Saves each Group, and commits the checkpoint after each page"""
+        nonlocal total_groups, cnt, offset
+        if isinstance(entry, pipeline.Marker):
+            count, total_groups = entry.value
+            offset += count
+            sqlite_export.commit()
+            checkpoint.commit('groups', offset, cnt, groups_file, _capture.admin_objects)
+            metrics.progress('groups', offset, total_groups)
+            return
+        body, group_obj, text = entry
+        cnt += 1
+        groups_file.write_encoded(text, writers.record_keys(group_obj))
+        sqlite_export.add('groups', group_obj)
+        incremental.update('groups', body)
+
+    _run_pipeline('groups', url, [
+        ('fetch', _fetch_group),
+        ('enrich', _enrich_group),
+        ('encode', _encode_entry)], save_group)
+
+    metrics.end_phase('groups')
+    profiler.end_phase('groups')
+
+    _logger.info(f"Collected {offset - first_offset} of a possible {total_groups} Groups.")
+
+    _close_phase_file('groups', groups_file, offset, cnt, total_groups, failures)
+    incremental.end_phase('groups', config.groups_filename, 'groups' not in _capture.incomplete)
 
 def _save_admin_data():
     """Saves the collected admin sets
@@ -480,17 +1187,18 @@ def _save_admin_data():
         None
     """
     admin_dict = {
-        'admins': list(_admin_objects['admins']),
-        'roles': list(_admin_objects['roles']),
-        'timezones': list(_admin_objects['timezones']),
-        'countries': list(_admin_objects['countries']),
-        'languages': list(_admin_objects['languages']),
-        'devices': list(_admin_objects['devices']),
-        'usps': list(_admin_objects['usps'])
+        'admins': list(_capture.admin_objects['admins']),
+        'roles': list(_capture.admin_objects['roles']),
+        'timezones': list(_capture.admin_objects['timezones']),
+        'countries': list(_capture.admin_objects['countries']),
+        'languages': list(_capture.admin_objects['languages']),
+        'devices': list(_capture.admin_objects['devices']),
+        'usps': list(_capture.admin_objects['usps'])
     }
     admin_file = _create_out_file(config.admin_filename)
     json.dump(admin_dict, admin_file, indent=2)
     admin_file.close()
+    sqlite_export.add_admin(admin_dict)
 
 def process(objects_to_process: list):
     """Capture objects for this instance.
@@ -503,38 +1211,65 @@ def process(objects_to_process: list):
     Args:
         objects_to_process (list): The list of object types to capture
     """
-    global _logger, _admin_objects # pylint: disable=global-statement
-
-    ### Get the current logger
-    _logger = common_logger.get_logger()
-
-    # Initialize the Admin object
-    _admin_objects = {
-        'admins': set(),
-        'roles': set(),
-        'timezones': set(),
-        'countries': set(),
-        'languages': set(),
-        'devices': set(),
-        'usps': set()
-    }
-
-    # Capture and save the Site objects
-    if 'sites' in objects_to_process:
-        _process_sites()
-
-    # Capture and save the User objects, and possibly devices
-    if 'users' in objects_to_process:
-        _process_users('devices' in objects_to_process)
-    elif 'devices' in objects_to_process:
-        _process_users(True)
-
-    # Capture and save the Device objects
-    if 'groups' in objects_to_process:
-        _process_groups()
-
-    # Preserve the collected admin data
-    _save_admin_data()
+    global _page_executor # pylint: disable=global-statement
+
+    json_codec.begin()
+    checkpoint.begin()
+    metrics.begin()
+    http_archive.begin()
+    incremental.begin()
+    sqlite_export.begin()
+    _begin_capture()
+    site_cache.load()
+    profiler.begin()
+    try:
+        if config.resume:
+            for a_type, values in checkpoint.admin_sets().items():
+                _capture.admin_objects[a_type].update(values)
+        if config.workers > 1:
+            _logger.debug('Capturing with %d workers', config.workers)
+            _page_executor = ThreadPoolExecutor(max_workers=config.workers,
+                                                thread_name_prefix='page')
+
+        # Capture and save the Site objects
+        if 'sites' in objects_to_process:
+            _process_sites()
+
+        # Capture and save the User objects, and possibly devices
+        if 'users' in objects_to_process:
+            _process_users('devices' in objects_to_process)
+        elif 'devices' in objects_to_process:
+            _process_users(True)
+
+        # Capture and save the Device objects
+        if 'groups' in objects_to_process:
+            _process_groups()
+
+        # Preserve the collected admin data and the run metrics
+        profiler.begin_phase('admin save')
+        _save_admin_data()
+        profiler.end_phase('admin save')
+        metrics.save(config.metrics_filename)
+        # An incomplete capture is not a snapshot to compare against
+        if not _capture.incomplete:
+            incremental.finish()
+        sqlite_export.finish()
+        site_cache.save()
+        checkpoint.finish()
+        http_archive.finish()
+    finally:
+        # Also when the capture raised, so the next one starts afresh
+        _close_open_files()
+        # Release the workers, and the pooled connections unless a daemon
+        # captures again with them
+        if _page_executor is not None:
+            _page_executor.shutdown()
+            _page_executor = None
+        if not config.daemon_interval:
+            xm_session.close()
+        metrics.finish()
+        profiler.finish()
+    _end_capture()
 
 def main():
     """In case we need to execute the module directly"""
@@ -0,0 +1,240 @@
+"""Profiles where the time of a capture goes, enabled with --profile.
+
+    Records the wall and CPU time of each phase of the capture (sites,
+    devices, users, groups, and saving the admin data), and the time spent
+    on the network, decoding and encoding JSON, logging, and exporting to
+    SQLite (with --sqlite).  The network and JSON times are summed over
+    every thread, so with several workers they can add up to more than the
+    wall time.
+
+    With --profile-stacks, the stacks of every thread are also sampled
+    at a fixed interval and saved in the folded format read by flame graph
+    tools (e.g. flamegraph.pl or speedscope).
+
+    The profile is saved as JSON in the output directory and summarized in
+    the log at the end of the capture.
+
+    Attributes:
+        enabled (bool): True while a capture is being profiled
+        __phases (dict): Wall and CPU seconds of each phase by name
+        __categories (dict): Seconds and calls of each kind of work
+        __stacks (Counter): Samples of each folded stack
+        __timed (tuple): The logger whose handle is timed, and the handle
+            it had of its own before, or None
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import collections
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import config
+import common_logger
+
+# Kinds of work timed across the capture
+CATEGORIES = ['network', 'json decode', 'json encode', 'logging', 'sqlite']
+# Seconds between samples of the thread stacks
+SAMPLE_INTERVAL = 0.01
+
+enabled = False
+__lock = threading.Lock()
+__started = None
+__phases = {}
+__open_phases = {}
+__categories = {}
+__stacks = collections.Counter()
+__sampler = None
+__sampler_stop = None
+__timed = None
+
+def _timed_handle(handle):
+    """Wraps Logger.handle to add its time to the logging category"""
+    def timed_handle(record):
+        started = time.perf_counter()
+        try:
+            return handle(record)
+        finally:
+            add('logging', time.perf_counter() - started)
+    return timed_handle
+
+def _stop():
+    """Stops sampling the stacks, and restores the logger's own handle
+
+    Safe to call more than once, e.g. when a capture that raised left
+    its profile running.
+    """
+    global __sampler, __timed # pylint: disable=global-statement
+    if __sampler is not None:
+        __sampler_stop.set()
+        __sampler.join()
+        __sampler = None
+    if __timed is not None:
+        logger, handle = __timed
+        if handle is None:
+            del logger.handle
+        else:
+            logger.handle = handle
+        __timed = None
+
+def begin():
+    """Starts profiling the capture, if config.profile is set
+
+    Args:
+
+    Returns:
+        None
+    """
+    global enabled, __started, __phases, __open_phases, __categories, __stacks # pylint: disable=global-statement
+    global __sampler, __sampler_stop, __timed # pylint: disable=global-statement
+    _stop()
+    enabled = config.profile
+    if not enabled:
+        return
+    __started = (time.perf_counter(), time.process_time())
+    __phases = {}
+    __open_phases = {}
+    __categories = {category: {'seconds': 0.0, 'calls': 0}
+                    for category in CATEGORIES}
+    __stacks = collections.Counter()
+    __sampler = None
+
+    logger = common_logger.get_logger()
+    __timed = (logger, vars(logger).get('handle'))
+    logger.handle = _timed_handle(logger.handle)
+
+    if config.profile_stacks:
+        __sampler_stop = threading.Event()
+        __sampler = threading.Thread(target=_sample_stacks,
+                                     args=(__sampler_stop,),
+                                     name='profiler', daemon=True)
+        __sampler.start()
+
+def begin_phase(name: str):
+    """Starts timing a phase
+
+    Args:
+        name (str): The phase, e.g. 'users'
+    """
+    if enabled:
+        __open_phases[name] = (time.perf_counter(), time.process_time())
+
+def end_phase(name: str):
+    """Stops timing a phase, adding to any earlier time for it
+
+    Args:
+        name (str): The phase, e.g. 'users'
+    """
+    if not enabled or name not in __open_phases:
+        return
+    wall_started, cpu_started = __open_phases.pop(name)
+    phase = __phases.setdefault(name, {'wallSeconds': 0.0, 'cpuSeconds': 0.0})
+    phase['wallSeconds'] += time.perf_counter() - wall_started
+    phase['cpuSeconds'] += time.process_time() - cpu_started
+
+def add(category: str, seconds: float):
+    """Adds time spent on a kind of work
+
+    Args:
+        category (str): One of CATEGORIES
+        seconds (float): Time spent
+    """
+    if enabled:
+        with __lock:
+            totals = __categories[category]
+            totals['seconds'] += seconds
+            totals['calls'] += 1
+
+def _sample_stacks(stop: threading.Event):
+    """Samples the stack of every other thread until stopped
+
+    Runs on the profiler thread.  Each stack is folded from the thread
+    name (without its pool number) down to the innermost function.
+
+    Args:
+        stop (Event): Set to stop sampling
+    """
+    me = threading.get_ident()
+    while not stop.wait(SAMPLE_INTERVAL):
+        names = {thread.ident: re.sub(r'[_-]\d+$', '', thread.name)
+                 for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items(): # pylint: disable=protected-access
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                        code.co_name))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread'))
+            __stacks[';'.join(reversed(stack))] += 1
+
+def summary() -> dict:
+    """Returns the profile collected so far
+
+    Args:
+
+    Returns:
+        dict: The wall and CPU time of the capture and each phase, and the
+            seconds and calls of each kind of work
+    """
+    wall_started, cpu_started = __started
+    with __lock:
+        categories = {category: {'seconds': round(totals['seconds'], 3),
+                                 'calls': totals['calls']}
+                      for category, totals in __categories.items()}
+    return {
+        'timeStr': config.time_str,
+        'wallSeconds': round(time.perf_counter() - wall_started, 3),
+        'cpuSeconds': round(time.process_time() - cpu_started, 3),
+        'phases': {name: {key: round(value, 3) for key, value in phase.items()}
+                   for name, phase in __phases.items()},
+        'categories': categories,
+        'stackSamples': sum(__stacks.values())
+    }
+
+def finish():
+    """Stops profiling, then saves and logs the profile
+
+    Args:
+
+    Returns:
+        None
+    """
+    global enabled # pylint: disable=global-statement
+    if not enabled:
+        return
+    _stop()
+    enabled = False
+    logger = common_logger.get_logger()
+
+    profile = summary()
+    with open(config.profile_filename, 'w') as profile_file:
+        json.dump(profile, profile_file, indent=2)
+    if __stacks:
+        with open(config.stacks_filename, 'w') as stacks_file:
+            for stack, count in __stacks.most_common():
+                stacks_file.write('%s %d\n' % (stack, count))
+
+    logger.info('Profile: %.3f seconds wall, %.3f seconds CPU.',
+                profile['wallSeconds'], profile['cpuSeconds'])
+    for name, phase in profile['phases'].items():
+        logger.info('Profile: %s took %.3f seconds wall, %.3f seconds CPU.',
+                    name, phase['wallSeconds'], phase['cpuSeconds'])
+    for category, totals in profile['categories'].items():
+        logger.info('Profile: %s took %.3f seconds over %d calls.',
+                    category, totals['seconds'], totals['calls'])
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""Splits the Users and Groups output into shards, with a manifest.
+
+    With --shards N, each User or Group goes to one of N shard files,
+    picked by a hash of its targetName, so the same object always lands in
+    the same shard from one capture to the next.  With --shard-records M,
+    a new shard file is started every M records instead.
+
+    Each shard is a complete Users or Groups file of its own, in the
+    configured record format and compression, named after the unsharded
+    file with the shard's number before the extension, e.g.
+    base.np.users.20240101-1200.shard-0003.json.gz.  Every shard has its
+    own writer thread, so the shards are compressed and written to disk in
+    parallel, and downstream jobs can read them concurrently.
+
+    When the phase is closed, a manifest is written next to the shards,
+    e.g. base.np.users.20240101-1200.manifest.json, listing each shard's
+    file name, record count, size, and SHA-256.
+
+    Files of a snapshot are found with filenames and read with
+    read_records, which work the same for sharded and unsharded snapshots.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import glob
+import hashlib
+import json
+import os
+
+import config
+import writers
+
+# Types of object whose output may be sharded
+KINDS = ['users', 'groups']
+# Added to a file name, before the extension, for each shard
+SHARD_SUFFIX = '.shard-%04d'
+# Replaces the extension of a file name for its manifest
+MANIFEST_SUFFIX = '.manifest.json'
+
+def sharded(kind: str) -> bool:
+    """Returns True if a type of object is written in shards
+
+    Args:
+        kind (str): The type of object, e.g. 'users'
+
+    Returns:
+        bool: True if config.shards or config.shard_records applies to kind
+    """
+    return kind in KINDS and bool(config.shards or config.shard_records)
+
+def _split(filename: str):
+    """Splits a file name into its stem and its record and compression extension"""
+    for format_extension in writers.FORMAT_EXTENSIONS.values():
+        for extension in writers.EXTENSIONS.values():
+            if extension and filename.endswith(format_extension + extension):
+                return filename[:-len(format_extension + extension)], format_extension + extension
+        if filename.endswith(format_extension):
+            return filename[:-len(format_extension)], format_extension
+    return os.path.splitext(filename)
+
+def shard_filename(filename: str, index: int) -> str:
+    """Returns the name of a shard of an output file
+
+    Args:
+        filename (str): The unsharded output file name
+        index (int): The number of the shard, from 0
+
+    Returns:
+        str: The shard's file name
+    """
+    stem, extension = _split(filename)
+    return stem + SHARD_SUFFIX % index + extension
+
+def manifest_filename(filename: str) -> str:
+    """Returns the name of the manifest of a sharded output file
+
+    Args:
+        filename (str): The unsharded output file name
+
+    Returns:
+        str: The manifest's file name
+    """
+    return _split(filename)[0] + MANIFEST_SUFFIX
+
+def filenames(filename: str) -> list:
+    """Returns the files that hold the records of an output file
+
+    Args:
+        filename (str): The unsharded output file name
+
+    Returns:
+        list: The shards listed in the manifest, or the shards found on
+            disk if there is no manifest yet, or filename itself if it
+            was not sharded, or an empty list if none of them exist
+    """
+    directory = os.path.dirname(filename)
+    try:
+        with open(manifest_filename(filename)) as manifest_file:
+            manifest = json.load(manifest_file)
+        return [os.path.join(directory, shard['filename']) for shard in manifest['files']]
+    except FileNotFoundError:
+        pass
+    stem, extension = _split(filename)
+    found = sorted(glob.glob(glob.escape(stem) + '.shard-[0-9]*' + glob.escape(extension)))
+    if found:
+        return found
+    return [filename] if os.path.exists(filename) else []
+
+def exists(filename: str) -> bool:
+    """Returns True if an output file, or any of its shards, exists"""
+    return bool(filenames(filename))
+
+def read_records(filename: str):
+    """Reads the records of an output file, or of each of its shards in turn
+
+    Args:
+        filename (str): The unsharded output file name
+
+    Return:
+        record (dict): Each record, see writers.read_records
+    """
+    for shard in filenames(filename):
+        yield from writers.read_records(shard)
+
+def shard_index(key: str, count: int) -> int:
+    """Returns the shard a targetName is written to with --shards
+
+    The hash does not change between runs, unlike the built-in hash.
+
+    Args:
+        key (str): The targetName of a User or Group
+        count (int): The number of shards
+
+    Returns:
+        int: The number of the shard, from 0
+    """
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+class ShardedWriter(object):
+    """Writes records to shard files, as a RecordWriter writes to one file
+
+    Args:
+        kind (str): The type of object, 'users' or 'groups'
+        filename (str): The unsharded output file name
+        position (list): If given, the [position, written] of each shard
+            returned by sync, to append to the existing shards
+        written (int): The number of records already in the shards
+    """
+    def __init__(self, kind: str, filename: str, position: list = None,
+                 written: int = 0):
+        self.name = filename
+        self.written = written
+        self._kind = kind
+        self._shards = []
+        for index, (shard_position, shard_written) in enumerate(position or []):
+            self._shards.append(writers.RecordWriter(
+                shard_filename(filename, index), position=shard_position,
+                written=shard_written, checksum=True))
+        if config.shards and len(self._shards) not in (0, config.shards):
+            self.close(manifest=False)
+            raise ValueError('The interrupted capture wrote %d shards of %s, not %d'
+                             % (len(self._shards), kind, config.shards))
+        # Shards started after the last checkpoint are started again
+        index = len(self._shards)
+        while config.shard_records and os.path.exists(shard_filename(filename, index)):
+            os.remove(shard_filename(filename, index))
+            index += 1
+        while len(self._shards) < (config.shards or 0):
+            self._shards.append(writers.RecordWriter(
+                shard_filename(filename, len(self._shards)), checksum=True))
+        # Until it is written again, the shards on disk are the listing
+        if os.path.exists(manifest_filename(filename)):
+            os.remove(manifest_filename(filename))
+
+    def _shard(self, key: str) -> writers.RecordWriter:
+        """Returns the shard the next record, with targetName key, goes to"""
+        if config.shards:
+            return self._shards[shard_index(key, len(self._shards))]
+        if not self._shards or self._shards[-1].written >= config.shard_records:
+            self._shards.append(writers.RecordWriter(
+                shard_filename(self.name, len(self._shards)), checksum=True))
+        return self._shards[-1]
+
+    def write_record(self, record: dict):
+        """Writes a single record
+
+        Args:
+            record (dict): The record to write
+        """
+        self.write_encoded(writers.encode_record(record), writers.record_keys(record))
+
+    def write_encoded(self, data: bytes, keys: tuple = ()):
+        """Writes a single record already encoded by writers.encode_record
+
+        Args:
+            data (bytes): The record's JSON
+            keys (tuple): The record's id and targetName, see
+                writers.record_keys, which pick the shard with --shards
+        """
+        self._shard(keys[1] if keys else None).write_encoded(data, keys)
+        self.written += 1
+
+    def sync(self) -> list:
+        """Writes every record so far to disk, see writers.OutputFile.sync
+
+        Returns:
+            list: The [position, written] of each shard, which may be
+                passed back in to append to the shards later
+        """
+        return [[shard.sync(), shard.written] for shard in self._shards]
+
+    def close(self, manifest: bool = True):
+        """Closes every shard, and writes the manifest
+
+        Args:
+            manifest (bool): If False, the manifest is not written
+        """
+        for shard in self._shards:
+            shard.close()
+        if not manifest:
+            return
+        contents = {
+            'timeStr': config.time_str,
+            'kind': self._kind,
+            'format': config.output_format,
+            'compression': config.compression,
+            'records': self.written}
+        if config.shards:
+            contents['shardBy'] = 'targetName'
+            contents['shards'] = config.shards
+        else:
+            contents['shardBy'] = 'records'
+            contents['shardRecords'] = config.shard_records
+        contents['files'] = [{'filename': os.path.basename(shard.name),
+                              'records': shard.written,
+                              'bytes': os.path.getsize(shard.name),
+                              'sha256': shard.sha256} for shard in self._shards]
+        temp_filename = manifest_filename(self.name) + '.tmp'
+        with open(temp_filename, 'w') as manifest_file:
+            json.dump(contents, manifest_file, indent=2)
+        os.replace(temp_filename, manifest_filename(self.name))
+
+def open_writer(kind: str, filename: str, position=None, written: int = 0):
+    """Opens the output file for a type of object, sharded if configured
+
+    Args:
+        kind (str): The type of object, e.g. 'users'
+        filename (str): The unsharded output file name
+        position (int or list): If given, append from this synced position,
+            as returned by the writer's sync
+        written (int): The number of records already written
+
+    Returns:
+        RecordWriter or ShardedWriter: The output file
+
+    Raises:
+        ValueError: If position was saved by a capture that was sharded
+            differently
+    """
+    if position is not None and isinstance(position, list) != sharded(kind):
+        raise ValueError('The interrupted capture of %s was %s, use the same '
+                         'sharding options to resume it' %
+                         (kind, 'sharded' if isinstance(position, list) else 'not sharded'))
+    if sharded(kind):
+        return ShardedWriter(kind, filename, position=position, written=written)
+    return writers.RecordWriter(filename, position=position, written=written)
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Caches Site names by ID, across captures.
+
+    Groups refer to their Site by ID, but are saved with the Site's name.
+    The names are cached here, filled from the Sites list (either by the
+    Sites phase or by a single paginated sweep before the Groups phase),
+    so that Groups do not need to request their Site one at a time.
+
+    The cache is saved in the output directory at the end of a capture and
+    loaded by the next one, as long as it was filled from a complete sweep
+    of the Sites list within config.site_cache_ttl seconds.
+
+    A Site that is not in the cache is requested on its own.  A Site that
+    xMatters reports as not found is remembered for the rest of the
+    capture, but other failures are not remembered, so the next Group with
+    that Site asks again.  A process that captures more than once (see
+    daemon.py) keeps the cache in memory while it is fresh.
+
+    Attributes:
+        __names (dict): Site names by ID
+        __missing (set): IDs of Sites that were not found in this capture
+        __refreshed (float): When the Sites list was last swept, in seconds
+            since the epoch, or None
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import os
+import threading
+import time
+
+import config
+import common_logger
+
+__lock = threading.Lock()
+__names = {}
+__missing = set()
+__refreshed = None
+
+def load():
+    """Loads the cache saved by an earlier capture, if it is still fresh
+
+    The cache of an earlier capture by this process is kept as it is.
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __names, __missing, __refreshed # pylint: disable=global-statement
+    __missing = set()
+    if is_fresh():
+        return
+    __names = {}
+    __refreshed = None
+    if not config.site_cache_ttl:
+        return
+    try:
+        with open(config.site_cache_filename) as cache_file:
+            saved = json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return
+    if time.time() - saved['refreshed'] < config.site_cache_ttl:
+        __names = saved['sites']
+        __refreshed = saved['refreshed']
+        common_logger.get_logger().info(
+            'Loaded %d Site names from %s.', len(__names), config.site_cache_filename)
+
+def is_fresh() -> bool:
+    """Returns True if the Sites list was swept within the TTL
+
+    Args:
+
+    Returns:
+        bool: True if the cache does not need a refresh
+    """
+    return (__refreshed is not None and
+            time.time() - __refreshed < max(config.site_cache_ttl, 0))
+
+def update(sites: list):
+    """Adds the Sites from a page of the Sites list
+
+    Args:
+        sites (list): The Site records
+    """
+    with __lock:
+        for site in sites:
+            __names[site['id']] = site['name']
+            __missing.discard(site['id'])
+
+def refreshed():
+    """Records that every page of the Sites list has been added
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __refreshed # pylint: disable=global-statement
+    __refreshed = time.time()
+
+def get(site_id: str):
+    """Returns a cached Site name
+
+    Args:
+        site_id (str): The ID of the Site
+
+    Returns:
+        (bool, str): Whether the Site is known, and its name, which is None
+            if the Site was not found
+    """
+    name = __names.get(site_id)
+    if name is not None:
+        return True, name
+    return site_id in __missing, None
+
+def put(site_id: str, name: str):
+    """Caches a Site name, or that the Site was not found
+
+    Args:
+        site_id (str): The ID of the Site
+        name (str): The Site's name, or None if xMatters did not find it
+    """
+    with __lock:
+        if name is None:
+            __missing.add(site_id)
+        else:
+            __names[site_id] = name
+
+def save():
+    """Saves the cache for the next capture
+
+    Only a cache that was filled from a sweep of the Sites list is saved.
+
+    Args:
+
+    Returns:
+        None
+    """
+    if not config.site_cache_ttl or __refreshed is None:
+        return
+    with __lock:
+        saved = {'refreshed': __refreshed, 'sites': dict(__names)}
+    temp_filename = config.site_cache_filename + '.tmp'
+    with open(temp_filename, 'w') as cache_file:
+        json.dump(saved, cache_file)
+    os.replace(temp_filename, config.site_cache_filename)
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+"""Reports what changed between two captured snapshots.
+
+    Compares the Sites, Users, and Groups of two snapshots of an instance
+    and reports, for each type of object, the ones that were added and
+    removed, and for each changed one which fields, Devices, Shifts, etc.
+    changed, e.g.
+
+    $ python3 snapshot_diff.py out/my-instance.np.20181219-0307 \\
+          out/my-instance.np.20181220-0307 -o changes.json
+
+    A snapshot is named by its files' common prefix and time stamp (or by
+    any one of its files), and may be in either record format, compressed,
+    and sharded.
+
+    Neither snapshot is loaded whole.  The records are first split by a
+    hash of their id into partitions on disk, then each partition of the
+    older snapshot is loaded and the same partition of the newer one is
+    streamed past it.  Both steps run in parallel worker processes, and
+    there are enough partitions that each fits in the memory given to a
+    worker.  Records are only decoded when they differ.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import argparse
+import concurrent.futures
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+
+import json_codec
+import shards
+import writers
+
+# Types of object compared, and the key their name is reported under
+KINDS = {'sites': 'name', 'users': 'targetName', 'groups': 'targetName'}
+# Megabytes of the older snapshot's records a worker may hold at once
+DEFAULT_MEMORY = 256
+# Uncompressed bytes estimated for each byte of a compressed file
+COMPRESSION_RATIO = 10
+# The name of a file of a snapshot, with its prefix and time stamp
+_SNAPSHOT_FILE = re.compile(r'^(.*)\.(?:sites|users|groups|devices|admin|metrics|'
+                            r'fingerprints|changes|profile)\.(\d{8}-\d{4})(\..*)?$')
+
+def snapshot_prefix(name: str) -> str:
+    """Returns the prefix of a snapshot's files from the snapshot's name
+
+    Args:
+        name (str): Either the output directory, base name, instance type,
+            and time stamp of the snapshot, e.g. out/my-instance.np.20181220-0307,
+            or the name of any of its files
+
+    Returns:
+        str: E.g. out/my-instance.np.20181220-0307
+    """
+    match = _SNAPSHOT_FILE.match(name)
+    if match:
+        return match.group(1) + '.' + match.group(2)
+    return name
+
+def snapshot_files(prefix: str, kind: str) -> list:
+    """Returns the files that hold a type of object in a snapshot
+
+    Args:
+        prefix (str): The snapshot, see snapshot_prefix
+        kind (str): The type of object, e.g. 'users'
+
+    Returns:
+        list: The record file, or its shards, or an empty list if the
+            snapshot did not capture kind
+    """
+    stem, time_str = prefix.rsplit('.', 1)
+    for format_extension in writers.FORMAT_EXTENSIONS.values():
+        for extension in writers.EXTENSIONS.values():
+            found = shards.filenames(stem + '.' + kind + '.' + time_str +
+                                     format_extension + extension)
+            if found:
+                return found
+    return []
+
+def _estimate(filename: str) -> int:
+    """Returns the estimated uncompressed size of a record file"""
+    size = os.path.getsize(filename)
+    if writers.compression_of(filename) != 'none':
+        size *= COMPRESSION_RATIO
+    return size
+
+def _partition_filename(directory: str, side: str, kind: str, number: int,
+                        partition: int) -> str:
+    """Returns the name of the part of a partition from one record file"""
+    return os.path.join(directory, '%s.%s.%d.%d' % (side, kind, number, partition))
+
+def _partition(task: tuple) -> int:
+    """Splits the records of a file into partitions by a hash of their id
+
+    Runs in a worker process.  Each line of a partition is a record's id,
+    as JSON, a tab, and the record's JSON as it was in the file.
+
+    Args:
+        task (tuple): The directory, side ('old' or 'new'), type of object,
+            number of the file, file name, and number of partitions
+
+    Returns:
+        int: The number of records
+    """
+    directory, side, kind, number, filename, partitions = task
+    parts = [open(_partition_filename(directory, side, kind, number, partition), 'wb')
+             for partition in range(partitions)]
+    count = 0
+    try:
+        for data in writers.read_encoded(filename):
+            record_id = writers.record_keys(json_codec.loads(data))[0]
+            parts[writers.index_hash(record_id) % partitions].write(
+                json_codec.dumps(record_id) + b'\t' + data + b'\n')
+            count += 1
+    finally:
+        for part in parts:
+            part.close()
+    return count
+
+def _read_partition(filenames: list):
+    """Reads the (id, record JSON) of each record in the parts of a partition"""
+    for filename in filenames:
+        with open(filename, 'rb') as part:
+            for line in part:
+                record_id, _, data = line.rstrip(b'\n').partition(b'\t')
+                yield record_id, data
+
+def _name(item: dict) -> str:
+    """Returns what an object in a list (e.g. a Device) is reported as"""
+    return item.get('targetName') or item.get('name') or item.get('id')
+
+def _compare_lists(old: list, new: list):
+    """Compares two lists of objects, by id if they have one
+
+    Returns:
+        dict or bool: The names of the objects that were added, removed,
+            and changed, or True if the lists differ but are not objects
+            with ids
+    """
+    if not all(isinstance(item, dict) and 'id' in item for item in old + new):
+        return True
+    old_items = {item['id']: item for item in old}
+    new_items = {item['id']: item for item in new}
+    changes = {
+        'added': sorted(_name(item) for item_id, item in new_items.items()
+                        if item_id not in old_items),
+        'removed': sorted(_name(item) for item_id, item in old_items.items()
+                          if item_id not in new_items),
+        'changed': sorted(_name(item) for item_id, item in new_items.items()
+                          if item_id in old_items and old_items[item_id] != item)}
+    return {change: names for change, names in changes.items() if names}
+
+def compare(old: dict, new: dict) -> dict:
+    """Compares two records of the same object
+
+    Args:
+        old (dict): The record in the older snapshot
+        new (dict): The record in the newer snapshot
+
+    Returns:
+        dict: For each top level field that changed, e.g. 'user' or
+            'devices', the names of the fields within it that changed if
+            it is an object, the added, removed, and changed objects (see
+            _compare_lists) if it is a list, or True otherwise.  Empty if
+            the records are the same.
+    """
+    changes = {}
+    for field in list(old) + [field for field in new if field not in old]:
+        old_value, new_value = old.get(field), new.get(field)
+        if old_value == new_value:
+            continue
+        if isinstance(old_value, dict) and isinstance(new_value, dict):
+            changes[field] = sorted(
+                key for key in set(old_value) | set(new_value)
+                if old_value.get(key) != new_value.get(key))
+        elif isinstance(old_value, list) and isinstance(new_value, list):
+            changes[field] = _compare_lists(old_value, new_value)
+        else:
+            changes[field] = True
+    return changes
+
+def _summary(kind: str, record: dict) -> dict:
+    """Returns the id and name a record is reported with"""
+    record_id, name = writers.record_keys(record)
+    return {'id': record_id, KINDS[kind]: name}
+
+def _compare_partition(task: tuple) -> tuple:
+    """Compares a partition of the older snapshot with the newer one's
+
+    Runs in a worker process.  Only the older partition is held in memory.
+
+    Args:
+        task (tuple): The type of object, and the parts of the old and of
+            the new partition
+
+    Returns:
+        (str, dict): The type of object, and its added, removed, changed,
+            and number of unchanged records in the partition
+    """
+    kind, old_parts, new_parts = task
+    old = dict(_read_partition(old_parts))
+    result = {'added': [], 'removed': [], 'changed': [], 'unchanged': 0}
+    for record_id, data in _read_partition(new_parts):
+        old_data = old.pop(record_id, None)
+        if old_data is None:
+            result['added'].append(_summary(kind, json_codec.loads(data)))
+        elif old_data == data:
+            result['unchanged'] += 1
+        else:
+            new_record = json_codec.loads(data)
+            changes = compare(json_codec.loads(old_data), new_record)
+            if changes:
+                result['changed'].append(dict(_summary(kind, new_record), changes=changes))
+            else:
+                result['unchanged'] += 1
+    for data in old.values():
+        result['removed'].append(_summary(kind, json_codec.loads(data)))
+    return kind, result
+
+def diff(old: str, new: str, kinds: list = None, workers: int = None,
+         memory: int = DEFAULT_MEMORY, temp_dir: str = None) -> dict:
+    """Compares two snapshots
+
+    Args:
+        old (str): The older snapshot, see snapshot_prefix
+        new (str): The newer snapshot
+        kinds (list): The types of object to compare, defaults to KINDS
+        workers (int): Worker processes, defaults to the number of CPUs
+        memory (int): Megabytes of records each worker may hold at once
+        temp_dir (str): Where to put the partitions, defaults to the
+            system's temporary directory
+
+    Returns:
+        dict: With the time stamps of the snapshots, and for each type of
+            object in both snapshots the 'added', 'removed', and 'changed'
+            records (each with its id and name, and its changes, see
+            compare) sorted by name, and the number 'unchanged'
+    """
+    old, new = snapshot_prefix(old), snapshot_prefix(new)
+    workers = workers or os.cpu_count() or 1
+    report = {'old': old.rsplit('.', 1)[1], 'new': new.rsplit('.', 1)[1]}
+    files = {}
+    for kind in kinds or list(KINDS):
+        old_files, new_files = snapshot_files(old, kind), snapshot_files(new, kind)
+        if old_files and new_files:
+            files[kind] = {'old': old_files, 'new': new_files}
+        elif old_files or new_files:
+            print('Skipping %s, which are only in the %s snapshot.' %
+                  (kind, 'old' if old_files else 'new'), file=sys.stderr)
+
+    with tempfile.TemporaryDirectory(prefix='snapshot-diff-', dir=temp_dir) as directory, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # Enough partitions to keep the workers busy and within memory
+        partitions = {
+            kind: max(workers, math.ceil(sum(_estimate(filename) for filename in sides['old'])
+                                         / (memory * 1024 * 1024)))
+            for kind, sides in files.items()}
+        tasks = [(directory, side, kind, number, filename, partitions[kind])
+                 for kind, sides in files.items()
+                 for side, filenames in sides.items()
+                 for number, filename in enumerate(filenames)]
+        list(executor.map(_partition, tasks))
+
+        tasks = [(kind,
+                  [_partition_filename(directory, 'old', kind, number, partition)
+                   for number in range(len(sides['old']))],
+                  [_partition_filename(directory, 'new', kind, number, partition)
+                   for number in range(len(sides['new']))])
+                 for kind, sides in files.items()
+                 for partition in range(partitions[kind])]
+        for kind in files:
+            report[kind] = {'added': [], 'removed': [], 'changed': [], 'unchanged': 0}
+        for kind, result in executor.map(_compare_partition, tasks):
+            for change in ('added', 'removed', 'changed'):
+                report[kind][change].extend(result[change])
+            report[kind]['unchanged'] += result['unchanged']
+
+    for kind in files:
+        for change in ('added', 'removed', 'changed'):
+            report[kind][change].sort(key=lambda summary, kind=kind: (
+                str(summary[KINDS[kind]]), str(summary['id'])))
+    return report
+
+def main():
+    """Compares the snapshots given on the command line"""
+    parser = argparse.ArgumentParser(
+        description='Reports what changed between two captured snapshots.')
+    parser.add_argument('old',
+                        help=('The older snapshot, e.g. out/my-instance.np.20181219-0307, '
+                              'or any of its files'))
+    parser.add_argument('new', help='The newer snapshot')
+    parser.add_argument('-k', '--kinds', default=','.join(KINDS),
+                        help='The types of object to compare [default: %(default)s]')
+    parser.add_argument('-m', '--memory', type=int, default=DEFAULT_MEMORY,
+                        help=('Megabytes of records each worker may hold at once '
+                              '[default: %(default)s]'))
+    parser.add_argument('-o', '--output',
+                        help='Save the report to this file rather than printing it')
+    parser.add_argument('-t', '--temp-dir',
+                        help='Where to put the partitions [default: the system temp directory]')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Worker processes [default: the number of CPUs]')
+    args = parser.parse_args()
+
+    kinds = args.kinds.split(',')
+    for kind in kinds:
+        if kind not in KINDS:
+            parser.error('kinds must be one of: ' + ', '.join(KINDS))
+    report = diff(args.old, args.new, kinds, args.workers, args.memory, args.temp_dir)
+    for kind in KINDS:
+        if kind in report:
+            print('%s: %d added, %d removed, %d changed, %d unchanged.' % (
+                kind, len(report[kind]['added']), len(report[kind]['removed']),
+                len(report[kind]['changed']), report[kind]['unchanged']), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""Looks up single records in a captured snapshot by id or targetName.
+
+    A capture run with --index writes an index next to each Sites, Users,
+    and Groups file (see writers.RecordIndex), so one record can be read
+    without loading the whole file.  The index and the record file are
+    memory mapped, the key is found by a binary search of the index, and
+    only that record is decoded.  For a compressed file, only the block
+    that holds the record is decompressed.
+
+    Files captured without --index can be indexed afterwards with --build,
+    as long as they hold one record per line, which is how this utility
+    writes them.
+
+    Lookup a User by targetName (or id) from the command line:
+
+    $ python3 snapshot_index.py my-instance.np.users.20181220-0307.json.gz jsmith
+
+    A sharded snapshot is looked up through its unsharded file name, and
+    each of its shards is searched in turn.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import argparse
+import bz2
+import gzip
+import json
+import lzma
+import mmap
+import os
+import sys
+
+import json_codec
+import shards
+import writers
+
+# Decompresses a whole member of a file, by compression
+DECOMPRESS = {'gzip': gzip.decompress, 'bz2': bz2.decompress, 'xz': lzma.decompress}
+
+def _map(filename: str):
+    """Memory maps a file for reading, or returns b'' if it is empty"""
+    with open(filename, 'rb') as in_file:
+        if os.fstat(in_file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+class Index(object):
+    """An indexed record file, opened for lookups
+
+    Args:
+        filename (str): Name of the record file, whose index is filename
+            plus writers.INDEX_EXTENSION
+        keys (function): Returns the keys of a record, as it was indexed
+
+    Raises:
+        FileNotFoundError: If the file or its index does not exist
+        ValueError: If the index is not an index
+    """
+    def __init__(self, filename: str, keys=writers.record_keys):
+        self.name = filename
+        self._keys = keys
+        self._compression = writers.compression_of(filename)
+        self._index = _map(filename + writers.INDEX_EXTENSION)
+        if self._index[:len(writers.INDEX_MAGIC)] != writers.INDEX_MAGIC:
+            raise ValueError(filename + writers.INDEX_EXTENSION + ' is not an index')
+        _, self._entries, self._members = writers.INDEX_HEADER.unpack_from(self._index)
+        self._members_at = (writers.INDEX_HEADER.size +
+                            self._entries * writers.INDEX_ENTRY.size)
+        self._data = _map(filename)
+        # The last member decompressed, as (number, data)
+        self._cached = (None, b'')
+
+    def __len__(self) -> int:
+        return self._entries
+
+    def _entry(self, number: int) -> tuple:
+        """Returns the (key hash, offset, length) of an index entry"""
+        return writers.INDEX_ENTRY.unpack_from(
+            self._index, writers.INDEX_HEADER.size + number * writers.INDEX_ENTRY.size)
+
+    def _member(self, number: int) -> tuple:
+        """Returns the (uncompressed start, compressed start) of a member"""
+        return writers.INDEX_MEMBER.unpack_from(
+            self._index, self._members_at + number * writers.INDEX_MEMBER.size)
+
+    def _find(self, key_hash: int) -> int:
+        """Returns the first entry whose key hash is not less than key_hash"""
+        low, high = 0, self._entries
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < key_hash:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _decompress(self, number: int) -> bytes:
+        """Returns the uncompressed data of a member"""
+        if self._cached[0] != number:
+            start = self._member(number)[1]
+            end = (self._member(number + 1)[1] if number + 1 < self._members
+                   else len(self._data))
+            self._cached = (number, DECOMPRESS[self._compression](self._data[start:end]))
+        return self._cached[1]
+
+    def _read(self, offset: int, length: int) -> bytes:
+        """Returns length bytes of the uncompressed file from offset"""
+        if self._compression == 'none':
+            return self._data[offset:offset + length]
+        # The last member that starts at or before offset
+        low, high = 0, self._members
+        while low < high:
+            middle = (low + high) // 2
+            if self._member(middle)[0] <= offset:
+                low = middle + 1
+            else:
+                high = middle
+        number = low - 1
+        parts = []
+        while length > 0 and 0 <= number < self._members:
+            start = offset - self._member(number)[0]
+            part = self._decompress(number)[start:start + length]
+            parts.append(part)
+            offset += len(part)
+            length -= len(part)
+            number += 1
+        return b''.join(parts)
+
+    def records(self, key: str):
+        """Yields each record with a key, in the order of the file
+
+        Args:
+            key (str): The id, or the targetName (or name, for a Site)
+
+        Returns:
+            dict: Each record with key
+        """
+        key_hash = writers.index_hash(key)
+        number = self._find(key_hash)
+        while number < self._entries:
+            entry_hash, offset, length = self._entry(number)
+            if entry_hash != key_hash:
+                break
+            record = json_codec.loads(self._read(offset, length))
+            if key in self._keys(record):
+                yield record
+            number += 1
+
+    def get(self, key: str) -> dict:
+        """Returns the record with an id or targetName
+
+        Args:
+            key (str): The id, or the targetName (or name, for a Site)
+
+        Returns:
+            dict: The record, or None if there is none with key
+        """
+        for record in self.records(key):
+            return record
+        return None
+
+    def close(self):
+        """Unmaps the index and the record file"""
+        for mapped in (self._index, self._data):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        self._cached = (None, b'')
+
+def build(filename: str) -> int:
+    """Writes the index of a record file that was captured without one
+
+    Args:
+        filename (str): Name of the record file
+
+    Returns:
+        int: The number of index entries, two per record unless a record's
+            id and targetName are the same
+
+    Raises:
+        ValueError: If the file does not hold one record per line
+    """
+    index, members, _ = writers.index_records(filename)
+    index.write(filename + writers.INDEX_EXTENSION, members)
+    return len(index)
+
+def lookup(filename: str, key: str) -> dict:
+    """Returns a record from a snapshot file, or from any of its shards
+
+    Args:
+        filename (str): Name of the record file, or the unsharded name of a
+            sharded one
+        key (str): The id, or the targetName (or name, for a Site)
+
+    Returns:
+        dict: The record, or None if there is none with key
+
+    Raises:
+        FileNotFoundError: If a file or its index does not exist
+    """
+    for shard in shards.filenames(filename) or [filename]:
+        index = Index(shard)
+        try:
+            record = index.get(key)
+        finally:
+            index.close()
+        if record is not None:
+            return record
+    return None
+
+def main():
+    """Looks up the records given on the command line, or builds indexes"""
+    parser = argparse.ArgumentParser(
+        description='Looks up records in a captured snapshot by id or targetName.')
+    parser.add_argument('filename',
+                        help=('The Sites, Users, or Groups file, or the '
+                              'unsharded name of a sharded one'))
+    parser.add_argument('keys', nargs='*', metavar='KEY',
+                        help='The id or targetName (name for Sites) of each record')
+    parser.add_argument('--build', action='store_true',
+                        help=('Index the file (or each of its shards) first, '
+                              'e.g. if it was captured without --index'))
+    args = parser.parse_args()
+
+    if args.build:
+        for shard in shards.filenames(args.filename) or [args.filename]:
+            print('Indexed %d keys of %s.' % (build(shard), shard), file=sys.stderr)
+    missing = 0
+    for key in args.keys:
+        record = lookup(args.filename, key)
+        if record is None:
+            print('%s was not found.' % key, file=sys.stderr)
+            missing += 1
+        else:
+            print(json.dumps(record, indent=2, ensure_ascii=False))
+    return 1 if missing else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+"""Exports the captured data to normalized SQLite tables.
+
+    With --sqlite, every Site, User, and Group written to the output files
+    is also added to a SQLite database next to them (e.g.
+    my-instance.np.20181220-0307.sqlite), so audits become indexed queries
+    rather than a parse of the whole snapshot, e.g. the Users without an
+    SMS Device:
+
+        SELECT target_name FROM users WHERE NOT EXISTS (
+            SELECT 1 FROM devices
+            WHERE devices.user_id = users.id AND device_type = 'TEXT_PHONE')
+
+    or the Groups in a Site that have no Shifts:
+
+        SELECT target_name FROM groups WHERE site_name = 'Site 0' AND
+            NOT EXISTS (SELECT 1 FROM shifts WHERE shifts.group_id = groups.id)
+
+    Each table has the columns most often queried, and a data column with
+    the object's full JSON for the rest (see SQLite's JSON functions).
+    Timeframes and Shift members have no id of their own, so they are
+    keyed by their ordinal, their place in their Device's or Shift's list,
+    since neither a name nor a position need be unique or present.
+
+    Rows are buffered and inserted with executemany, a page of records per
+    transaction, committed just before the capture's checkpoint, and the
+    secondary indexes are only built once the capture is done.  Rows are
+    inserted or replaced by their primary key, so a resumed capture can
+    add a page again without duplicating it.
+
+    Attributes:
+        __connection (Connection): The database, or None if not exporting
+        __pending (dict): Rows waiting to be inserted, by table
+        __buffered (int): Records waiting to be inserted
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import os
+import sqlite3
+import time
+
+import config
+import common_logger
+import json_codec
+import profiler
+
+# Records buffered before they are inserted without waiting for a commit
+BATCH_RECORDS = 1000
+
+# The columns and the primary key of each table
+TABLES = {
+    'sites': ('id TEXT, name TEXT, status TEXT, country TEXT, language TEXT, '
+              'timezone TEXT, data TEXT', 'id'),
+    'users': ('id TEXT, target_name TEXT, first_name TEXT, last_name TEXT, '
+              'external_key TEXT, recipient_type TEXT, status TEXT, language TEXT, '
+              'timezone TEXT, site_id TEXT, data TEXT', 'id'),
+    'roles': ('user_id TEXT, name TEXT', 'user_id, name'),
+    'supervisors': ('recipient_id TEXT, supervisor_id TEXT, supervisor_target_name TEXT',
+                    'recipient_id, supervisor_id'),
+    'devices': ('id TEXT, user_id TEXT, target_name TEXT, name TEXT, device_type TEXT, '
+                'status TEXT, provider_id TEXT, data TEXT', 'id'),
+    'timeframes': ('device_id TEXT, ordinal INTEGER, name TEXT, start_time TEXT, '
+                   'duration_in_minutes INTEGER, days TEXT, timezone TEXT',
+                   'device_id, ordinal'),
+    'groups': ('id TEXT, target_name TEXT, description TEXT, recipient_type TEXT, '
+               'status TEXT, site_name TEXT, data TEXT', 'id'),
+    'shifts': ('id TEXT, group_id TEXT, name TEXT, start TEXT, end TEXT, '
+               'rotation_type TEXT, data TEXT', 'id'),
+    'shift_members': ('shift_id TEXT, ordinal INTEGER, position INTEGER, member_id TEXT, '
+                      'member_target_name TEXT', 'shift_id, ordinal'),
+    'admin': ('name TEXT, value TEXT', 'name, value')
+}
+# Secondary indexes, built once the capture is done
+INDEXES = {
+    'sites': ['name'],
+    'users': ['target_name', 'site_id', 'status'],
+    'roles': ['name'],
+    'supervisors': ['supervisor_id'],
+    'devices': ['user_id', 'device_type', 'target_name'],
+    'groups': ['target_name', 'site_name'],
+    'shifts': ['group_id'],
+    'shift_members': ['member_id']
+}
+
+__connection = None
+__pending = {}
+__buffered = 0
+
+def _insert_sql(table: str) -> str:
+    """Returns the statement that inserts or replaces a row of a table"""
+    columns = TABLES[table][0].count(',') + 1
+    return 'INSERT OR REPLACE INTO %s VALUES (%s)' % (table, ', '.join('?' * columns))
+
+def begin():
+    """Opens the database at config.sqlite_filename, if exporting
+
+    A new capture starts a new database, a resumed capture adds to the
+    interrupted capture's database.
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __connection, __pending, __buffered # pylint: disable=global-statement
+    finish()
+    __pending = {table: [] for table in TABLES}
+    __buffered = 0
+    if not config.sqlite_filename:
+        return
+    if not config.resume:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(config.sqlite_filename + suffix):
+                os.remove(config.sqlite_filename + suffix)
+    __connection = sqlite3.connect(config.sqlite_filename)
+    __connection.execute('PRAGMA journal_mode=WAL')
+    __connection.execute('PRAGMA synchronous=NORMAL')
+    with __connection:
+        for table, (columns, key) in TABLES.items():
+            __connection.execute('CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY (%s))'
+                                 % (table, columns, key))
+    common_logger.get_logger().info('Exporting to %s.', config.sqlite_filename)
+
+def _json(value) -> str:
+    """Returns the JSON text of a value, for a data column"""
+    return json_codec.dumps(value).decode('utf-8')
+
+def _add_supervisors(recipient_id: str, obj: dict):
+    """Adds the supervisors of a User or Group"""
+    for supervisor in (obj.get('supervisors') or {}).get('data', []):
+        __pending['supervisors'].append(
+            (recipient_id, supervisor.get('id'), supervisor.get('targetName')))
+
+def _add_site(site: dict):
+    """Adds a Site record"""
+    __pending['sites'].append((
+        site.get('id'), site.get('name'), site.get('status'), site.get('country'),
+        site.get('language'), site.get('timezone'), _json(site)))
+
+def _add_user(record: dict):
+    """Adds a User record, with its Roles, Supervisors, Devices, and Timeframes"""
+    user = record['user']
+    __pending['users'].append((
+        user.get('id'), user.get('targetName'), user.get('firstName'),
+        user.get('lastName'), user.get('externalKey'), user.get('recipientType'),
+        user.get('status'), user.get('language'), user.get('timezone'),
+        (user.get('site') or {}).get('id'), _json(user)))
+    for role in (user.get('roles') or {}).get('data', []):
+        __pending['roles'].append((user['id'], role.get('name')))
+    _add_supervisors(user['id'], user)
+    for device in record.get('devices') or []:
+        __pending['devices'].append((
+            device.get('id'), user['id'], device.get('targetName'), device.get('name'),
+            device.get('deviceType'), device.get('status'),
+            (device.get('provider') or {}).get('id'), _json(device)))
+        for ordinal, timeframe in enumerate(device.get('timeframes') or []):
+            __pending['timeframes'].append((
+                device['id'], ordinal, timeframe.get('name'), timeframe.get('startTime'),
+                timeframe.get('durationInMinutes'), ','.join(timeframe.get('days') or []),
+                timeframe.get('timezone')))
+
+def _add_group(record: dict):
+    """Adds a Group record, with its Supervisors, Shifts, and Shift members"""
+    group = record['group']
+    site = group.get('site')
+    __pending['groups'].append((
+        group.get('id'), group.get('targetName'), group.get('description'),
+        group.get('recipientType'), group.get('status'),
+        site.get('name') if isinstance(site, dict) else site, _json(group)))
+    _add_supervisors(group['id'], group)
+    for shift in record.get('shifts') or []:
+        __pending['shifts'].append((
+            shift.get('id'), group['id'], shift.get('name'), shift.get('start'),
+            shift.get('end'), (shift.get('rotation') or {}).get('type'), _json(shift)))
+        for ordinal, member in enumerate((shift.get('members') or {}).get('data', [])):
+            __pending['shift_members'].append((
+                shift['id'], ordinal, member.get('position'),
+                (member.get('member') or {}).get('id'),
+                (member.get('member') or {}).get('targetName')))
+
+def add(kind: str, record: dict):
+    """Adds a saved record, if exporting
+
+    Called by the thread that writes the output files.
+
+    Args:
+        kind (str): The type of object, 'sites', 'users', or 'groups'
+        record (dict): The record, as written to the output file
+    """
+    global __buffered # pylint: disable=global-statement
+    if __connection is None:
+        return
+    if kind == 'sites':
+        _add_site(record)
+    elif kind == 'users':
+        _add_user(record)
+    else:
+        _add_group(record)
+    __buffered += 1
+    if __buffered >= BATCH_RECORDS:
+        commit()
+
+def add_admin(admin_dict: dict):
+    """Replaces the admin sets, if exporting
+
+    Args:
+        admin_dict (dict): Lists of admin values by set name
+    """
+    if __connection is None:
+        return
+    with __connection:
+        __connection.execute('DELETE FROM admin')
+        __connection.executemany(_insert_sql('admin'), [
+            (name, value) for name, values in admin_dict.items() for value in values])
+
+def commit():
+    """Inserts the buffered rows in a single transaction
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    global __buffered # pylint: disable=global-statement
+    if __connection is None or __buffered == 0:
+        return
+    started = time.perf_counter()
+    with __connection:
+        for table, rows in __pending.items():
+            if rows:
+                __connection.executemany(_insert_sql(table), rows)
+                rows.clear()
+    __buffered = 0
+    profiler.add('sqlite', time.perf_counter() - started)
+
+def finish():
+    """Inserts the last rows, builds the indexes, and closes the database
+
+    Args:
+
+    Returns:
+        None
+    """
+    global __connection # pylint: disable=global-statement
+    if __connection is None:
+        return
+    commit()
+    started = time.perf_counter()
+    with __connection:
+        for table, columns in INDEXES.items():
+            for column in columns:
+                __connection.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                                     % (table, column, table, column))
+    __connection.execute('ANALYZE')
+    __connection.close()
+    __connection = None
+    profiler.add('sqlite', time.perf_counter() - started)
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
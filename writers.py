@@ -0,0 +1,575 @@
+"""Writes the captured data to output files, optionally compressed.
+
+    Also reads back the records of an earlier snapshot, see read_records.
+
+    Records are written either as a JSON array (one record per line
+    between the brackets) or as newline delimited JSON, one record per
+    line with nothing else, so the file can be streamed with constant
+    memory.
+
+    Records are encoded by json_codec, and the output is buffered in
+    memory, and large blocks are handed to a background thread that
+    compresses them and writes them to disk, so neither the many small
+    writes nor compression hold up requests to the instance.
+
+    Compressed output is written as a series of compressed members (gzip,
+    bz2, and xz all allow concatenated members).  Each call to sync ends
+    the current member, so the file can be truncated at any synced
+    position and appended to later, which is what resuming a capture
+    relies on.
+
+    With config.index, each record file also gets a sidecar index (the
+    file name plus INDEX_EXTENSION), written when the file is closed,
+    which maps the id and targetName (or name) of each record to its
+    offset and length in the uncompressed file.  Each block of an indexed
+    compressed file is its own member, and the index lists where each
+    member starts, so a record can be read by decompressing a single
+    block.  See snapshot_index.py for the lookups.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import array
+import bz2
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+import config
+import json_codec
+import profiler
+
+# File name extension added for each kind of compression
+EXTENSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'bz2': '.bz2',
+    'xz': '.xz'
+}
+# File name extension for each record format
+FORMAT_EXTENSIONS = {
+    'json': '.json',
+    'ndjson': '.ndjson'
+}
+# Bytes buffered before a block is handed to the writer thread
+BLOCK_SIZE = 1024 * 1024
+# Blocks waiting for the writer thread before write() blocks
+QUEUE_BLOCKS = 8
+# File name extension added to a record file for its index, and the index
+# layout: the header, then the entries sorted by key hash, then the members
+INDEX_EXTENSION = '.idx'
+INDEX_MAGIC = b'xmindex1'
+INDEX_HEADER = struct.Struct('<8sQQ') # magic, entries, members
+INDEX_ENTRY = struct.Struct('<QQQ') # key hash, record offset, record length
+INDEX_MEMBER = struct.Struct('<QQ') # uncompressed start, compressed start
+
+def _compressor(compression: str):
+    """Returns a new compressor object for a member, or None
+
+    Args:
+        compression (str): One of the EXTENSIONS keys
+
+    Returns:
+        object: With compress(data) and flush() methods
+    """
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == 'bz2':
+        return bz2.BZ2Compressor()
+    if compression == 'xz':
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+    return None
+
+def _decompressor(compression: str):
+    """Returns a new decompressor object for a member
+
+    Args:
+        compression (str): One of the EXTENSIONS keys other than 'none'
+
+    Returns:
+        object: With decompress(data), eof, and unused_data
+    """
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+def compression_of(filename: str) -> str:
+    """Returns the compression of a file, from its file name extension
+
+    Args:
+        filename (str): Name of the file
+
+    Returns:
+        str: One of the EXTENSIONS keys
+    """
+    for compression, extension in EXTENSIONS.items():
+        if extension and filename.endswith(extension):
+            return compression
+    return 'none'
+
+class OutputFile(object):
+    """Buffered, optionally compressed, output file
+
+    Args:
+        filename (str): Name of file to hold output
+        compression (str): One of the EXTENSIONS keys, defaults to
+            config.compression
+        position (int): If given, the existing file is truncated to this
+            synced position and appended to, rather than replaced
+        checksum (bool): If True, the SHA-256 of the file is computed as
+            it is written, see sha256
+        members (list): If given, each block is compressed as its own
+            member, and the [uncompressed start, compressed start] of each
+            member is added to this list
+        offset (int): The uncompressed size of the file at position
+
+    Attributes:
+        offset (int): The uncompressed bytes written so far
+        members (list): As given
+    """
+    def __init__(self, filename: str, compression: str = None,
+                 position: int = None, checksum: bool = False,
+                 members: list = None, offset: int = 0):
+        self.name = filename
+        self.offset = offset
+        self.members = members
+        self._compression = compression or config.compression or 'none'
+        self._hash = hashlib.sha256() if checksum else None
+        if position is None:
+            self._file = open(filename, 'wb')
+        else:
+            self._file = open(filename, 'r+b')
+            self._file.truncate(position)
+            if self._hash is not None:
+                while self._file.tell() < position:
+                    self._hash.update(self._file.read(BLOCK_SIZE))
+            self._file.seek(position)
+        self._buffer = []
+        self._buffered = 0
+        self._error = None
+        self._blocks = queue.Queue(maxsize=QUEUE_BLOCKS)
+        self._thread = threading.Thread(target=self._write_blocks,
+                                        name='writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def sha256(self) -> str:
+        """The hex SHA-256 of the file, once closed, or None without checksum"""
+        return self._hash.hexdigest() if self._hash is not None else None
+
+    def _put(self, data: bytes):
+        """Writes data to the file, on the writer thread"""
+        self._file.write(data)
+        if self._hash is not None:
+            self._hash.update(data)
+
+    def _write_blocks(self):
+        """Compresses and writes blocks until told to stop
+
+        Runs on the writer thread.  A block of None ends the current member
+        and syncs the file, a block of False stops the thread.
+        """
+        compressor = None
+        offset = self.offset
+        while True:
+            block = self._blocks.get()
+            try:
+                if self._error is not None:
+                    # Drain the queue after an error, but still stop when told
+                    if block is False:
+                        return
+                    continue
+                if block is None or block is False:
+                    if compressor is not None:
+                        self._put(compressor.flush())
+                        compressor = None
+                    self._file.flush()
+                    if block is None:
+                        os.fsync(self._file.fileno())
+                elif self._compression != 'none':
+                    if compressor is None:
+                        compressor = _compressor(self._compression)
+                        if self.members is not None:
+                            self.members.append([offset, self._file.tell()])
+                    self._put(compressor.compress(block))
+                    if self.members is not None:
+                        self._put(compressor.flush())
+                        compressor = None
+                else:
+                    self._put(block)
+                if block:
+                    offset += len(block)
+            except Exception as e: # pylint: disable=broad-except
+                self._error = e
+            finally:
+                self._blocks.task_done()
+            if block is False:
+                return
+
+    def _check(self):
+        """Raises the error hit by the writer thread, if any"""
+        if self._error is not None:
+            raise self._error
+
+    def _hand_off(self):
+        """Hands the buffered output to the writer thread"""
+        if self._buffer:
+            self._blocks.put(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def write(self, text: str):
+        """Encodes and buffers text, handing off full blocks
+
+        Args:
+            text (str): The output to write
+        """
+        self.write_bytes(text.encode('utf-8'))
+
+    def write_bytes(self, data: bytes):
+        """Buffers data, handing off full blocks
+
+        Args:
+            data (bytes): The encoded output to write
+        """
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.offset += len(data)
+        if self._buffered >= BLOCK_SIZE:
+            self._check()
+            self._hand_off()
+
+    def sync(self) -> int:
+        """Writes everything so far to disk, ending the compressed member
+
+        Returns:
+            int: The position in the file, which may be passed back in to
+                append to the file later
+        """
+        self._hand_off()
+        self._blocks.put(None)
+        self._blocks.join()
+        self._check()
+        return self._file.tell()
+
+    def close(self):
+        """Writes everything to disk and closes the file"""
+        if self._file.closed:
+            return
+        self._hand_off()
+        self._blocks.put(False)
+        self._thread.join()
+        self._file.close()
+        self._check()
+
+def encode_record(record: dict) -> bytes:
+    """Encodes a record as it is written by RecordWriter
+
+    Lets the encoding be done on another thread than the writing, e.g. by
+    the workers of a capture pipeline.
+
+    Args:
+        record (dict): The record to encode
+
+    Returns:
+        bytes: The record's JSON, on a single line
+    """
+    started = time.perf_counter()
+    data = json_codec.dumps(record)
+    profiler.add('json encode', time.perf_counter() - started)
+    return data
+
+def record_keys(record: dict) -> tuple:
+    """Returns the keys a record is indexed and sharded by
+
+    Args:
+        record (dict): A Site, User, Group, or Device record
+
+    Returns:
+        tuple: The id and the targetName (the name for a Site) of the
+            record, either of which may be None
+    """
+    obj = record.get('user') or record.get('group') or record
+    return obj.get('id'), obj.get('targetName', obj.get('name'))
+
+def index_hash(key: str) -> int:
+    """Returns the hash a key is found by in an index"""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(),
+                          'little')
+
+class RecordIndex(object):
+    """The index of a record file, built as the records are written
+
+    The entries are kept in an array of integers, three per key, so the
+    index of a large file takes little memory until it is sorted.
+    """
+    def __init__(self):
+        self._entries = array.array('Q')
+
+    def __len__(self) -> int:
+        return len(self._entries) // 3
+
+    def add(self, keys: tuple, offset: int, length: int):
+        """Adds a record
+
+        Args:
+            keys (tuple): The keys of the record, see record_keys
+            offset (int): Where the record starts in the uncompressed file
+            length (int): The length of the record's JSON
+        """
+        for key in dict.fromkeys(keys):
+            if key is not None:
+                self._entries.extend((index_hash(key), offset, length))
+
+    def write(self, filename: str, members: list):
+        """Writes the index file
+
+        Args:
+            filename (str): Name of the index file
+            members (list): The [uncompressed start, compressed start] of
+                each member of the record file, empty if not compressed
+        """
+        entries = self._entries
+        ordered = sorted(zip(entries[0::3], entries[1::3], entries[2::3]))
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as index_file:
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(ordered), len(members)))
+            index_file.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in ordered))
+            index_file.write(b''.join(INDEX_MEMBER.pack(*member) for member in members))
+        os.replace(temp_filename, filename)
+
+def _decompressed(filename: str, limit: int, members: list):
+    """Reads a file a chunk at a time, decompressing it
+
+    Args:
+        filename (str): Name of the file to read
+        limit (int): Where to stop reading, or None to read it all
+        members (list): The [uncompressed start, compressed start] of each
+            compressed member read is added to this list
+
+    Return:
+        bytes: Each chunk of uncompressed data
+    """
+    compression = compression_of(filename)
+    decompressor = None
+    produced = 0
+    read = 0
+    data = b''
+    with open(filename, 'rb') as in_file:
+        while True:
+            if not data:
+                size = BLOCK_SIZE if limit is None else min(BLOCK_SIZE, limit - read)
+                data = in_file.read(size) if size > 0 else b''
+                read += len(data)
+                if not data:
+                    return
+            if compression == 'none':
+                chunk, data = data, b''
+            else:
+                if decompressor is None:
+                    decompressor = _decompressor(compression)
+                    members.append([produced, read - len(data)])
+                chunk = decompressor.decompress(data)
+                data = b''
+                if decompressor.eof:
+                    data = decompressor.unused_data
+                    decompressor = None
+            produced += len(chunk)
+            yield chunk
+
+def _index_line(index: RecordIndex, line: bytes, offset: int, keys):
+    """Adds the record on a line of a record file to an index, if any"""
+    start = len(line) - len(line.lstrip(b' \t\r['))
+    data = line[start:].rstrip(b' \t\r,]')
+    if data:
+        index.add(keys(json_codec.loads(data)), offset + start, len(data))
+
+def index_records(filename: str, limit: int = None, keys=record_keys):
+    """Indexes a record file that was written one record per line
+
+    Used when appending to a file, and by snapshot_index.py to index a
+    file that was written without an index.
+
+    Args:
+        filename (str): Name of the record file
+        limit (int): Where to stop reading, e.g. a synced position, or None
+            to read it all
+        keys (function): Returns the keys of a record, see record_keys
+
+    Returns:
+        (RecordIndex, list, int): The index of the records, the
+            [uncompressed start, compressed start] of each member, and the
+            uncompressed size read
+
+    Raises:
+        ValueError: If the file does not hold one record per line
+    """
+    index = RecordIndex()
+    members = []
+    offset = 0
+    pending = b''
+    for chunk in _decompressed(filename, limit, members):
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            _index_line(index, line, offset, keys)
+            offset += len(line) + 1
+    _index_line(index, pending, offset, keys)
+    return index, members, offset + len(pending)
+
+class RecordWriter(object):
+    """Writes records to an output file in the configured record format
+
+    For the JSON array format, the separator is written before each record
+    after the first, so a skipped record never leaves a trailing comma.
+
+    Args:
+        filename (str): Name of file to hold output
+        output_format (str): One of the FORMAT_EXTENSIONS keys, defaults to
+            config.output_format
+        position (int): If given, append to the existing file from this
+            synced position, as with OutputFile
+        written (int): The number of records already in the file
+        checksum (bool): If True, the SHA-256 of the file is computed, as
+            with OutputFile
+        index (bool): If True, the file's index is written when it is
+            closed, defaults to config.index
+    """
+    def __init__(self, filename: str, output_format: str = None,
+                 position: int = None, written: int = 0, checksum: bool = False,
+                 index: bool = None):
+        self._format = output_format or config.output_format or 'json'
+        self._index = None
+        members = None
+        offset = 0
+        if config.index if index is None else index:
+            if position is None:
+                self._index, members = RecordIndex(), []
+            else:
+                self._index, members, offset = index_records(filename, position)
+        self._file = OutputFile(filename, position=position, checksum=checksum,
+                                members=members, offset=offset)
+        self.name = self._file.name
+        self.written = written
+        if position is None and self._format == 'json':
+            self._file.write('[\n')
+
+    def write_record(self, record: dict):
+        """Writes a single record
+
+        Args:
+            record (dict): The record to write
+        """
+        self.write_encoded(encode_record(record), record_keys(record))
+
+    def write_encoded(self, data: bytes, keys: tuple = ()):
+        """Writes a single record already encoded by encode_record
+
+        Args:
+            data (bytes): The record's JSON
+            keys (tuple): The record's keys, see record_keys, which are
+                needed if the file is indexed
+        """
+        if self._format == 'json' and self.written > 0:
+            self._file.write_bytes(b',\n')
+        if self._index is not None:
+            self._index.add(keys, self._file.offset, len(data))
+        self._file.write_bytes(data)
+        if self._format == 'ndjson':
+            self._file.write_bytes(b'\n')
+        self.written += 1
+
+    def sync(self) -> int:
+        """Writes every record so far to disk, see OutputFile.sync
+
+        Returns:
+            int: The position in the file
+        """
+        return self._file.sync()
+
+    @property
+    def sha256(self) -> str:
+        """The hex SHA-256 of the file, see OutputFile.sha256"""
+        return self._file.sha256
+
+    def close(self):
+        """Finishes the record format and closes the file"""
+        if self._format == 'json':
+            self._file.write('\n]' if self.written > 0 else ']')
+        self._file.close()
+        if self._index is not None:
+            self._index.write(self.name + INDEX_EXTENSION, self._file.members or [])
+
+def _open_records(filename: str):
+    """Opens a record file for reading bytes, decompressing it by extension"""
+    openers = {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+    return openers.get(compression_of(filename), open)(filename, 'rb')
+
+def read_encoded(filename: str):
+    """Reads the records of a file written one record per line, undecoded
+
+    Lets the records be passed on or compared without decoding them all,
+    e.g. by snapshot_diff.py.
+
+    Args:
+        filename (str): Name of the file to read
+
+    Return:
+        data (bytes): Each record's JSON, in file order
+    """
+    with _open_records(filename) as in_file:
+        for line in in_file:
+            line = line.strip()
+            if line.startswith(b'['):
+                line = line[1:]
+            if line.endswith(b']'):
+                line = line[:-1]
+            line = line.rstrip(b',')
+            if line:
+                yield line
+
+def read_records(filename: str):
+    """Reads the records of a Sites, Users, or Groups file
+
+    The compression is found from the file name extension.  Both record
+    formats are read a line at a time, which also works for a file that
+    was cut off at a synced position, e.g. by an interrupted capture.
+    Files that were not written one record per line (e.g. indented JSON)
+    are read whole.
+
+    Args:
+        filename (str): Name of the file to read
+
+    Return:
+        record (dict): Each record, in file order
+    """
+    read = 0
+    try:
+        for data in read_encoded(filename):
+            record = json_codec.loads(data)
+            read += 1
+            yield record
+        return
+    except ValueError:
+        if read > 0:
+            raise
+    with _open_records(filename) as in_file:
+        yield from json.load(in_file)
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""Creates and manages a singleton HTTP session for xMatters requests.
+
+    Every request to the xMatters instance goes through the shared session
+    so that connections are kept alive and reused instead of paying for a
+    new TCP and TLS handshake on each call.
+
+    Requests are also paced by a shared scheduler.  It limits the request
+    rate with a token bucket (when a rate limit is configured) and the
+    number of requests in flight, and adapts both to throttling: a 429
+    pauses every caller for the Retry-After period and halves the limits,
+    while runs of successful requests slowly raise them again.  Throttled,
+    5xx, and failed connection attempts are retried with jittered
+    exponential backoff.
+
+    Every response can also be recorded to, or answered from, an archive,
+    see http_archive.
+
+    Attributes:
+        __session (Session): Holds the instance of the shared session
+        __scheduler (_Scheduler): Paces the requests on the shared session
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import asyncio
+import collections
+import email.utils
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+import common_logger
+import http_archive
+import instances
+import metrics
+import profiler
+
+# Responses that are retried, after backing off
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Successful requests needed before the limits are raised again
+RAISE_AFTER = 50
+
+__session = None
+__scheduler = None
+__session_lock = threading.Lock()
+
+class _Scheduler(object):
+    """Paces the requests made by every caller of the shared session
+
+    Args:
+        max_in_flight (int): The most requests that may be in flight
+        rate_limit (float): The most requests per second, or None
+    """
+    def __init__(self, max_in_flight: int, rate_limit: float = None):
+        self._cond = threading.Condition()
+        self._max_in_flight = max_in_flight
+        self._in_flight_limit = max_in_flight
+        self._in_flight = 0
+        self._max_rate = rate_limit
+        self._rate = rate_limit
+        self._tokens = 1.0
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._successes = 0
+
+    def _refill(self, now: float):
+        """Adds the tokens earned since the last refill"""
+        if self._rate is not None:
+            self._tokens = min(max(self._rate, 1.0),
+                               self._tokens + (now - self._refilled) * self._rate)
+        self._refilled = now
+
+    def _admit(self, now: float):
+        """Lets a request be sent now, or says how long to wait
+
+        Called with the condition held.
+
+        Args:
+            now (float): The time.monotonic() time
+
+        Returns:
+            (bool, float): True if the request may be sent, else False and
+                the seconds to wait, or None to wait for a release
+        """
+        self._refill(now)
+        if now < self._paused_until:
+            return False, self._paused_until - now
+        if self._in_flight >= self._in_flight_limit:
+            return False, None
+        if self._rate is not None and self._tokens < 1.0:
+            return False, (1.0 - self._tokens) / self._rate
+        self._in_flight += 1
+        if self._rate is not None:
+            self._tokens -= 1.0
+        return True, None
+
+    def _notify(self):
+        """Wakes the waiting callers, called with the condition held"""
+        self._cond.notify_all()
+
+    def acquire(self):
+        """Waits until a request may be sent"""
+        with self._cond:
+            while True:
+                admitted, wait = self._admit(time.monotonic())
+                if admitted:
+                    return
+                self._cond.wait(wait)
+
+    def release(self):
+        """Records that a request is no longer in flight"""
+        with self._cond:
+            self._in_flight -= 1
+            self._notify()
+
+    def succeeded(self):
+        """Raises the limits a step after a run of successful requests"""
+        with self._cond:
+            self._successes += 1
+            if self._successes < RAISE_AFTER:
+                return
+            self._successes = 0
+            if self._in_flight_limit < self._max_in_flight:
+                self._in_flight_limit += 1
+            if self._rate is not None and self._rate < self._max_rate:
+                self._rate = min(self._max_rate, self._rate * 1.1)
+            self._notify()
+
+    def throttled(self, retry_after: float):
+        """Pauses every caller, and halves the limits once per pause
+
+        The requests in flight when xMatters starts throttling are
+        usually all throttled, so a 429 that arrives while already paused
+        only extends the pause.
+
+        Args:
+            retry_after (float): Seconds to pause for
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._successes = 0
+            new_pause = now >= self._paused_until
+            if new_pause:
+                self._in_flight_limit = max(1, self._in_flight_limit // 2)
+                if self._rate is not None:
+                    self._rate = max(0.1, self._rate / 2)
+            self._paused_until = max(self._paused_until, now + retry_after)
+        if new_pause:
+            common_logger.get_logger().warning(
+                'Throttled by xMatters, pausing %.1f seconds and allowing %d '
+                'requests in flight.', retry_after, self._in_flight_limit)
+
+class _AsyncScheduler(_Scheduler):
+    """Paces the requests of the asyncio engine, as _Scheduler does threads
+
+    Every method but acquire is called from the event loop, and does not
+    block, so the limits and backoff are the same as for the threads.
+
+    Args:
+        max_in_flight (int): The most requests that may be in flight
+        rate_limit (float): The most requests per second, or None
+    """
+    def __init__(self, max_in_flight: int, rate_limit: float = None):
+        super().__init__(max_in_flight, rate_limit)
+        self._waiters = collections.deque()
+
+    def _notify(self):
+        """Wakes as many waiting coroutines as may now be sent, in order
+
+        Waking them all would have each of the many coroutines the engine
+        starts check again on every release, to admit just one of them.
+        """
+        free = self._in_flight_limit - self._in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            # A waiter that timed out or was cancelled is done already
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def acquire(self): # pylint: disable=invalid-overridden-method
+        """Waits, without blocking the event loop, until a request may be sent"""
+        while True:
+            with self._cond:
+                admitted, wait = self._admit(time.monotonic())
+                if admitted:
+                    return
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, wait)
+            except asyncio.TimeoutError:
+                pass
+
+def async_scheduler() -> _AsyncScheduler:
+    """Returns a scheduler for the requests of the asyncio engine
+
+    Sized from config.max_requests, and rate limited as the shared session.
+
+    Args:
+
+    Returns:
+        _AsyncScheduler: A new scheduler, used by one event loop
+    """
+    return _AsyncScheduler(config.max_requests, config.rate_limit
+                           if http_archive.real_time() else None)
+
+def retry_after(headers) -> float:
+    """Returns the seconds to wait from a Retry-After header, or None
+
+    Args:
+        headers (Mapping): The headers of a 429 response
+
+    Returns:
+        float: Seconds to wait
+    """
+    value = headers.get('Retry-After')
+    if value is None or not http_archive.real_time():
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def backoff(attempt: int) -> float:
+    """Returns a jittered exponential backoff, in seconds, for an attempt"""
+    if not http_archive.real_time():
+        return 0.0
+    return random.uniform(0, min(config.backoff_cap,
+                                 config.backoff_base * (2 ** attempt)))
+
+def get_session() -> requests.Session:
+    """Returns the existing session or creates a new one if the first time
+
+    The connection pool is sized from the number of workers in the config
+    object (the fetch and enrich stage workers, and the page workers) plus
+    one for the list reader, so that every concurrent caller can hold a
+    kept-alive connection to the instance.
+
+    Args:
+
+    Returns:
+        Session: __session
+    """
+    global __session, __scheduler # pylint: disable=global-statement
+    with __session_lock:
+        if __session is None:
+            workers = config.workers or 1
+            stage_workers = config.stage_workers or {}
+            pool_size = (stage_workers.get('fetch', workers) +
+                         stage_workers.get('enrich', workers) + workers + 1)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                  pool_block=True)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.auth = config.basic_auth
+            __scheduler = _Scheduler(pool_size, config.rate_limit
+                                     if http_archive.real_time() else None)
+            __session = session
+    return __session
+
+def get(url: str) -> requests.Response:
+    """Issues a GET on the shared session using the default timeouts
+
+    Waits on the scheduler, and on the budget shared with other instances
+    when capturing several, before each attempt.  Throttled, 5xx, and
+    failed connection attempts are retried up to config.max_retries times.
+    Each attempt is recorded in the request metrics, and in the archive
+    when recording.  When replaying, the archive answers instead.
+
+    Args:
+        url (str): The location to request
+
+    Returns:
+        Response: The response from xMatters, or the last failed response
+            once the retries are used up
+    """
+    session = get_session()
+    scheduler = __scheduler
+    attempt = 0
+    while True:
+        scheduler.acquire()
+        instances.acquire()
+        started = time.monotonic()
+        try:
+            if http_archive.replaying():
+                response = http_archive.replay(url)
+            else:
+                response = session.get(
+                    url, timeout=(config.connect_timeout, config.read_timeout))
+            elapsed = time.monotonic() - started
+            metrics.record_request(url, response.status_code,
+                                   len(response.content), elapsed)
+            profiler.add('network', elapsed)
+            http_archive.record(url, response.status_code, response.headers,
+                                response.content, elapsed)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            elapsed = time.monotonic() - started
+            metrics.record_request(url, None, 0, elapsed)
+            profiler.add('network', elapsed)
+            http_archive.record_failure(url, e, elapsed)
+            if attempt >= config.max_retries:
+                raise
+            reason = repr(e)
+            delay = backoff(attempt)
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                scheduler.succeeded()
+                return response
+            if attempt >= config.max_retries:
+                return response
+            reason = 'status ' + str(response.status_code)
+            delay = backoff(attempt)
+            if response.status_code == 429:
+                wait = retry_after(response.headers)
+                if wait is not None:
+                    delay = wait
+                scheduler.throttled(delay)
+        finally:
+            instances.release()
+            scheduler.release()
+
+        attempt += 1
+        common_logger.get_logger().warning(
+            'Retrying (%d of %d) in %.1f seconds after %s from %s',
+            attempt, config.max_retries, delay, reason, url)
+        if delay > 0:
+            time.sleep(delay)
+
+def close():
+    """Closes the shared session and releases its pooled connections"""
+    global __session, __scheduler # pylint: disable=global-statement
+    with __session_lock:
+        if __session is not None:
+            __session.close()
+            __session = None
+            __scheduler = None
+
+def main():
+    """ Only needed by convention """
+    pass
+
+if __name__ == '__main__':
+    main()